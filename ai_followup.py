@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 追问直接在上一次的查询结果上用 pandas 处理
+- "只看细皮蛙"：按上次结果里出现的取值筛选
+- "按池类型拆开看" / "按客户汇总"：按列分组求和
+- "从高到低排" / "前 5 个"：按数值列排序取前 N
+上次结果里没有对应的列或取值、或者问题带出了新的主题 / 指标（"死亡最多的前 3 个池塘"）时返回 None，
+交给数据库重新查
+"""
+import re
+
+# 追问里常用的说法 → 可能的列名（模板 SQL 用中文列名，大模型生成的 SQL 多用英文列名）
+COLUMN_SYNONYMS = {
+    "池类型": ["池塘类型", "池类型", "pond_type", "pond_type_name", "类型", "type_name"],
+    "池塘类型": ["池塘类型", "池类型", "pond_type", "pond_type_name", "类型", "type_name"],
+    "类型": ["池塘类型", "类型", "pond_type", "pond_type_name", "type", "type_name"],
+    "客户": ["客户", "客户名称", "customer", "customer_name"],
+    "池塘": ["池塘", "池塘名称", "pond", "pond_name", "name"],
+    "池子": ["池塘", "池塘名称", "pond", "pond_name", "name"],
+    "蛙种": ["蛙种", "frog_type", "frog_type_name"],
+    "品种": ["蛙种", "品种", "frog_type", "frog_type_name", "feed_type", "饲料"],
+    "日期": ["日期", "date", "log_date", "day"],
+    "月份": ["月份", "month"],
+}
+
+FILTER_WORDS = ["只看", "只要", "仅看", "只显示", "筛选", "过滤", "其中"]
+GROUP_RE = re.compile(r"按(.{1,6}?)(?:拆开|拆分|分开|分组|汇总|统计|分|看|来)")
+SORT_DESC_WORDS = ["从高到低", "从大到小", "降序", "倒序", "排个序", "排序", "排一下"]
+SORT_ASC_WORDS = ["从低到高", "从小到大", "升序"]
+TOP_RE = re.compile(r"前\s*(\d+|[一两二三四五六七八九十])\s*(?:个|名|条|位)?")
+_CN_NUM = {"一": 1, "两": 2, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+
+# 太长的问题多半是新问题，不当追问处理
+MAX_FOLLOWUP_LEN = 20
+# 主题 / 指标词：上次的问题和列名里都没有出现过，说明问的是别的东西
+SUBJECT_WORDS = ["死亡", "死", "存栏", "存量", "库存", "投喂", "喂", "饲料", "销售", "卖", "收入", "营收",
+                 "金额", "采购", "外购", "进货", "孵化", "转池", "水温", "温度", "ph", "溶氧", "湿度",
+                 "成本", "花费", "容量", "占用", "客户", "订单"]
+# 只有排序 / 取前 N 这类操作时允许不提列名，这些词去掉后不应再剩下别的内容
+FILLER_RE = re.compile(r"再|给我|看看|看下|看|一下|排|只|的|呢|吧|这些|上面|刚才|其中|个|名|条|位|[,，。.?？!！]")
+
+
+def _find_column(df, word):
+    for candidate in COLUMN_SYNONYMS.get(word, [word]):
+        for col in df.columns:
+            if str(col).lower() == candidate.lower():
+                return col
+    for col in df.columns:  # 兜底：列名和说法互相包含
+        if word in str(col) or (len(str(col)) >= 2 and str(col) in word):
+            return col
+    return None
+
+
+def _numeric_columns(df):
+    return [c for c in df.columns if df[c].dtype.kind in "iuf"]
+
+
+def _text_columns(df):
+    return [c for c in df.columns if df[c].dtype.kind == "O"]
+
+
+def _is_about_previous(q, df, previous_question):
+    """问题只围绕上次的结果：不带新的主题 / 指标词，并且提到了上次结果的列或取值（或者只是排序 / 取前 N）"""
+    context = (previous_question + "".join(str(c) for c in df.columns)).lower()
+    if any(w in q.lower() and w not in context for w in SUBJECT_WORDS):
+        return False
+    mentioned = [w for w in COLUMN_SYNONYMS if w in q and _find_column(df, w) is not None]
+    mentioned += [str(c) for c in df.columns if len(str(c)) >= 2 and str(c) in q]
+    mentioned += [v for c in _text_columns(df) for v in df[c].dropna().astype(str).unique() if v and v in q]
+    if mentioned:
+        return True
+    residue = TOP_RE.sub("", q)
+    for w in FILTER_WORDS + SORT_DESC_WORDS + SORT_ASC_WORDS:
+        residue = residue.replace(w, "")
+    return FILLER_RE.sub("", residue) == ""
+
+
+def apply_followup(question, df, previous_question=""):
+    """
+    能在 df 上处理时返回 (新 df, 说明)，否则返回 None。
+    筛选 / 分组 / 排序可以组合，例如"只看细皮蛙，按池类型汇总"。
+    previous_question：产生 df 的那次提问，用来判断追问有没有换主题。
+    """
+    q = re.sub(r"\s+", "", question)
+    if df is None or df.empty or len(q) > MAX_FOLLOWUP_LEN:
+        return None
+    if not _is_about_previous(q, df, previous_question):
+        return None
+    result, steps = df, []
+
+    if any(w in q for w in FILTER_WORDS):
+        matched = None
+        for col in _text_columns(df):
+            values = [v for v in df[col].dropna().astype(str).unique() if v and v in q]
+            if values:
+                matched = (col, max(values, key=len))
+                break
+        if matched is None:
+            return None
+        col, value = matched
+        result = result[result[col].astype(str) == value]
+        steps.append(f"只看{col}为「{value}」")
+
+    m = GROUP_RE.search(q)
+    if m:
+        col = _find_column(result, m.group(1))
+        numeric = [c for c in _numeric_columns(result) if c != col]
+        if col is None or not numeric:
+            return None
+        result = result.groupby(col, as_index=False, dropna=False)[numeric].sum()
+        result = result.sort_values(numeric[0], ascending=False)
+        steps.append(f"按{col}汇总")
+
+    top = TOP_RE.search(q)
+    ascending = any(w in q for w in SORT_ASC_WORDS)
+    if top or ascending or any(w in q for w in SORT_DESC_WORDS):
+        numeric = _numeric_columns(result)
+        if not numeric:
+            return None
+        sort_col = next((c for c in numeric if str(c) in q), numeric[0])
+        result = result.sort_values(sort_col, ascending=ascending)
+        steps.append(f"按{sort_col}{'升序' if ascending else '降序'}")
+        if top:
+            n = int(top.group(1)) if top.group(1).isdigit() else _CN_NUM[top.group(1)]
+            result = result.head(n)
+            steps.append(f"取前 {n} 条")
+
+    if not steps:
+        return None
+    return result.reset_index(drop=True), "，".join(steps)
+
+
+def format_followup_answer(df, description, max_rows=10):
+    """把处理后的结果整理成简短文字"""
+    if df.empty:
+        return f"基于上一次的查询结果（{description}），没有符合条件的数据。"
+    lines = []
+    for _, row in df.head(max_rows).iterrows():
+        lines.append("- " + "，".join(f"{col}：{_fmt(val)}" for col, val in row.items()))
+    more = f"\n（共 {len(df)} 条，只列出前 {max_rows} 条）" if len(df) > max_rows else ""
+    return f"基于上一次的查询结果（{description}）：\n" + "\n".join(lines) + more
+
+
+def _fmt(val):
+    if isinstance(val, float):
+        return f"{val:,.2f}".rstrip("0").rstrip(".")
+    return str(val)
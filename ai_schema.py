@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - AI 问答用的精简表结构
+- 原来每次提问都把所有表 json.dumps(indent=2) 塞进 system prompt，连 user_shiwa.password_hash 都在里面
+- 这里把表结构压成一行一表的 DDL 摘要（带中文注释和外键提示），每个 schema 版本只生成一次
+- 提问时按关键词 / 同义词挑出相关的表，再补上它们外键指向的表；一个都没匹配上时退回全部表
+"""
+import re
+
+# 不给 AI 看的表：账号密码、内部版本号、问答耗时统计、探头原始读数（量大，用小时 / 日汇总）
+EXCLUDED_TABLES = {"user_shiwa", "data_version_shiwa", "ai_metrics_shiwa",
+                   "sensor_reading_shiwa", "sensor_rollup_state_shiwa", "water_quality_state_shiwa"}
+
+# 表说明 + 触发该表的关键词（问题里出现任一关键词即选中）
+TABLE_DESCRIPTIONS = {
+    "pond_shiwa": ("池塘：当前存栏和容量",
+                   ["池", "池塘", "存栏", "存量", "库存", "数量", "多少只", "容量", "占用", "满"]),
+    "pond_type_shiwa": ("池塘类型：种蛙池/孵化池/养殖池/商品蛙池/N年蛙池",
+                        ["类型", "种蛙", "孵化", "养殖池", "商品蛙", "年蛙"]),
+    "frog_type_shiwa": ("蛙种：细皮蛙/粗皮蛙", ["蛙种", "品种", "细皮", "粗皮"]),
+    "feed_type_shiwa": ("饲料品种、单价和库存", ["饲料", "料", "饵料", "单价"]),
+    "feeding_record_shiwa": ("喂养记录", ["喂", "投喂", "喂养", "饲料", "吃", "成本", "花费"]),
+    "feed_usage_daily_shiwa": ("每种饲料每天的投喂总量", ["用量", "消耗", "每天", "饲料"]),
+    "feed_forecast_shiwa": ("饲料库存预测：日用量（EWMA）、可用天数、补货点、建议采购量",
+                            ["还能用", "可用天数", "补货", "采购", "用完", "够用", "库存", "用量", "消耗"]),
+    "daily_log_shiwa": ("每日池塘日志：水温/pH/溶氧/湿度/天气",
+                        ["水温", "温度", "ph", "溶氧", "湿度", "天气", "水质", "水源", "日志", "观察"]),
+    "stock_movement_shiwa": ("存栏变动流水：转池/外购/孵化/销售/死亡",
+                             ["转池", "转入", "转出", "外购", "孵化", "死亡", "死", "损耗", "变动", "流水"]),
+    "sensor_hourly_shiwa": ("水质探头每小时汇总：条数/最小/最大/平均",
+                            ["探头", "传感器", "每小时", "小时", "水温", "温度", "ph", "溶氧", "水质"]),
+    "sensor_daily_shiwa": ("水质探头每日汇总：条数/最小/最大/平均",
+                           ["探头", "传感器", "水温", "温度", "ph", "溶氧", "水质", "最高", "最低"]),
+    "water_quality_flag_shiwa": ("水质异常告警：偏离本池近期水平或同类型池子",
+                                 ["异常", "告警", "报警", "偏高", "偏低", "水质"]),
+    "death_image_shiwa": ("死亡记录的现场照片", ["照片", "图片"]),
+    "sale_order_shiwa": ("销售订单（表头）：一单可含多个池塘，合计金额", ["订单", "整单", "一单", "客单价"]),
+    "sale_record_shiwa": ("销售明细（每行一个池塘，order_id 指向订单）", ["卖", "销售", "售出", "收入", "营收", "零售", "批发", "客户", "金额"]),
+    "customer_shiwa": ("客户", ["客户", "买家", "顾客", "电话"]),
+    "frog_purchase_type_shiwa": ("外购蛙的品种、单价和剩余数量", ["外购", "采购", "蛙苗", "供应商"]),
+    "feed_purchase_record_shiwa": ("饲料采购记录", ["采购", "进货", "买料", "供应商", "支出"]),
+    "frog_purchase_record_shiwa": ("蛙苗采购记录", ["采购", "蛙苗", "进货", "供应商", "支出"]),
+    "pond_life_cycle_shiwa": ("池塘批次生命周期", ["批次", "周期", "阶段"]),
+    "pond_change_log": ("池塘修正 / 变更用途记录", ["修正", "变更", "改名", "用途"]),
+    # 报表物化视图：已经关联好名称，优先用
+    "daily_feed_mv": ("【视图，优先用】每日每池每种饲料的投喂量和成本",
+                      ["喂", "投喂", "喂养", "饲料", "成本", "花费"]),
+    "movements_labeled_mv": ("【视图，优先用】带池名/类型/中文标签的存栏变动流水",
+                             ["转池", "转入", "转出", "外购", "孵化", "死亡", "死", "损耗", "变动", "流水"]),
+    "sales_labeled_mv": ("【视图，优先用】带池名/类型/蛙种/客户名的销售明细",
+                         ["卖", "销售", "售出", "收入", "营收", "零售", "批发", "客户", "金额"]),
+}
+
+# 字段注释：数据库里没有 COMMENT 时用这里的
+COLUMN_NOTES = {
+    ("pond_shiwa", "current_count"): "当前存栏（只）",
+    ("pond_shiwa", "max_capacity"): "最大容量（只）",
+    ("feed_type_shiwa", "stock_kg"): "库存（kg）",
+    ("feeding_record_shiwa", "feed_weight_kg"): "投喂量（kg）",
+    ("feeding_record_shiwa", "total_cost"): "= feed_weight_kg * unit_price_at_time",
+    ("daily_log_shiwa", "do_value"): "溶氧 mg/L",
+    ("feed_forecast_shiwa", "ewma_7"): "近 7 天指数加权日用量（kg/天）",
+    ("feed_forecast_shiwa", "ewma_28"): "近 28 天指数加权日用量（kg/天）",
+    ("feed_forecast_shiwa", "days_left"): "库存按日用量还能用的天数，NULL = 最近没有消耗",
+    ("stock_movement_shiwa", "movement_type"): "transfer/purchase/hatch/sale/death",
+    ("stock_movement_shiwa", "from_pond_id"): "死亡/销售/转出时的池子",
+    ("stock_movement_shiwa", "to_pond_id"): "外购/孵化/转入时的池子",
+    ("sale_record_shiwa", "sale_type"): "零售/批发",
+    ("sale_record_shiwa", "total_amount"): "= quantity * unit_price",
+    ("sale_record_shiwa", "weight_jin"): "重量（斤）",
+    ("sale_order_shiwa", "total_amount"): "= 明细 total_amount 之和",
+    ("customer_shiwa", "type"): "零售/批发",
+    ("sensor_hourly_shiwa", "metric"): "1 水温 / 2 pH / 3 溶氧",
+    ("sensor_daily_shiwa", "metric"): "1 水温 / 2 pH / 3 溶氧",
+    ("water_quality_flag_shiwa", "metric"): "water_temp/ph_value/do_value/humidity（daily_log_shiwa 的字段名）",
+    ("water_quality_flag_shiwa", "method"): "self_z 偏离本池近期水平 / peer_iqr 偏离同类型池子",
+    ("water_quality_flag_shiwa", "acknowledged_at"): "NULL = 未处理",
+    ("daily_feed_mv", "feed_kg"): "投喂量（kg）",
+    ("movements_labeled_mv", "movement_label"): "转池/外购/孵化/销售出库/死亡",
+    ("movements_labeled_mv", "amount"): "= quantity * unit_price",
+}
+
+_TYPE_SHORT = [
+    (r"^VARCHAR.*|^TEXT$|^CHAR.*", "text"),
+    (r"^NUMERIC.*|^DOUBLE.*|^REAL$", "num"),
+    (r"^INTEGER$|^BIGINT$|^SMALLINT$", "int"),
+    (r"^TIMESTAMP.*", "ts"),
+]
+
+
+def _short_type(type_name):
+    for pattern, short in _TYPE_SHORT:
+        if re.match(pattern, type_name):
+            return short
+    return type_name.lower()
+
+
+def build_schema_digest(schema):
+    """
+    schema：{表名: {"columns": [{col, type, comment}], "fks": [(列, 目标表, 目标列)]}}
+    返回 {表名: 一行 DDL 摘要}，例如：
+    sale_record_shiwa(id int, pond_id int->pond_shiwa.id, ...) -- 销售记录
+    """
+    digest = {}
+    for table, info in sorted(schema.items()):
+        if table in EXCLUDED_TABLES:
+            continue
+        fks = {col: f"{ref_table}.{ref_col}" for col, ref_table, ref_col in info.get("fks", [])}
+        cols = []
+        for c in info["columns"]:
+            part = f"{c['col']} {_short_type(c['type'])}"
+            if c["col"] in fks:
+                part += f"->{fks[c['col']]}"
+            note = c.get("comment") or COLUMN_NOTES.get((table, c["col"]))
+            if note:
+                part += f" /*{note}*/"
+            cols.append(part)
+        line = f"{table}({', '.join(cols)})"
+        desc = TABLE_DESCRIPTIONS.get(table)
+        if desc:
+            line += f" -- {desc[0]}"
+        digest[table] = line
+    return digest
+
+
+def select_tables(question, schema):
+    """按关键词挑相关表，再补一层外键目标表；没有命中时返回全部（已排除敏感表）"""
+    q = question.lower()
+    available = [t for t in schema if t not in EXCLUDED_TABLES]
+    picked = {t for t in available
+              if t in q or any(k in q for k in TABLE_DESCRIPTIONS.get(t, ("", []))[1])}
+    if not picked:
+        return sorted(available)
+    for t in list(picked):
+        for _col, ref_table, _ref_col in schema[t].get("fks", []):
+            if ref_table not in EXCLUDED_TABLES:
+                picked.add(ref_table)
+    return sorted(picked)
+
+
+def estimate_tokens(text):
+    """粗估 token 数：中文约 1 字 1 token，其余约 4 字符 1 token"""
+    cjk = len(re.findall(r"[一-鿿]", text))
+    return cjk + (len(text) - cjk) // 4
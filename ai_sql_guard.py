@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - AI 生成 SQL 的安全检查
+- 词法解析（跳过注释、字符串、$$ 字符串、带引号的标识符），只允许单条 SELECT / WITH ... SELECT
+- CTE 里夹带的 INSERT / UPDATE / DELETE、SELECT INTO、FOR UPDATE、危险函数一律拒绝
+- 执行前先 EXPLAIN：总代价超上限，或出现没有连接条件的大笛卡尔积，直接拒绝
+
+只做"拒绝明显危险的语句"，真正的权限边界是 init_shiwa_db.py 建的只读角色 shiwa_ai_reader。
+"""
+import re
+
+# 不允许出现的关键字（作为独立单词，字符串 / 注释里的不算）
+FORBIDDEN_KEYWORDS = {
+    "insert", "update", "delete", "merge", "truncate", "drop", "alter", "create",
+    "grant", "revoke", "copy", "call", "do", "lock", "vacuum", "analyze", "cluster",
+    "reindex", "refresh", "set", "reset", "listen", "notify", "unlisten", "prepare",
+    "execute", "deallocate", "discard", "comment", "security", "into",
+}
+# 有副作用或能读服务器文件的函数
+FORBIDDEN_FUNCTIONS = {
+    "pg_sleep", "pg_read_file", "pg_read_binary_file", "pg_ls_dir", "pg_stat_file",
+    "lo_import", "lo_export", "lo_get", "dblink", "dblink_exec", "set_config",
+    "pg_terminate_backend", "pg_cancel_backend", "pg_reload_conf", "pg_advisory_lock",
+    "pg_advisory_xact_lock", "nextval", "setval", "txid_current", "query_to_xml",
+}
+# 不允许读的表
+FORBIDDEN_TABLES = {"user_shiwa"}
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<line_comment>--[^\n]*)
+  | (?P<block_comment>/\*.*?\*/)
+  | (?P<dollar>\$(?P<tag>[A-Za-z_]*)\$.*?\$(?P=tag)\$)
+  | (?P<string>[EeBbXxUu]?'(?:[^']|'')*')
+  | (?P<qident>"(?:[^"]|"")*")
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<semicolon>;)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+class UnsafeSQLError(ValueError):
+    """AI 生成的 SQL 不满足只读 / 代价限制"""
+
+
+def _tokens(sql):
+    """返回 [(类型, 文本)]，注释替换成一个空格"""
+    out = []
+    pos = 0
+    while pos < len(sql):
+        m = _TOKEN_RE.match(sql, pos)
+        if m.group("block_comment") is None and sql.startswith("/*", pos):
+            raise UnsafeSQLError("注释没有闭合")
+        kind = m.lastgroup if m.lastgroup != "tag" else "dollar"
+        pos = m.end()
+        if kind in ("line_comment", "block_comment"):
+            out.append(("ws", " "))
+            continue
+        if kind == "other" and m.group() in ("'", '"', "$"):
+            raise UnsafeSQLError("字符串或标识符没有闭合")
+        out.append((kind, m.group()))
+    return out
+
+
+def validate_select(sql):
+    """检查通过时返回去掉末尾分号的 SQL，否则抛 UnsafeSQLError"""
+    tokens = _tokens(sql)
+    while tokens and tokens[-1][0] in ("ws", "semicolon"):
+        tokens.pop()
+    if not tokens:
+        raise UnsafeSQLError("SQL 为空")
+    if any(kind == "semicolon" for kind, _ in tokens):
+        raise UnsafeSQLError("只允许一条语句")
+
+    words = [text.lower() for kind, text in tokens if kind == "word"]
+    if not words:
+        raise UnsafeSQLError("仅允许 SELECT 查询")
+    if words[0] not in ("select", "with"):
+        raise UnsafeSQLError("仅允许 SELECT 查询")
+    bad = FORBIDDEN_KEYWORDS.intersection(words)
+    if bad:
+        raise UnsafeSQLError(f"不允许的关键字：{', '.join(sorted(bad))}")
+    idents = set(words) | {text.strip('"').lower() for kind, text in tokens if kind == "qident"}
+    bad = FORBIDDEN_FUNCTIONS.intersection(idents)
+    if bad:
+        raise UnsafeSQLError(f"不允许的函数：{', '.join(sorted(bad))}")
+    bad = FORBIDDEN_TABLES.intersection(idents)
+    if bad:
+        raise UnsafeSQLError(f"不允许查询的表：{', '.join(sorted(bad))}")
+    for prev, cur in zip(words, words[1:]):
+        if prev == "for" and cur in ("update", "share", "no", "key"):
+            raise UnsafeSQLError("不允许加锁查询")
+
+    # 用词法单元重新拼接：去掉注释和末尾分号，交给服务端游标（DECLARE ... CURSOR FOR）执行
+    return "".join(text for _, text in tokens).strip()
+
+
+def check_plan(plan, max_cost, max_cross_rows):
+    """
+    plan：EXPLAIN (FORMAT JSON) 的结果（[{"Plan": {...}}]）。
+    总代价超过 max_cost，或有无连接条件的 Nested Loop 且两边行数乘积超过 max_cross_rows 时拒绝。
+    """
+    root = plan[0]["Plan"]
+    if root["Total Cost"] > max_cost:
+        raise UnsafeSQLError(f"查询代价过高（估算 {root['Total Cost']:.0f}，上限 {max_cost:.0f}），请缩小范围")
+
+    def walk(node):
+        children = node.get("Plans", [])
+        if node["Node Type"] == "Nested Loop" and "Join Filter" not in node and len(children) == 2:
+            outer, inner = children
+            # 内侧带条件的索引扫描 / 过滤是参数化连接，不是笛卡尔积
+            inner_has_cond = any(k in inner for k in ("Index Cond", "Filter", "Recheck Cond"))
+            if not inner_has_cond and outer["Plan Rows"] * inner["Plan Rows"] > max_cross_rows:
+                raise UnsafeSQLError("查询包含没有连接条件的表（笛卡尔积），请补充 JOIN 条件")
+        for child in children:
+            walk(child)
+
+    walk(root)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 常见问题的模板直答（不调用大模型）
+- 管理人员问得最多的几类问题：全场存栏、各类型存栏、占用率、本月饲料成本、本周死亡、客户销售
+- 关键词匹配意图，从问题里抽取时间范围 / 池塘类型 / 蛙种，套用写好的参数化 SQL，再按模板组织回答
+- 匹配不上（或问题带有"为什么""趋势"等需要分析的词）才交给大模型；本模块不依赖网络
+"""
+import re
+from datetime import date, timedelta
+
+# 带这些词的问题需要分析推理，不走模板
+BLOCK_WORDS = ["为什么", "原因", "趋势", "预测", "建议", "对比", "比较", "平均", "同比", "环比", "哪个", "哪些",
+               "最多", "最少", "最高", "最低", "最大", "最小",
+               "每天", "每周", "每月", "每个月", "按天", "按月", "容量", "还能"]
+
+# 问的是流水（外购、销售、喂养……）而不是当前存栏
+FLOW_WORDS = ["外购", "采购", "孵化", "转池", "转入", "转出", "卖", "销售", "喂", "死"]
+
+FROG_TYPES = ["细皮蛙", "粗皮蛙"]
+
+_CN_NUM = {"一": 1, "两": 2, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+
+
+class TemplateMatch:
+    """命中的模板：name 意图名、sql 参数化 SQL、params 参数、label 时间范围说明"""
+
+    def __init__(self, name, sql, params, label, formatter):
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self.label = label
+        self.formatter = formatter
+
+    def format_answer(self, df):
+        return self.formatter(df, self)
+
+
+def _parse_count(text):
+    if text.isdigit():
+        return int(text)
+    return _CN_NUM.get(text)
+
+
+def extract_date_range(question, today, default):
+    """
+    返回 (开始日期, 结束日期（不含）, 说明)；问题里没有时间词时用 default（"week"/"month"）。
+    支持：今天、昨天、本周/这周、上周、本月/这个月、上个月、今年、最近/近 N 天|周
+    """
+    q = question
+    m = re.search(r"(?:最近|近)\s*(\d+|[一两二三四五六七八九十])\s*(天|日|周|星期)", q)
+    if m:
+        n = _parse_count(m.group(1)) or 7
+        days = n * 7 if m.group(2) in ("周", "星期") else n
+        return today - timedelta(days=days - 1), today + timedelta(days=1), f"最近 {days} 天"
+    if "昨天" in q:
+        return today - timedelta(days=1), today, "昨天"
+    if "今天" in q or "今日" in q:
+        return today, today + timedelta(days=1), "今天"
+    week_start = today - timedelta(days=today.weekday())
+    if "上周" in q or "上星期" in q:
+        return week_start - timedelta(days=7), week_start, "上周"
+    month_start = today.replace(day=1)
+    if "上个月" in q or "上月" in q:
+        prev_start = (month_start - timedelta(days=1)).replace(day=1)
+        return prev_start, month_start, "上个月"
+    if "今年" in q or "本年" in q:
+        return today.replace(month=1, day=1), today + timedelta(days=1), "今年"
+    if "本周" in q or "这周" in q or "本星期" in q or default == "week":
+        return week_start, today + timedelta(days=1), "本周"
+    return month_start, today + timedelta(days=1), "本月"
+
+
+def _extract_names(question, names, suffix=None):
+    """
+    返回问题里提到的名称（长的优先，被更长名称包含的不重复计）；
+    给了 suffix 时允许省略末尾的字（"细皮"→"细皮蛙"）。
+    池塘类型不省略："养殖池"省成"养殖"会和"养殖场"混淆。
+    """
+    found, rest = [], question
+    for name in sorted(names, key=len, reverse=True):
+        short = name[:-len(suffix)] if suffix and name.endswith(suffix) else name
+        for token in (name, short):
+            if token in rest:
+                found.append(name)
+                rest = rest.replace(token, "|")
+                break
+    return found
+
+
+def _has(question, words):
+    return any(w in question for w in words)
+
+
+# ---------- 回答模板 ----------
+def _fmt_total_stock(df, m):
+    scope = "".join(x for x in (m.params["pond_type"], m.params["frog_type"]) if x) or "全场"
+    row = df.iloc[0]
+    return f"{scope}目前共有 {int(row['存栏']):,} 只蛙，分布在 {int(row['池塘数'])} 个池塘。"
+
+
+def _fmt_stock_by_type(df, m):
+    if df.empty:
+        return "目前没有池塘数据。"
+    lines = [f"- {r['池塘类型']}：{int(r['存栏']):,} 只（{int(r['池塘数'])} 个池）" for _, r in df.iterrows()]
+    return f"各类型池塘存栏（合计 {int(df['存栏'].sum()):,} 只）：\n" + "\n".join(lines)
+
+
+def _fmt_occupancy(df, m):
+    if df.empty:
+        return "目前没有池塘数据。"
+    total_count, total_cap = df["存栏"].sum(), df["容量"].sum()
+    overall = total_count / total_cap if total_cap else 0
+    lines = [f"- {r['池塘类型']}：{r['占用率']:.1%}（{int(r['存栏']):,} / {int(r['容量']):,}）"
+             for _, r in df.iterrows()]
+    return f"整体占用率 {overall:.1%}（{int(total_count):,} / {int(total_cap):,}）：\n" + "\n".join(lines)
+
+
+def _fmt_feed_cost(df, m):
+    row = df.iloc[0]
+    if not row["次数"]:
+        return f"{m.label}还没有喂养记录。"
+    return (f"{m.label}饲料成本 {float(row['成本']):,.2f} 元，共投喂 {float(row['投喂量']):,.2f} kg，"
+            f"{int(row['次数'])} 次喂养记录。")
+
+
+def _fmt_deaths(df, m):
+    if df.empty:
+        return f"{m.label}没有死亡记录。"
+    lines = [f"- {r['池塘']}：{int(r['死亡数'])} 只" for _, r in df.head(5).iterrows()]
+    more = f"\n（共 {len(df)} 个池有死亡记录）" if len(df) > 5 else ""
+    return f"{m.label}共死亡 {int(df['死亡数'].sum()):,} 只，按池塘：\n" + "\n".join(lines) + more
+
+
+def _fmt_sales_by_customer(df, m):
+    if df.empty:
+        return f"{m.label}没有销售记录。"
+    lines = [f"- {r['客户']}：{int(r['数量']):,} 只，{float(r['金额']):,.2f} 元" for _, r in df.head(10).iterrows()]
+    return (f"{m.label}共销售 {int(df['数量'].sum()):,} 只，金额 {float(df['金额'].sum()):,.2f} 元，按客户：\n"
+            + "\n".join(lines))
+
+
+# ---------- SQL ----------
+_POND_FILTER = """
+    (%(pond_type)s IS NULL OR pt.name = %(pond_type)s)
+    AND (%(frog_type)s IS NULL OR ft.name = %(frog_type)s)
+"""
+
+SQL_TOTAL_STOCK = f"""
+    SELECT COALESCE(SUM(p.current_count), 0) AS 存栏, COUNT(*) AS 池塘数
+    FROM pond_shiwa p
+    LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+    LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+    WHERE {_POND_FILTER};
+"""
+
+SQL_STOCK_BY_TYPE = f"""
+    SELECT COALESCE(pt.name, '未分类') AS 池塘类型,
+           COALESCE(SUM(p.current_count), 0) AS 存栏,
+           COUNT(*) AS 池塘数
+    FROM pond_shiwa p
+    LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+    LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+    WHERE {_POND_FILTER}
+    GROUP BY pt.name
+    ORDER BY 存栏 DESC;
+"""
+
+SQL_OCCUPANCY = f"""
+    SELECT COALESCE(pt.name, '未分类') AS 池塘类型,
+           COALESCE(SUM(p.current_count), 0) AS 存栏,
+           COALESCE(SUM(p.max_capacity), 0) AS 容量,
+           COALESCE(SUM(p.current_count)::float / NULLIF(SUM(p.max_capacity), 0), 0) AS 占用率
+    FROM pond_shiwa p
+    LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+    LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+    WHERE {_POND_FILTER}
+    GROUP BY pt.name
+    ORDER BY 占用率 DESC;
+"""
+
+SQL_FEED_COST = f"""
+    SELECT COALESCE(SUM(fr.total_cost), 0) AS 成本,
+           COALESCE(SUM(fr.feed_weight_kg), 0) AS 投喂量,
+           COUNT(fr.id) AS 次数
+    FROM feeding_record_shiwa fr
+    JOIN pond_shiwa p ON fr.pond_id = p.id
+    LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+    LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+    WHERE fr.fed_at >= %(start)s AND fr.fed_at < %(end)s AND {_POND_FILTER};
+"""
+
+SQL_DEATHS = f"""
+    SELECT p.name AS 池塘, SUM(sm.quantity) AS 死亡数
+    FROM stock_movement_shiwa sm
+    JOIN pond_shiwa p ON sm.from_pond_id = p.id
+    LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+    LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+    WHERE sm.movement_type = 'death'
+      AND sm.moved_at >= %(start)s AND sm.moved_at < %(end)s AND {_POND_FILTER}
+    GROUP BY p.name
+    ORDER BY 死亡数 DESC;
+"""
+
+SQL_SALES_BY_CUSTOMER = f"""
+    SELECT COALESCE(c.name, '散客') AS 客户,
+           SUM(sr.quantity) AS 数量,
+           SUM(sr.total_amount) AS 金额
+    FROM sale_record_shiwa sr
+    JOIN pond_shiwa p ON sr.pond_id = p.id
+    LEFT JOIN customer_shiwa c ON sr.customer_id = c.id
+    LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+    LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+    WHERE sr.sold_at >= %(start)s AND sr.sold_at < %(end)s AND {_POND_FILTER}
+    GROUP BY c.name
+    ORDER BY 金额 DESC;
+"""
+
+def match_template(question, pond_types, today=None):
+    """命中返回 TemplateMatch，否则返回 None；pond_types 为数据库里的池塘类型名称列表"""
+    q = re.sub(r"\s+", "", question)
+    if _has(q, BLOCK_WORDS):
+        return None
+    today = today or date.today()
+    pond_type_hits = _extract_names(q, pond_types)
+    frog_type_hits = _extract_names(q, FROG_TYPES, "蛙")
+    if len(pond_type_hits) > 1 or len(frog_type_hits) > 1:
+        return None  # "细皮蛙和粗皮蛙各多少"这类对比交给大模型
+    params = {
+        "pond_type": pond_type_hits[0] if pond_type_hits else None,
+        "frog_type": frog_type_hits[0] if frog_type_hits else None,
+    }
+    by_type = _has(q, ["各类", "每类", "各种", "按类型", "分类型", "各池塘类型", "各个类型", "每种"])
+
+    if _has(q, ["占用率", "利用率", "使用率", "满不满", "空余"]):
+        return TemplateMatch("occupancy", SQL_OCCUPANCY, params, "当前", _fmt_occupancy)
+    if _has(q, ["饲料", "喂", "料"]) and _has(q, ["成本", "花费", "花了", "费用", "多少钱", "开销"]) \
+            and not _has(q, ["采购", "进货", "买料"]):
+        start, end, label = extract_date_range(q, today, "month")
+        return TemplateMatch("feed_cost", SQL_FEED_COST, {**params, "start": start, "end": end},
+                             label, _fmt_feed_cost)
+    # "死亡率"问的是比例，模板只会数死亡只数
+    if _has(q, ["死亡", "死了", "死掉", "损失多少"]) and not _has(q, ["率", "比例", "占比"]):
+        start, end, label = extract_date_range(q, today, "week")
+        return TemplateMatch("deaths", SQL_DEATHS, {**params, "start": start, "end": end},
+                             label, _fmt_deaths)
+    if _has(q, ["销售", "卖", "销量", "售出"]) and _has(q, ["客户", "买家", "顾客"]):
+        start, end, label = extract_date_range(q, today, "month")
+        return TemplateMatch("sales_by_customer", SQL_SALES_BY_CUSTOMER, {**params, "start": start, "end": end},
+                             label, _fmt_sales_by_customer)
+    # "孵化池"里的"孵化"不算流水
+    q_flow = q.replace(params["pond_type"], "") if params["pond_type"] else q
+    if _has(q, ["存栏", "多少只", "几只", "总数", "数量", "共有", "一共"]) and not _has(q_flow, FLOW_WORDS):
+        if by_type:
+            return TemplateMatch("stock_by_type", SQL_STOCK_BY_TYPE, params, "当前", _fmt_stock_by_type)
+        return TemplateMatch("total_stock", SQL_TOTAL_STOCK, params, "当前", _fmt_total_stock)
+    return None
@@ -2,19 +2,42 @@ import streamlit as st
 import os
 from urllib.parse import urlparse
 import psycopg2
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 from PIL import Image
 import io
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from dotenv import load_dotenv
 import uuid
+import select
+import threading
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from psycopg2 import sql as pgsql
+from psycopg2.extras import execute_values
+from psycopg2.errors import QueryCanceled
+from pandas.errors import DatabaseError as PandasDatabaseError
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ================== ① AI 问答新增依赖 ==================
 import json, tempfile, pandas as pd
+import re, hashlib, unicodedata
 from datetime import datetime
 from openai import OpenAI
-from sqlalchemy import create_engine, text, inspect
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.exc import SQLAlchemyError
+from result_cache import build_result_cache
+from ai_schema import build_schema_digest, select_tables, estimate_tokens
+from ai_sql_guard import validate_select, check_plan
+from ai_templates import match_template
+from ai_followup import apply_followup, format_followup_answer
+from water_quality import run_incremental as detect_water_quality, METRIC_LABELS as WATER_METRIC_LABELS, METHOD_LABELS
+from sensor_ingest import DAILY_LOG_COLUMNS as SENSOR_DAILY_LOG_COLUMNS
+from feed_forecast import (refresh as refresh_feed_forecast_table, SAFETY_DAYS as FEED_SAFETY_DAYS,
+                           COVER_DAYS as FEED_COVER_DAYS)
+from session_auth import SessionStore, LoginRateLimiter, InvalidSession
+from death_image_store import (DEATH_IMAGE_DIR, stage_upload, staged_path_for,
+                               finalize_staged, discard_staged, storage_usage_by_month, RenditionCache,
+                               STATUS_PENDING, STATUS_PROCESSING, STATUS_READY, STATUS_FAILED)
 # =======================================================
 
 # -----------------------------
@@ -40,8 +63,25 @@ except Exception as e:
     st.error(f"❌ 数据库 URL 解析失败: {e}")
     st.stop()
 
-# 确保死亡图片目录存在
-DEATH_IMAGE_DIR = "death_images"
+# 可选：只读副本（报表 / ROI / AI 查询走副本，录入与库存校验仍走主库）
+# 本地验证：起两个 PG 实例（主库 + 流复制副本），分别配置两个 URL；停掉副本后报表自动回退主库
+DATABASE_REPLICA_URL = os.getenv("DATABASE_SHIWA_REPLICA_URL")
+REPLICA_DB_CONFIG = None
+if DATABASE_REPLICA_URL:
+    try:
+        replica_url = urlparse(DATABASE_REPLICA_URL)
+        REPLICA_DB_CONFIG = {
+            "host": replica_url.hostname,
+            "port": replica_url.port or 5432,
+            "database": replica_url.path[1:],
+            "user": replica_url.username,
+            "password": replica_url.password,
+        }
+    except Exception as e:
+        st.error(f"❌ 副本数据库 URL 解析失败: {e}")
+        st.stop()
+
+# 确保死亡图片目录存在（目录名见 death_image_store.py）
 os.makedirs(DEATH_IMAGE_DIR, exist_ok=True)
 
 # -----------------------------
@@ -72,8 +112,140 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 # -----------------------------
 # 数据库工具函数
 # -----------------------------
-def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+# 各类查询的 statement_timeout 预算（毫秒）：页面加载要快，报表可以慢一些，AI 生成的 SQL 最严格
+QUERY_TIMEOUTS_MS = {
+    "page": int(os.getenv("SHIWA_TIMEOUT_PAGE_MS", "5000")),
+    "report": int(os.getenv("SHIWA_TIMEOUT_REPORT_MS", "60000")),
+    "ai": int(os.getenv("SHIWA_TIMEOUT_AI_MS", "8000")),
+}
+
+# 当前线程里打开的查询连接（run_cancellable 用来在 rerun 时取消后端查询）
+_query_tracker = threading.local()
+
+def _connect(config, query_class=None, **kwargs):
+    if query_class:
+        kwargs["options"] = f"-c statement_timeout={QUERY_TIMEOUTS_MS[query_class]}"
+    conn = psycopg2.connect(**config, **kwargs)
+    tracked = getattr(_query_tracker, "conns", None)
+    if tracked is not None:
+        tracked.append(conn)
+    return conn
+
+def get_db_connection(query_class=None):
+    """主库连接；query_class 为 page/report/ai 时带上对应的 statement_timeout，写入不设超时"""
+    return _connect(DB_CONFIG, query_class)
+
+# 副本连接失败后，这段时间内直接走主库，避免每次报表都等连接超时
+REPLICA_RETRY_SECONDS = 30
+_replica_state = {"down_until": 0.0}
+
+def _replica_lagging(conn, required_versions):
+    """副本上的数据版本是否落后于主库（版本表随物理复制同步过来）"""
+    cur = conn.cursor()
+    cur.execute("SELECT table_name, version FROM data_version_shiwa WHERE table_name = ANY(%s);",
+                (list(required_versions),))
+    replica_versions = dict(cur.fetchall())
+    cur.close()
+    return any(replica_versions.get(t, 0) < v for t, v in required_versions.items())
+
+def get_report_connection(required_versions=None, query_class="report"):
+    """
+    只读报表连接：配置了 DATABASE_SHIWA_REPLICA_URL 时优先连副本，
+    副本连不上，或落后于 required_versions（{表名: 主库版本号}）时回退主库。
+    写入和"写后立即读"（表单、库存校验）不要用这个连接。
+    """
+    if REPLICA_DB_CONFIG and monotonic() >= _replica_state["down_until"]:
+        try:
+            conn = _connect(REPLICA_DB_CONFIG, query_class, connect_timeout=3)
+        except psycopg2.OperationalError as e:
+            print(f"[replica] 副本不可用，{REPLICA_RETRY_SECONDS} 秒内回退主库：{e}")
+            _replica_state["down_until"] = monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            try:
+                lagging = bool(required_versions) and _replica_lagging(conn, required_versions)
+            except psycopg2.Error as e:
+                # 版本表还没同步过来 / 副本正在恢复 / 查询超时：这次走主库
+                print(f"[replica] 检查副本版本失败，回退主库：{e}")
+                lagging = True
+            if lagging:
+                conn.close()
+            else:
+                conn.rollback()
+                conn.set_session(readonly=True)
+                return conn
+    conn = get_db_connection(query_class)
+    conn.set_session(readonly=True)
+    return conn
+
+# -----------------------------
+# 可取消的慢查询
+# -----------------------------
+class ReportNotReady(Exception):
+    """查询超过 statement_timeout 被数据库取消，页面显示"报表准备中"降级状态"""
+
+def is_query_canceled(exc):
+    """statement_timeout / cancel：psycopg2 直接抛 QueryCanceled，经 pd.read_sql 会被包成 pandas 的 DatabaseError"""
+    return isinstance(exc, QueryCanceled) or (
+        isinstance(exc, PandasDatabaseError) and isinstance(exc.__cause__, QueryCanceled))
+
+def page_query(fn, *args, default=None, label="数据", **kwargs):
+    """
+    page 类查询（5 秒超时）被取消时提示一下并返回 default，页面其余部分照常渲染；
+    放在缓存函数外面调用，超时不会被缓存。
+    """
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        if not is_query_canceled(e):
+            raise
+        st.warning(f"⏳ {label}查询超时，请稍后刷新重试")
+        return default
+
+_query_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SHIWA_QUERY_WORKERS", "4")),
+                                 thread_name_prefix="shiwa-query")
+
+def run_cancellable(fn, *args, label="查询中"):
+    """
+    在后台线程执行 fn(*args)，脚本线程每 0.5 秒刷新一次等待提示。
+    用户 rerun / 切换页面时 Streamlit 会在下一次 st 调用处打断脚本，
+    这里在 finally 里对还没结束的连接发 cancel（等价于 pg_cancel_backend），后端查询立即停止。
+    """
+    ctx = get_script_run_ctx()
+    conns = []
+
+    def _worker():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        _query_tracker.conns = conns
+        try:
+            return fn(*args)
+        finally:
+            _query_tracker.conns = None
+
+    future = _query_pool.submit(_worker)
+    placeholder = st.empty()
+    started = monotonic()
+    try:
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except FutureTimeout:
+                placeholder.caption(f"⏳ {label}…已等待 {monotonic() - started:.0f} 秒")
+            except Exception as e:
+                if is_query_canceled(e):
+                    raise ReportNotReady(str(e)) from e
+                raise
+    finally:
+        placeholder.empty()
+        if not future.done():
+            for conn in conns:
+                if not conn.closed:
+                    conn.cancel()
+
+def show_report_pending(name, retry_key):
+    """慢查询超时后的降级显示"""
+    st.info(f"⏳ {name}正在准备中（数据量较大，本次查询超时），请稍后刷新查看。")
+    if st.button("🔄 重新加载", key=retry_key):
+        st.rerun()
 
 def table_exists(cursor, table_name):
     cursor.execute("""
@@ -118,8 +290,103 @@ def get_user_by_username(username: str):
     return row  # (id, username, password_hash, department, role) 或 None
 
 # -----------------------------
-# 初始化用户表（如果不存在）
+# 🔐 登录会话：签名令牌 + 进程内缓存 + 后台 bcrypt + 限流（见 session_auth.py）
 # -----------------------------
+SESSION_PARAM = "s"  # 页面地址里的查询参数名
+# 令牌在地址栏里会随链接 / 浏览器历史 / 访问日志泄露（见 session_auth.py），有效期保持短，使用中自动续期
+SESSION_TTL = int(float(os.getenv("SHIWA_SESSION_TTL_HOURS", "2")) * 3600)
+LOGIN_MAX_FAILURES = int(os.getenv("SHIWA_LOGIN_MAX_FAILURES", "5"))
+LOGIN_LOCKOUT_SECONDS = int(os.getenv("SHIWA_LOGIN_LOCKOUT_SECONDS", "300"))
+
+# 只用来限制同时跑 bcrypt 的线程数（防止并发登录把 CPU 占满）；调用方仍同步等结果，不会让登录变快
+_auth_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SHIWA_AUTH_WORKERS", "2")),
+                                thread_name_prefix="shiwa-auth")
+
+@st.cache_resource(show_spinner=False)
+def get_session_store():
+    secret = os.getenv("SHIWA_SESSION_SECRET")
+    if not secret:
+        # 没配置时每个进程随机生成：进程重启后旧令牌失效，多进程部署时必须配置
+        print("[session] 未设置 SHIWA_SESSION_SECRET，使用进程内随机密钥")
+        secret = uuid.uuid4().hex + uuid.uuid4().hex
+    return SessionStore(secret, SESSION_TTL)
+
+@st.cache_resource(show_spinner=False)
+def get_dummy_password_hash():
+    """用户名不存在时也校验一次这个哈希，让响应时间不暴露用户名是否存在"""
+    return hash_password(uuid.uuid4().hex)
+
+@st.cache_resource(show_spinner=False)
+def get_login_limiter():
+    return LoginRateLimiter(max_failures=LOGIN_MAX_FAILURES, lockout_seconds=LOGIN_LOCKOUT_SECONDS)
+
+def _authenticate(username: str, password: str):
+    """在后台线程里跑：查库 + bcrypt 校验，成功返回用户 dict，否则 None"""
+    user = get_user_by_username(username)
+    try:
+        ok = verify_password(password, user[2] if user else get_dummy_password_hash())
+    except ValueError:  # 库里的哈希格式不对
+        ok = False
+    if not (user and ok):
+        return None
+    return {"id": user[0], "username": user[1], "department": user[3], "role": user[4]}
+
+def authenticate(username: str, password: str):
+    """返回 (用户 dict 或 None, 需等待秒数)；被限流时不查库、不跑 bcrypt"""
+    limiter = get_login_limiter()
+    wait = limiter.retry_after(username)
+    if wait:
+        return None, wait
+    with st.spinner("正在验证…"):
+        user = _auth_pool.submit(_authenticate, username, password).result()
+    if user:
+        limiter.record_success(username)
+    else:
+        limiter.record_failure(username)
+    return user, 0
+
+def resume_session():
+    """地址里带有效令牌时直接恢复登录（不查库、不跑 bcrypt），返回是否恢复成功"""
+    token = st.query_params.get(SESSION_PARAM)
+    if not token:
+        return False
+    try:
+        st.session_state.user = get_session_store().verify(token)
+    except InvalidSession as e:
+        print(f"[session] 令牌无效：{e}")
+        del st.query_params[SESSION_PARAM]
+        return False
+    st.session_state.logged_in = True
+    st.session_state.session_token = token
+    return True
+
+def renew_session():
+    """令牌过了一半有效期就换发新的并吊销旧的：用着的人不掉线，地址栏里泄露出去的旧链接尽快失效"""
+    token = st.session_state.get("session_token")
+    if not token:
+        return
+    store = get_session_store()
+    try:
+        if not store.needs_renewal(token):
+            return
+    except InvalidSession:
+        return
+    store.revoke(token)
+    st.session_state.session_token = store.issue(st.session_state.user)
+    st.query_params[SESSION_PARAM] = st.session_state.session_token
+
+def end_session():
+    token = st.session_state.pop("session_token", None)
+    if token:
+        get_session_store().revoke(token)
+    st.query_params.pop(SESSION_PARAM, None)
+    st.session_state.logged_in = False
+    st.session_state.user = None
+
+# -----------------------------
+# 初始化用户表（如果不存在）：每个进程只建一次，断线重连不再查库
+# -----------------------------
+@st.cache_resource(show_spinner=False)
 def init_user_table():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -186,18 +453,45 @@ COMMON_REMARKS = {
         "暴雨后应急转移"
     ]
 }
+# AI 查询的限制：低权限角色（init_shiwa_db.py 创建）、最多取回的行数、EXPLAIN 代价上限
+AI_DB_ROLE = os.getenv("SHIWA_AI_ROLE", "shiwa_ai_reader")
+AI_ROW_CAP = int(os.getenv("SHIWA_AI_ROW_CAP", "200"))
+AI_MAX_COST = float(os.getenv("SHIWA_AI_MAX_COST", "100000"))
+AI_MAX_CROSS_ROWS = int(os.getenv("SHIWA_AI_MAX_CROSS_ROWS", "100000"))
+
 def execute_safe_select(sql: str) -> pd.DataFrame:
-    """只允许 SELECT，返回 DataFrame"""
-    # 移除重复的 import pandas as pd，直接使用全局导入的 pd
-    sql = sql.strip()
-    if not sql.lower().startswith("select"):
-        raise ValueError("仅允许 SELECT 查询")
-    engine = create_engine(DATABASE_URL)
-    with engine.connect() as conn:
-        return pd.read_sql(text(sql), conn)
+    """
+    执行 AI 生成的 SQL：词法检查（单条 SELECT）→ 只读事务 + 低权限角色 → EXPLAIN 代价检查
+    → 服务端游标最多取 AI_ROW_CAP 行。超时由 "ai" 类的 statement_timeout 兜底。
+    结果被截断时 df.attrs["truncated"] 为 True。
+    """
+    sql = validate_select(sql)
+    conn = get_report_connection(query_class="ai")
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute(pgsql.SQL("SET LOCAL ROLE {};").format(pgsql.Identifier(AI_DB_ROLE)))
+        except psycopg2.Error as e:
+            raise RuntimeError(f"AI 只读角色 {AI_DB_ROLE} 不可用，请重新运行 init_shiwa_db.py：{e}") from e
+        cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+        check_plan(cur.fetchone()[0], AI_MAX_COST, AI_MAX_CROSS_ROWS)
+        cur.close()
+
+        # 服务端游标：只把需要的行传回来，大结果集不会整表进内存
+        cur = conn.cursor(name="ai_select")
+        cur.execute(sql)
+        rows = cur.fetchmany(AI_ROW_CAP + 1)
+        columns = [d[0] for d in cur.description]
+        cur.close()
+    finally:
+        conn.rollback()
+        conn.close()
+    df = pd.DataFrame.from_records(rows[:AI_ROW_CAP], columns=columns, coerce_float=True)
+    df.attrs["truncated"] = len(rows) > AI_ROW_CAP
+    return df
 # ==========================================
 def get_recent_movements(limit=20):
-    conn = get_db_connection()
+    conn = get_db_connection("page")
     cur = conn.cursor()
     cur.execute("""
         SELECT sm.id,
@@ -228,7 +522,7 @@ def get_recent_movements(limit=20):
 # 业务功能函数
 # -----------------------------
 def get_all_ponds():
-    conn = get_db_connection()
+    conn = get_db_connection("page")
     cur = conn.cursor()
     cur.execute("""
         SELECT p.id, p.name, pt.name AS pond_type, ft.name AS frog_type, 
@@ -243,6 +537,78 @@ def get_all_ponds():
     conn.close()
     return rows
 
+# ---- 池塘总览：筛选 / 排序 / 分页 / 汇总都在数据库里做，页面只取当前页 ----
+# 排序选项 → ORDER BY（白名单，不拼接用户输入）
+POND_SORT_OPTIONS = {
+    "编号": "p.id",
+    "占用率从高到低": "occupancy DESC NULLS LAST, p.id",
+    "占用率从低到高": "occupancy ASC NULLS LAST, p.id",
+    "当前数量从多到少": "p.current_count DESC, p.id",
+    "名称": "p.name",
+}
+POND_OCCUPANCY_SQL = "LEAST(ROUND(p.current_count * 100.0 / NULLIF(p.max_capacity, 0), 1), 100)"
+
+def _pond_filter_sql(frog_types, pond_types):
+    """frog_types / pond_types 为 None 表示不筛选"""
+    clauses, params = [], []
+    if frog_types is not None:
+        clauses.append("ft.name = ANY(%s)")
+        params.append(list(frog_types))
+    if pond_types is not None:
+        clauses.append("pt.name = ANY(%s)")
+        params.append(list(pond_types))
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def get_pond_page(frog_types, pond_types, sort_key, page, page_size):
+    """返回 (当前页行, 筛选后总行数)；行：(id, 名称, 池类型, 蛙种, 最大容量, 当前数量, 占用率%)"""
+    where, params = _pond_filter_sql(frog_types, pond_types)
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT p.id, p.name, pt.name, ft.name, p.max_capacity, p.current_count,
+               {POND_OCCUPANCY_SQL} AS occupancy,
+               COUNT(*) OVER () AS total_rows
+        FROM pond_shiwa p
+        JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+        {where}
+        ORDER BY {POND_SORT_OPTIONS[sort_key]}
+        LIMIT %s OFFSET %s;
+    """, params + [page_size, page * page_size])
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    # 翻页越界（例如筛选后页数变少）时总数取不到，回第一页
+    total = rows[0][-1] if rows else 0
+    return [r[:-1] for r in rows], total
+
+def get_pond_summary(frog_types, pond_types):
+    """
+    GROUPING SETS 一次算出：按池类型、按蛙种、池类型×蛙种、全场合计。
+    行：(池类型, 蛙种, 层级, 池数, 总容量, 当前数量, 占用率%)；层级：合计 / 池类型 / 蛙种 / 明细
+    """
+    where, params = _pond_filter_sql(frog_types, pond_types)
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT pt.name, ft.name,
+               CASE GROUPING(pt.name, ft.name)
+                   WHEN 3 THEN '合计' WHEN 1 THEN '池类型' WHEN 2 THEN '蛙种' ELSE '明细'
+               END AS level,
+               COUNT(*), SUM(p.max_capacity), SUM(p.current_count),
+               ROUND(SUM(p.current_count) * 100.0 / NULLIF(SUM(p.max_capacity), 0), 1)
+        FROM pond_shiwa p
+        JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+        {where}
+        GROUP BY GROUPING SETS ((pt.name), (ft.name), (pt.name, ft.name), ())
+        ORDER BY GROUPING(pt.name, ft.name) DESC, pt.name NULLS FIRST, ft.name NULLS FIRST;
+    """, params)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
 
 def add_feeding_record(pond_id, feed_type_id, weight_kg, unit_price, notes,
                        fed_at=None, fed_by=None):
@@ -580,12 +946,23 @@ def add_stock_movement(movement_type, from_pond_id, to_pond_id, quantity,
 def add_death_record(from_pond_id: int, quantity: int, note: str = "", image_files=None, created_by: str = None, moved_at=None):
     """
     记录死亡事件：
-    1. 扣减源池 current_count
-    2. 插入 stock_movement_shiwa（movement_type='death'）
-    3. 保存死亡照片（如有）
+    1. 先把照片原始字节落到 staging/（不占数据库事务）
+    2. 扣减源池 current_count，插入 stock_movement_shiwa（movement_type='death'）
+       和 death_image_shiwa（status='processing'，由本进程认领），立即提交
+    3. 提交后把照片交给后台线程：生成缩略图 + 移到正式位置 + 标记 ready
     """
+    # ========== 先落盘照片（事务外）==========
+    staged = []  # [(staging 路径, 最终路径, sha256, 字节数)]
+    for uploaded_file in image_files or []:
+        if uploaded_file is not None:
+            ext = os.path.splitext(uploaded_file.name)[1].lower()
+            if ext not in ['.png', '.jpg', '.jpeg']:
+                continue  # 跳过非图片
+            staged.append(stage_upload(uploaded_file.getvalue(), ext))
+
     conn = get_db_connection()
     cur = conn.cursor()
+    image_jobs = []  # [(image_id, staging 路径, 最终路径)]
     try:
         actual_moved_at = moved_at or datetime.utcnow()
         
@@ -601,36 +978,105 @@ def add_death_record(from_pond_id: int, quantity: int, note: str = "", image_fil
         """, (from_pond_id, quantity, note or f"死亡 {quantity} 只", created_by, actual_moved_at))
         movement_id = cur.fetchone()[0]
 
-        # ========== 保存死亡照片（如有）==========
-        if image_files:
-            for uploaded_file in image_files:
-                if uploaded_file is not None:
-                    # 生成唯一文件名
-                    ext = os.path.splitext(uploaded_file.name)[1].lower()
-                    if ext not in ['.png', '.jpg', '.jpeg']:
-                        continue  # 跳过非图片
-                    unique_filename = f"{uuid.uuid4().hex}{ext}"
-                    save_path = os.path.join(DEATH_IMAGE_DIR, unique_filename)
-                    # 保存文件
-                    with open(save_path, "wb") as f:
-                        f.write(uploaded_file.getbuffer())
-                    # 记录到数据库
-                    cur.execute("""
-                        INSERT INTO death_image_shiwa (death_movement_id, image_path)
-                        VALUES (%s, %s);
-                    """, (movement_id, save_path))
+        # ========== 照片记录（状态 pending，由后台线程处理）==========
+        for staged_path, final_path, sha256, size in staged:
+            cur.execute("""
+                INSERT INTO death_image_shiwa
+                (death_movement_id, image_path, status, claimed_at, content_sha256, size_bytes, staged_path)
+                VALUES (%s, %s, %s, NOW(), %s, %s, %s)
+                RETURNING id;
+            """, (movement_id, final_path, STATUS_PROCESSING, sha256, size, staged_path))
+            image_jobs.append((cur.fetchone()[0], staged_path, final_path))
 
         conn.commit()
-        return True, None
     except Exception as e:
         conn.rollback()
+        discard_staged([s[0] for s in staged])
         return False, str(e)
     finally:
         cur.close()
         conn.close()
-def get_recent_death_records(limit=20, offset=0):
+
+    pool = get_image_worker_pool()
+    for job in image_jobs:
+        pool.submit(process_death_image, *job)
+    return True, None
+
+# -----------------------------
+# 死亡照片后台处理
+# -----------------------------
+MAX_IMAGE_ATTEMPTS = 3
+# 认领后超过这么久还没完成（进程崩溃 / 被杀），其他进程可以重新认领
+IMAGE_CLAIM_LEASE_SECONDS = int(os.getenv("SHIWA_IMAGE_LEASE_SECONDS", "600"))
+
+def process_death_image(image_id, staged_path, final_path):
+    """后台线程：生成渲染图并放到正式位置，更新 death_image_shiwa.status"""
+    status, error = STATUS_READY, None
+    try:
+        if os.path.exists(staged_path):
+            finalize_staged(staged_path, final_path)
+        elif not os.path.exists(final_path):
+            raise FileNotFoundError(f"staging 文件丢失：{staged_path}")
+    except Exception as e:
+        status, error = STATUS_FAILED, str(e)
+        print(f"[death-image] 处理照片 #{image_id} 失败：{e}")
     conn = get_db_connection()
     cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE death_image_shiwa
+            SET status = %s, error = %s, attempts = attempts + 1, claimed_at = NULL
+            WHERE id = %s;
+        """, (status, error, image_id))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+def resume_death_image_jobs(pool):
+    """
+    进程启动时认领上次中断（pending / 租约过期的 processing）或失败次数未满的照片。
+    多个进程同时启动时用 SKIP LOCKED 原子认领，同一张照片只会交给一个进程。
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE death_image_shiwa
+        SET status = %(processing)s, claimed_at = NOW()
+        WHERE id IN (
+            SELECT id FROM death_image_shiwa
+            WHERE status = %(pending)s
+               OR (status = %(failed)s AND attempts < %(max_attempts)s)
+               OR (status = %(processing)s AND claimed_at < NOW() - %(lease)s * INTERVAL '1 second')
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, image_path, staged_path;
+    """, {"processing": STATUS_PROCESSING, "pending": STATUS_PENDING, "failed": STATUS_FAILED,
+          "max_attempts": MAX_IMAGE_ATTEMPTS, "lease": IMAGE_CLAIM_LEASE_SECONDS})
+    rows = sorted(cur.fetchall())
+    conn.commit()
+    cur.close()
+    conn.close()
+    for image_id, image_path, staged_path in rows:
+        pool.submit(process_death_image, image_id, staged_path or staged_path_for(image_path), image_path)
+    return len(rows)
+
+@st.cache_resource(show_spinner=False)
+def get_image_worker_pool():
+    """有界线程池（每进程一个），首次创建时恢复未完成的照片任务"""
+    pool = ThreadPoolExecutor(max_workers=int(os.getenv("SHIWA_IMAGE_WORKERS", "2")),
+                              thread_name_prefix="shiwa-image")
+    try:
+        resumed = resume_death_image_jobs(pool)
+        if resumed:
+            print(f"[death-image] 恢复 {resumed} 个未完成的照片任务")
+    except psycopg2.Error as e:
+        print(f"[death-image] 恢复照片任务失败：{e}")
+    return pool
+def get_recent_death_records(limit=20, offset=0):
+    conn = get_db_connection("page")
+    cur = conn.cursor()
     try:
         # 1️⃣ 先查死亡记录（不 JOIN 图片）
         cur.execute("""
@@ -654,16 +1100,17 @@ def get_recent_death_records(limit=20, offset=0):
         image_dict = {}
         if death_ids:
             cur.execute("""
-                SELECT death_movement_id, image_path
+                SELECT death_movement_id, image_path, status, attempts
                 FROM death_image_shiwa
-                WHERE death_movement_id = ANY(%s);
+                WHERE death_movement_id = ANY(%s)
+                ORDER BY id;
             """, (death_ids,))
-            for mid, path in cur.fetchall():
+            for mid, path, status, attempts in cur.fetchall():
                 if mid not in image_dict:
                     image_dict[mid] = []
-                image_dict[mid].append(path)
+                image_dict[mid].append((path, status, attempts))
 
-        # 3️⃣ 合并：每条死亡记录 + 其图片列表
+        # 3️⃣ 合并：每条死亡记录 + 其图片列表 [(路径, 状态)]
         result = []
         for row in death_rows:
             mid = row[0]
@@ -673,6 +1120,34 @@ def get_recent_death_records(limit=20, offset=0):
     finally:
         cur.close()
         conn.close()
+@st.cache_resource(show_spinner=False)
+def get_rendition_cache():
+    """缩略图 / 展示图的进程内 LRU，翻页和重跑不再反复读盘；容量由 SHIWA_THUMB_CACHE_MB 控制"""
+    max_mb = float(os.getenv("SHIWA_THUMB_CACHE_MB", "64"))
+    return RenditionCache(max_bytes=int(max_mb * 1024 * 1024))
+
+def show_death_photo(img_path, caption, key, status=STATUS_READY, attempts=0):
+    """图库里先显示缩略图，点击后才加载展示图，原图只在点下载时读取"""
+    if status in (STATUS_PENDING, STATUS_PROCESSING):
+        st.caption(f"⏳ {caption} 处理中…")
+        return
+    if status == STATUS_FAILED:
+        if attempts >= MAX_IMAGE_ATTEMPTS:
+            st.caption(f"❌ {caption} 处理失败，已重试 {attempts} 次不再自动重试，请重新上传")
+        else:
+            st.caption(f"⚠️ {caption} 处理失败（服务重启后自动重试）")
+        return
+    renditions = get_rendition_cache()
+    thumb = renditions.get(img_path, "thumb")
+    if thumb is None:
+        st.caption(f"{caption} 不存在")
+        return
+    st.image(thumb, caption=caption, width='stretch')
+    if st.toggle("查看大图", key=key):
+        st.image(renditions.get(img_path, "display"), width='stretch')
+        with open(img_path, "rb") as f:
+            st.download_button("📥 下载原图", f.read(), file_name=os.path.basename(img_path),
+                               key=f"{key}_download")
 def get_pond_type_id_by_name(name):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -717,6 +1192,75 @@ def get_customers():
     cur.close(); conn.close()
     return rows
 
+# ---- 选池 / 选客户：按输入在数据库里搜，只取前 K 条（索引见 init_shiwa_db.py 6.1）----
+SEARCH_PICKER_LIMIT = 20
+SALEABLE_POND_TYPES = ["商品蛙池", "三年蛙池", "四年蛙池", "五年蛙池", "六年蛙池", "种蛙池"]
+
+def _like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# pg_trgm 按 3 字切片，更短的输入用不上 GIN，包含匹配只能扫表；这时只做前缀匹配（走 pattern_ops B-tree）
+SEARCH_MIN_CONTAINS_CHARS = 3
+
+def _search_patterns(query):
+    """输入 → (前缀模式, 包含模式)；空输入两个都是 None，输入太短时包含模式为 None"""
+    text = query.strip()
+    if not text:
+        return None, None
+    q = _like_escape(text)
+    return q + "%", ("%" + q + "%" if len(text) >= SEARCH_MIN_CONTAINS_CHARS else None)
+
+def search_ponds(query, pond_types=None, min_count=0, limit=SEARCH_PICKER_LIMIT):
+    """
+    名称包含 query 的池子（query 不足 3 个字时只按前缀），前缀匹配排前面；
+    query 为空时按当前数量从多到少取前 K 个。行：(id, 名称, 池类型, 蛙种, 最大容量, 当前数量)
+    """
+    prefix, contains = _search_patterns(query)
+    name_filter = ("TRUE" if prefix is None else
+                   "p.name LIKE %(prefix)s" if contains is None else "p.name ILIKE %(contains)s")
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT p.id, p.name, pt.name, ft.name, p.max_capacity, p.current_count
+        FROM pond_shiwa p
+        JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+        WHERE p.current_count >= %(min_count)s
+          AND (%(types)s::text[] IS NULL OR pt.name = ANY(%(types)s))
+          AND """ + name_filter + """
+        ORDER BY (%(prefix)s IS NOT NULL AND p.name LIKE %(prefix)s) DESC,
+                 CASE WHEN %(prefix)s IS NULL THEN -p.current_count ELSE 0 END, p.name
+        LIMIT %(limit)s;
+    """, {"prefix": prefix, "contains": contains, "types": list(pond_types) if pond_types else None,
+          "min_count": min_count, "limit": limit})
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+def search_customers(query, limit=SEARCH_PICKER_LIMIT):
+    """
+    姓名包含 query（不足 3 个字时只按前缀）或电话以 query 开头的客户；
+    query 为空时取最近添加的前 K 个。行：(id, name, phone, type)
+    """
+    prefix, contains = _search_patterns(query)
+    name_filter = "name LIKE %(prefix)s" if contains is None else "name ILIKE %(contains)s"
+    where = "TRUE" if prefix is None else f"{name_filter} OR phone LIKE %(prefix)s"
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, name, phone, type
+        FROM customer_shiwa
+        WHERE """ + where + """
+        ORDER BY (%(prefix)s IS NOT NULL AND (name LIKE %(prefix)s OR phone LIKE %(prefix)s)) DESC,
+                 CASE WHEN %(prefix)s IS NULL THEN -id ELSE 0 END, name
+        LIMIT %(limit)s;
+    """, {"prefix": prefix, "contains": contains, "limit": limit})
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
 def add_customer(name, phone, ctype):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -729,40 +1273,109 @@ def add_customer(name, phone, ctype):
     return cid
 
 # ---------- 销售 ----------
-def do_sale(pond_id, customer_id, sale_type, qty_zhi, unit_price_per_zhi, 
-            weight_jin=None, note="", sold_by=None):
+def do_sale_order(customer_id, sale_type, lines, note="", sold_by=None):
+    """
+    一张订单（表头 sale_order_shiwa + 明细 sale_record_shiwa），一个事务：
+    - 扣库存：一条 UPDATE ... FROM (VALUES ...)，只有库存够的池子才会被扣；扣到的行数不等于明细数就整单回滚
+    - 明细、出库流水各一条多行 INSERT
+    - 订单合计由明细汇总写回表头
+    lines：[{"pond_id", "qty_zhi", "unit_price_per_zhi", "weight_jin"}]，同一池塘只能出现一次。
+    返回订单 id；库存不足时抛 ValueError。
+    """
+    if not lines:
+        raise ValueError("订单没有明细")
+    pond_ids = [l["pond_id"] for l in lines]
+    if len(set(pond_ids)) != len(pond_ids):
+        raise ValueError("同一池塘在订单里出现了多次，请合并成一行")
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        # ❌ 不要计算 total_amount，也不要插入它！
         cur.execute("""
-            INSERT INTO sale_record_shiwa 
-            (pond_id, customer_id, sale_type, quantity, unit_price, 
-             weight_jin, note, sold_by)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-        """, (
-            pond_id, customer_id, sale_type, qty_zhi, unit_price_per_zhi,
-            weight_jin, note, sold_by
-        ))
-        # 扣库存
-        cur.execute("UPDATE pond_shiwa SET current_count = current_count - %s WHERE id = %s;",
-                    (qty_zhi, pond_id))
-        # 记录 movement
+            INSERT INTO sale_order_shiwa (customer_id, sale_type, note, sold_by)
+            VALUES (%s, %s, %s, %s) RETURNING id, sold_at;
+        """, (customer_id, sale_type, note, sold_by))
+        order_id, sold_at = cur.fetchone()
+
+        decremented = execute_values(cur, """
+            UPDATE pond_shiwa p
+            SET current_count = p.current_count - v.qty, updated_at = NOW()
+            FROM (VALUES %s) AS v(pond_id, qty)
+            WHERE p.id = v.pond_id AND p.current_count >= v.qty
+            RETURNING p.id;
+        """, [(l["pond_id"], l["qty_zhi"]) for l in lines], template="(%s::int, %s::int)", fetch=True)
+        if len(decremented) != len(lines):
+            short = set(pond_ids) - {r[0] for r in decremented}
+            cur.execute("SELECT name, current_count FROM pond_shiwa WHERE id = ANY(%s) ORDER BY name;", (list(short),))
+            detail = "、".join(f"{name}（现存 {cnt} 只）" for name, cnt in cur.fetchall())
+            raise ValueError(f"库存不足：{detail}")
+
+        # ❌ 不要插入 total_amount（生成列）
+        execute_values(cur, """
+            INSERT INTO sale_record_shiwa
+            (order_id, pond_id, customer_id, sale_type, quantity, unit_price, weight_jin, note, sold_at, sold_by)
+            VALUES %s;
+        """, [(order_id, l["pond_id"], customer_id, sale_type, l["qty_zhi"], l["unit_price_per_zhi"],
+               l.get("weight_jin"), note, sold_at, sold_by) for l in lines])
+        execute_values(cur, """
+            INSERT INTO stock_movement_shiwa (movement_type, from_pond_id, to_pond_id, quantity, description,
+                                              created_by, moved_at)
+            VALUES %s;
+        """, [("sale", l["pond_id"], None, l["qty_zhi"],
+               f"销售：{sale_type} {l.get('weight_jin')} 斤（订单 #{order_id}）", sold_by, sold_at) for l in lines])
         cur.execute("""
-            INSERT INTO stock_movement_shiwa (movement_type, from_pond_id, to_pond_id, quantity, description)
-            VALUES ('sale', %s, NULL, %s, %s);
-        """, (pond_id, qty_zhi, f"销售：{sale_type} {weight_jin} 斤"))
+            UPDATE sale_order_shiwa o
+            SET total_quantity = s.qty, total_weight_jin = s.jin, total_amount = s.amount
+            FROM (SELECT SUM(quantity) AS qty, SUM(weight_jin) AS jin, SUM(total_amount) AS amount
+                  FROM sale_record_shiwa WHERE order_id = %s) s
+            WHERE o.id = %s;
+        """, (order_id, order_id))
         conn.commit()
-    except Exception as e:
+        return order_id
+    except Exception:
         conn.rollback()
         raise
     finally:
         cur.close()
         conn.close()
 
+def do_sale(pond_id, customer_id, sale_type, qty_zhi, unit_price_per_zhi, 
+            weight_jin=None, note="", sold_by=None):
+    """单池销售：一张只有一行明细的订单"""
+    return do_sale_order(customer_id, sale_type, [{
+        "pond_id": pond_id, "qty_zhi": qty_zhi,
+        "unit_price_per_zhi": unit_price_per_zhi, "weight_jin": weight_jin,
+    }], note=note, sold_by=sold_by)
+
+def get_sale_orders_page(page, page_size):
+    """按订单分页：返回 (订单行, 明细行, 订单总数)"""
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM sale_order_shiwa;")
+    total = cur.fetchone()[0]
+    cur.execute("""
+        SELECT o.id, c.name, o.sale_type, o.total_quantity, o.total_weight_jin, o.total_amount,
+               o.sold_by, o.sold_at, o.note
+        FROM sale_order_shiwa o
+        LEFT JOIN customer_shiwa c ON c.id = o.customer_id
+        ORDER BY o.sold_at DESC, o.id DESC
+        LIMIT %s OFFSET %s;
+    """, (page_size, page * page_size))
+    orders = cur.fetchall()
+    cur.execute("""
+        SELECT sr.order_id, p.name, sr.quantity, sr.unit_price, sr.weight_jin, sr.total_amount
+        FROM sale_record_shiwa sr
+        JOIN pond_shiwa p ON p.id = sr.pond_id
+        WHERE sr.order_id = ANY(%s)
+        ORDER BY sr.order_id, sr.id;
+    """, ([o[0] for o in orders],))
+    lines = cur.fetchall()
+    cur.close()
+    conn.close()
+    return orders, lines, total
+
 # ---------- 最近销售 ----------
 def get_recent_sales(limit=20):
-    conn = get_db_connection()
+    conn = get_db_connection("page")
     cur = conn.cursor()
     cur.execute("""
         SELECT sr.id, p.name pond, c.name customer, sr.sale_type, sr.quantity,
@@ -779,8 +1392,8 @@ def get_recent_sales(limit=20):
 # -----------------------------
 # ROI 分析专用函数
 # -----------------------------
-def get_roi_data():
-    conn = get_db_connection()
+def get_roi_data(required_versions=None):
+    conn = get_report_connection(required_versions)
     cur = conn.cursor()
 
     # 获取所有蛙种（确保细皮蛙、粗皮蛙都在）
@@ -789,35 +1402,31 @@ def get_roi_data():
     if not all_frog_types:
         all_frog_types = ["细皮蛙", "粗皮蛙"]  # 安全兜底
 
-    # 1. 喂养成本
+    # 1. 喂养成本（报表物化视图，见 init_shiwa_db.py 的 REPORTING_VIEWS）
     cur.execute("""
-        SELECT ft.name, COALESCE(SUM(fr.total_cost), 0)
-        FROM frog_type_shiwa ft
-        LEFT JOIN pond_shiwa p ON ft.id = p.frog_type_id
-        LEFT JOIN feeding_record_shiwa fr ON p.id = fr.pond_id
-        GROUP BY ft.name;
+        SELECT frog_type, COALESCE(SUM(feed_cost), 0)
+        FROM daily_feed_mv
+        WHERE frog_type IS NOT NULL
+        GROUP BY frog_type;
     """)
     feed_dict = {row[0]: float(row[1]) for row in cur.fetchall()}
 
     # 2. 外购成本（使用 unit_price，若为 NULL 则按 20.0 估算）
     cur.execute("""
-        SELECT ft.name, 
-               COALESCE(SUM(sm.quantity * COALESCE(sm.unit_price, 20.0)), 0) AS total_cost
-        FROM frog_type_shiwa ft
-        LEFT JOIN pond_shiwa p ON ft.id = p.frog_type_id
-        LEFT JOIN stock_movement_shiwa sm 
-            ON p.id = sm.to_pond_id AND sm.movement_type = 'purchase'
-        GROUP BY ft.name;
+        SELECT frog_type,
+               COALESCE(SUM(quantity * COALESCE(unit_price, 20.0)), 0) AS total_cost
+        FROM movements_labeled_mv
+        WHERE movement_type = 'purchase' AND to_pond_id IS NOT NULL AND frog_type IS NOT NULL
+        GROUP BY frog_type;
     """)
     purchase_dict = {row[0]: float(row[1]) for row in cur.fetchall()}
 
     # 3. 销售收入
     cur.execute("""
-        SELECT ft.name, COALESCE(SUM(sr.total_amount), 0)
-        FROM frog_type_shiwa ft
-        LEFT JOIN pond_shiwa p ON ft.id = p.frog_type_id
-        LEFT JOIN sale_record_shiwa sr ON p.id = sr.pond_id
-        GROUP BY ft.name;
+        SELECT frog_type, COALESCE(SUM(total_amount), 0)
+        FROM sales_labeled_mv
+        WHERE frog_type IS NOT NULL
+        GROUP BY frog_type;
     """)
     sales_dict = {row[0]: float(row[1]) for row in cur.fetchall()}
 
@@ -845,9 +1454,9 @@ def get_roi_data():
         })
 
     return result
-def get_pond_roi_details():
+def get_pond_roi_details(required_versions=None):
     """获取每个池塘的喂养、外购、销售明细，用于 ROI 明细分析"""
-    conn = get_db_connection()
+    conn = get_report_connection(required_versions)
     cur = conn.cursor()
 
     # 1. 喂养明细
@@ -936,9 +1545,65 @@ def add_daily_log(pond_id, log_date, water_temp, ph_value, weather,
     conn.commit()
     cur.close(); conn.close()
 
-def get_daily_logs(limit=50):
+DAILY_WEATHER_OPTIONS = ["高温天气", "晴天", "阴天", "小雨", "大雨", "暴雨", "小雪", "大雪", "冰雹"]
+DAILY_WATER_SOURCES = ["山泉水", "地下水"]
+# 批量录入表格的可编辑列（与 daily_log_shiwa 字段一一对应）
+DAILY_LOG_GRID_FIELDS = ["water_temp", "ph_value", "do_value", "humidity", "weather", "water_source", "observation"]
+
+def get_daily_log_grid(pond_type, log_date):
+    """
+    某类型（None 为全部）所有池子在 log_date 的日志；当天还没记录的用前一天的数值预填。
+    行：(pond_id, 池名, 池类型, 当天已记录, *DAILY_LOG_GRID_FIELDS)
+    """
+    fields = ", ".join(f"CASE WHEN t.id IS NULL THEN y.{f} ELSE t.{f} END" for f in DAILY_LOG_GRID_FIELDS)
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT p.id, p.name, pt.name, t.id IS NOT NULL, {fields}
+        FROM pond_shiwa p
+        JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        LEFT JOIN daily_log_shiwa t ON t.pond_id = p.id AND t.log_date = %(d)s
+        LEFT JOIN daily_log_shiwa y ON y.pond_id = p.id AND y.log_date = %(d)s::date - 1
+        WHERE %(pt)s::text IS NULL OR pt.name = %(pt)s
+        ORDER BY pt.name, p.name;
+    """, {"d": log_date, "pt": pond_type})
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+def bulk_upsert_daily_logs(log_date, rows, recorded_by):
+    """rows：[(pond_id, *DAILY_LOG_GRID_FIELDS)]，一条 INSERT ... ON CONFLICT 写入，返回写入行数"""
+    if not rows:
+        return 0
+    cols = ", ".join(DAILY_LOG_GRID_FIELDS)
+    updates = ",\n            ".join(f"{f} = EXCLUDED.{f}" for f in DAILY_LOG_GRID_FIELDS + ["recorded_by"])
     conn = get_db_connection()
     cur = conn.cursor()
+    try:
+        execute_values(cur, f"""
+            INSERT INTO daily_log_shiwa
+            (pond_id, log_date, {cols}, recorded_by, created_at, updated_at)
+            VALUES %s
+            ON CONFLICT (pond_id, log_date)
+            DO UPDATE SET
+            {updates},
+            updated_at = NOW();
+        """, [(r[0], log_date, *r[1:], recorded_by) for r in rows],
+            template=f"(%s, %s, {', '.join(['%s'] * len(DAILY_LOG_GRID_FIELDS))}, %s, NOW(), NOW())",
+            page_size=len(rows))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return len(rows)
+
+def get_daily_logs(limit=50):
+    conn = get_db_connection("page")
+    cur = conn.cursor()
     cur.execute("""
         SELECT dl.log_date,
                p.name,
@@ -957,32 +1622,698 @@ def get_daily_logs(limit=50):
     cur.close()
     conn.close()
     return rows
+
+# -----------------------------
+# 水质趋势 + 异常告警（检测逻辑见 water_quality.py）
+# -----------------------------
+WATER_TREND_MAX_POINTS = 120
+WATER_TREND_SOURCES = ("每日日志", "探头（小时）")
+
+def get_water_quality_trend(pond_id, start, end, source="每日日志", max_points=WATER_TREND_MAX_POINTS,
+                            required_versions=None):
+    """
+    单池水质曲线，降采样在数据库里做：区间内点数超过 max_points 时按 k 天 / k 小时分桶取平均，
+    页面最多画 max_points 个点，与时间跨度无关。
+    返回 (以时间为索引的 DataFrame（列为中文指标名）, 每个点合并的天数 / 小时数)。
+    """
+    if source == "每日日志":
+        k = max(1, -(-((end - start).days + 1) // max_points))
+        metrics = list(WATER_METRIC_LABELS)
+        query = pgsql.SQL("""
+            SELECT %(start)s::date + (log_date - %(start)s::date) / %(k)s * %(k)s AS bucket, {cols}
+            FROM daily_log_shiwa
+            WHERE pond_id = %(pond)s AND log_date BETWEEN %(start)s AND %(end)s
+            GROUP BY bucket
+            ORDER BY bucket;
+        """).format(cols=pgsql.SQL(", ").join(
+            pgsql.SQL("AVG({})").format(pgsql.Identifier(m)) for m in metrics))
+    else:
+        k = max(1, -(-(((end - start).days + 1) * 24) // max_points))
+        # 探头小时汇总按条数加权平均
+        metrics = list(SENSOR_DAILY_LOG_COLUMNS.values())
+        query = pgsql.SQL("""
+            SELECT %(start)s::timestamp
+                   + FLOOR(EXTRACT(EPOCH FROM hour - %(start)s::timestamp) / (3600 * %(k)s)) * %(k)s
+                   * INTERVAL '1 hour' AS bucket, {cols}
+            FROM sensor_hourly_shiwa
+            WHERE pond_id = %(pond)s AND hour >= %(start)s AND hour < %(end)s::date + 1
+            GROUP BY bucket
+            ORDER BY bucket;
+        """).format(cols=pgsql.SQL(", ").join(
+            pgsql.SQL("SUM(avg_value * n) FILTER (WHERE metric = {0}) / NULLIF(SUM(n) FILTER (WHERE metric = {0}), 0)")
+            .format(pgsql.Literal(metric)) for metric in SENSOR_DAILY_LOG_COLUMNS))
+    conn = get_report_connection(required_versions)
+    cur = conn.cursor()
+    cur.execute(query, {"pond": pond_id, "start": start, "end": end, "k": k})
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    df = pd.DataFrame(rows, columns=["时间"] + [WATER_METRIC_LABELS[m] for m in metrics]).set_index("时间")
+    return df.astype(float), k
+
+def get_water_quality_alerts(days=7, limit=50):
+    """最近 days 天未处理的水质异常，按日期、偏离程度排序"""
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT f.id, f.log_date, p.name, pt.name, f.metric, f.method, f.value, f.baseline, f.score
+        FROM water_quality_flag_shiwa f
+        JOIN pond_shiwa p ON f.pond_id = p.id
+        JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        WHERE f.acknowledged_at IS NULL AND f.log_date >= CURRENT_DATE - %s
+        ORDER BY f.log_date DESC, ABS(f.score) DESC
+        LIMIT %s;
+    """, (days, limit))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+def acknowledge_water_quality_flags(flag_ids, username):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE water_quality_flag_shiwa
+        SET acknowledged_by = %s, acknowledged_at = NOW()
+        WHERE id = ANY(%s) AND acknowledged_at IS NULL;
+    """, (username, list(flag_ids)))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+# -----------------------------
+# 饲料库存预测（计算见 feed_forecast.py，页面只读 feed_forecast_shiwa）
+# -----------------------------
+def get_feed_forecast():
+    """每种饲料的库存、EWMA 日用量、可用天数和补货建议，按可用天数从少到多"""
+    conn = get_db_connection("page")
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT ft.name, COALESCE(ft.stock_kg, 0), f.ewma_7, f.ewma_28, f.days_left, ft.lead_time_days,
+               f.reorder_point_kg, f.reorder_by, f.suggested_order_kg
+        FROM feed_forecast_shiwa f
+        JOIN feed_type_shiwa ft ON f.feed_type_id = ft.id
+        ORDER BY f.days_left NULLS LAST, ft.name;
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+def set_feed_lead_time(name, lead_time_days):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("UPDATE feed_type_shiwa SET lead_time_days = %s WHERE name = %s;", (lead_time_days, name))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def get_monthly_feed_cost(required_versions=None):
+    """按月汇总投喂成本"""
+    conn = get_report_connection(required_versions)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT DATE_TRUNC('month', fed_date) AS 月份,
+            SUM(feed_cost)                AS 月总成本
+        FROM daily_feed_mv
+        GROUP BY 月份
+        ORDER BY 月份 DESC;
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+def get_monthly_purchase_summary(required_versions=None):
+    """按月汇总饲料 / 蛙苗采购"""
+    conn = get_report_connection(required_versions)
+    feed_month = pd.read_sql("""
+        SELECT date_trunc('month', purchased_at) AS 月份,
+            SUM(quantity_kg) AS 采购量_kg,
+            SUM(total_amount) AS 采购金额_元
+        FROM feed_purchase_record_shiwa
+        GROUP BY 月份
+        ORDER BY 月份 DESC;
+    """, conn)
+    frog_month = pd.read_sql("""
+        SELECT date_trunc('month', purchased_at) AS 月份,
+            SUM(quantity) AS 采购量_只,
+            SUM(total_amount) AS 采购金额_元
+        FROM frog_purchase_record_shiwa
+        GROUP BY 月份
+        ORDER BY 月份 DESC;
+    """, conn)
+    conn.close()
+    return feed_month, frog_month
+# -----------------------------
+# 数据版本 + 缓存读取
+# -----------------------------
+# 版本号由 init_shiwa_db.py 建立的语句级触发器维护（data_version_shiwa），
+# 每次 rerun 只读一次版本表，版本号作为 st.cache_data 的参数进入缓存键：
+# 数据没变 → 命中缓存；任意会话写入 → 版本 +1 → 所有会话下次 rerun 自动失效
+def get_data_versions():
+    """一次读出所有表的版本号 {table_name: version}"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT table_name, version FROM data_version_shiwa;")
+    versions = {row[0]: row[1] for row in cur.fetchall()}
+    cur.close()
+    conn.close()
+    return versions
+
+def data_version_key(versions, *tables):
+    """取出若干表的版本号组成缓存键"""
+    return tuple(versions.get(t, 0) for t in tables)
+
+POND_OVERVIEW_TABLES = ("pond_shiwa",)
+MONTHLY_FEED_TABLES = ("daily_feed_mv",)
+MONTHLY_PURCHASE_TABLES = ("feed_purchase_record_shiwa", "frog_purchase_record_shiwa")
+ROI_SUMMARY_TABLES = ("daily_feed_mv", "movements_labeled_mv", "sales_labeled_mv")
+ROI_TABLES = ("pond_shiwa", "feeding_record_shiwa", "stock_movement_shiwa",
+              "sale_record_shiwa", "customer_shiwa")
+WATER_QUALITY_TABLES = ("daily_log_shiwa",)
+FEED_FORECAST_TABLES = ("feeding_record_shiwa", "feed_type_shiwa")
+# 预测表本身也带版本号：别的进程刷新完提交后，本进程的缓存跟着失效
+FEED_FORECAST_RESULT_TABLES = FEED_FORECAST_TABLES + ("feed_forecast_shiwa",)
+# 告警同时跟日志版本走：日志变了、检测线程写完告警后都会失效
+WATER_QUALITY_FLAG_TABLES = ("daily_log_shiwa", "water_quality_flag_shiwa")
+
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    """跨进程结果缓存（默认本机 SQLite 文件，见 result_cache.py）"""
+    return build_result_cache()
+
+# 两级缓存：st.cache_data（进程内）→ 结果缓存（同机所有进程共享）→ 数据库
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_pond_page(version_key, frog_types, pond_types, sort_key, page, page_size):
+    return get_pond_page(frog_types, pond_types, sort_key, page, page_size)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def load_pond_summary(version_key, frog_types, pond_types):
+    return get_pond_summary(frog_types, pond_types)
+
+# 报表读副本：把主库版本号传下去，副本没追上就回退主库，避免把旧数据缓存到新版本号下
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_monthly_feed_cost(version_key):
+    required = dict(zip(MONTHLY_FEED_TABLES, version_key))
+    return get_result_cache().get_or_compute(
+        "monthly_feed_cost", version_key, lambda: get_monthly_feed_cost(required))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_monthly_purchase_summary(version_key):
+    required = dict(zip(MONTHLY_PURCHASE_TABLES, version_key))
+    return get_result_cache().get_or_compute(
+        "monthly_purchase_summary", version_key, lambda: get_monthly_purchase_summary(required))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_roi_summary(version_key):
+    required = dict(zip(ROI_SUMMARY_TABLES, version_key))
+    return get_result_cache().get_or_compute(
+        "roi_summary", version_key, lambda: get_roi_data(required))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_pond_roi_details(version_key):
+    required = dict(zip(ROI_TABLES, version_key))
+    return get_result_cache().get_or_compute(
+        "pond_roi_details", version_key, lambda: get_pond_roi_details(required))
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_water_quality_alerts(version_key, days):
+    return get_water_quality_alerts(days)
+
+# 探头小时数据不走版本号，靠 ttl 刷新
+@st.cache_data(show_spinner=False, max_entries=16, ttl=300)
+def load_water_quality_trend(version_key, pond_id, start, end, source):
+    required = dict(zip(WATER_QUALITY_TABLES, version_key))
+    return get_water_quality_trend(pond_id, start, end, source, required_versions=required)
+
+# 喂养 / 库存有写入，或者过了一天（today 进缓存键），刷新一次预测表
+@st.cache_data(show_spinner=False, max_entries=2)
+def refresh_feed_forecast(version_key, today):
+    conn = get_db_connection()
+    try:
+        return refresh_feed_forecast_table(conn, today)
+    finally:
+        conn.close()
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_feed_forecast(version_key, today):
+    return get_feed_forecast()
+
+# -----------------------------
+# 变更通知监听（LISTEN/NOTIFY，跨进程缓存失效）
+# -----------------------------
+# 写入触发器（init_shiwa_db.py）向 CHANGE_CHANNEL 发 {"table": ..., "pond_id": ...}，
+# 每个 Streamlit 进程起一个后台线程监听，收到后清掉相关缓存，并记一个变更序号供会话自动刷新
+CHANGE_CHANNEL = "shiwa_change"
+
+# 表 → 依赖该表的缓存读取函数
+CACHED_LOADERS_BY_TABLE = {}
+for _loader, _tables in ((load_pond_page, POND_OVERVIEW_TABLES),
+                         (load_pond_summary, POND_OVERVIEW_TABLES),
+                         (load_monthly_feed_cost, MONTHLY_FEED_TABLES),
+                         (load_monthly_purchase_summary, MONTHLY_PURCHASE_TABLES),
+                         (load_roi_summary, ROI_SUMMARY_TABLES),
+                         (load_pond_roi_details, ROI_TABLES),
+                         (load_water_quality_alerts, WATER_QUALITY_FLAG_TABLES),
+                         (load_water_quality_trend, WATER_QUALITY_TABLES),
+                         (refresh_feed_forecast, FEED_FORECAST_TABLES),
+                         (load_feed_forecast, FEED_FORECAST_RESULT_TABLES)):
+    for _t in _tables:
+        CACHED_LOADERS_BY_TABLE.setdefault(_t, []).append(_loader)
+
+class ChangeFeed:
+    """进程内共享的变更计数：监听线程写，各会话只读"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.last_change = None  # (table, pond_id)
+        self.stop = threading.Event()
+        self.subscribers = []  # 收到变更后回调 callback(表名集合)，在监听线程里执行
+
+    def record(self, table, pond_id):
+        with self.lock:
+            self.seq += 1
+            self.last_change = (table, pond_id)
+
+def _evict_cached_loaders(tables):
+    for loader in {l for t in tables for l in CACHED_LOADERS_BY_TABLE.get(t, [])}:
+        loader.clear()
+
+def _change_listener_loop(feed: ChangeFeed):
+    """后台线程：LISTEN 循环，断线后 5 秒重连"""
+    while not feed.stop.is_set():
+        conn = None
+        try:
+            conn = get_db_connection()
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {CHANGE_CHANNEL};")
+            while not feed.stop.is_set():
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                touched = set()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        payload = json.loads(notify.payload)
+                    except ValueError:
+                        continue
+                    touched.add(payload.get("table"))
+                    feed.record(payload.get("table"), payload.get("pond_id"))
+                if touched:
+                    _evict_cached_loaders(touched)
+                    for callback in feed.subscribers:
+                        callback(touched)
+        except Exception as e:
+            print(f"[change-listener] 连接中断，5 秒后重连：{e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        feed.stop.wait(5)
+
+@st.cache_resource(show_spinner=False)
+def start_change_listener():
+    """每个进程只启动一次监听线程（SHIWA_CHANGE_LISTENER=0 可关闭）"""
+    feed = ChangeFeed()
+    if os.getenv("SHIWA_CHANGE_LISTENER", "1") != "0":
+        threading.Thread(target=_change_listener_loop, args=(feed,),
+                         name="shiwa-change-listener", daemon=True).start()
+    return feed
+
+# -----------------------------
+# 报表物化视图刷新
+# -----------------------------
+# 视图定义在 init_shiwa_db.py 的 REPORTING_VIEWS；这里记录每个视图依赖哪些表。
+# 相关表有写入（变更通知）→ 攒几秒后 REFRESH ... CONCURRENTLY（不阻塞读），另外每隔一段时间全量刷新一次。
+# 刷新后给视图名的版本号 +1 并发一条变更通知，依赖视图的缓存随之失效。
+# 多个进程里只有拿到 advisory lock 的那个负责刷新。
+REPORTING_VIEW_DEPS = {
+    "daily_feed_mv": ("feeding_record_shiwa", "pond_shiwa", "feed_type_shiwa"),
+    "movements_labeled_mv": ("stock_movement_shiwa", "pond_shiwa"),
+    "sales_labeled_mv": ("sale_record_shiwa", "pond_shiwa", "customer_shiwa"),
+}
+VIEW_REFRESH_SECONDS = int(os.getenv("SHIWA_VIEW_REFRESH_SECONDS", "300"))
+VIEW_REFRESH_DEBOUNCE = float(os.getenv("SHIWA_VIEW_REFRESH_DEBOUNCE", "3"))
+VIEW_REFRESH_LOCK = 0x5368697761  # pg_try_advisory_lock 的键
+
+def refresh_reporting_views(views):
+    conn = get_db_connection()
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    try:
+        for view in views:
+            cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view};")
+            cur.execute("""
+                INSERT INTO data_version_shiwa (table_name, version, updated_at)
+                VALUES (%s, 1, NOW())
+                ON CONFLICT (table_name) DO UPDATE
+                SET version = data_version_shiwa.version + 1, updated_at = NOW();
+            """, (view,))
+            cur.execute("SELECT pg_notify(%s, %s);",
+                        (CHANGE_CHANNEL, json.dumps({"table": view, "pond_id": None})))
+    finally:
+        cur.close()
+        conn.close()
+
+class ViewRefresher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.wake = threading.Event()
+        self.stop = threading.Event()
+
+    def mark_dirty(self, tables):
+        views = {v for v, deps in REPORTING_VIEW_DEPS.items() if set(deps) & set(tables)}
+        if views:
+            with self.lock:
+                self.dirty |= views
+            self.wake.set()
+
+def _view_refresher_loop(refresher: ViewRefresher):
+    """后台线程：等变更（或定时）→ 抢 advisory lock → 刷新视图"""
+    lock_conn = None
+    while not refresher.stop.is_set():
+        woke = refresher.wake.wait(timeout=VIEW_REFRESH_SECONDS)
+        refresher.stop.wait(VIEW_REFRESH_DEBOUNCE if woke else 0)  # 同一批写入只刷新一次
+        refresher.wake.clear()
+        with refresher.lock:
+            views = sorted(refresher.dirty) if woke else sorted(REPORTING_VIEW_DEPS)
+            refresher.dirty.clear()
+        if not views:
+            continue
+        try:
+            if lock_conn is None or lock_conn.closed:
+                lock_conn = get_db_connection()
+                lock_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = lock_conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (VIEW_REFRESH_LOCK,))
+            is_leader = cur.fetchone()[0]
+            cur.close()
+            if is_leader:
+                refresh_reporting_views(views)
+        except psycopg2.Error as e:
+            print(f"[view-refresh] 刷新失败，下次重试：{e}")
+            with refresher.lock:
+                refresher.dirty |= set(views)
+            if lock_conn is not None:
+                lock_conn.close()
+                lock_conn = None
+
+@st.cache_resource(show_spinner=False)
+def start_view_refresher(_feed: ChangeFeed):
+    """每个进程一个刷新线程，挂在变更通知上（SHIWA_VIEW_REFRESH=0 可关闭，改用外部定时任务）"""
+    refresher = ViewRefresher()
+    if os.getenv("SHIWA_VIEW_REFRESH", "1") != "0":
+        _feed.subscribers.append(refresher.mark_dirty)
+        threading.Thread(target=_view_refresher_loop, args=(refresher,),
+                         name="shiwa-view-refresher", daemon=True).start()
+    return refresher
+
+# ---- 水质异常检测：后台线程，不占页面渲染 ----
+# 日志有写入（含探头每 5 分钟的汇总）时防抖后增量检测一次，另外定时跑一次兜住跨天；
+# 检测本身用 advisory 锁，多个进程同时触发时只有一个真正执行
+WATER_QUALITY_DETECT_SECONDS = int(os.getenv("SHIWA_WATER_QUALITY_DETECT_SECONDS", "3600"))
+WATER_QUALITY_DETECT_DEBOUNCE = float(os.getenv("SHIWA_WATER_QUALITY_DETECT_DEBOUNCE", "30"))
+
+def _water_quality_detector_loop(wake: threading.Event, stop: threading.Event):
+    """后台线程：等日志写入（或定时）→ 增量检测 → 写告警表"""
+    while not stop.is_set():
+        if wake.wait(timeout=WATER_QUALITY_DETECT_SECONDS):
+            stop.wait(WATER_QUALITY_DETECT_DEBOUNCE)  # 同一批写入只检测一次
+        wake.clear()
+        conn = None
+        try:
+            conn = get_db_connection()
+            flagged = detect_water_quality(conn)
+            if flagged:
+                print(f"[water-quality] 检测完成：{flagged} 条异常")
+        except Exception as e:  # pd.read_sql 把数据库错误包成 pandas 的 DatabaseError
+            print(f"[water-quality] 检测失败，下次重试：{e}")
+        finally:
+            if conn is not None:
+                conn.close()
+
+@st.cache_resource(show_spinner=False)
+def start_water_quality_detector(_feed: ChangeFeed):
+    """每个进程一个检测线程，挂在变更通知上（SHIWA_WATER_QUALITY_DETECT=0 可关闭，改用 water_quality.py detect）"""
+    wake, stop = threading.Event(), threading.Event()
+    if os.getenv("SHIWA_WATER_QUALITY_DETECT", "1") != "0":
+        _feed.subscribers.append(lambda tables: wake.set() if set(tables) & set(WATER_QUALITY_TABLES) else None)
+        wake.set()  # 启动后先补一次
+        threading.Thread(target=_water_quality_detector_loop, args=(wake, stop),
+                         name="shiwa-water-quality", daemon=True).start()
+    return stop
+
+@st.fragment(run_every=5)
+def change_auto_refresh(feed: ChangeFeed):
+    """其他终端有写入时触发整页 rerun（仅在用户开启自动刷新时挂载）"""
+    seen = st.session_state.get("change_seq_seen", feed.seq)
+    if feed.seq != seen:
+        st.session_state.change_seq_seen = feed.seq
+        table, pond_id = feed.last_change or (None, None)
+        st.toast(f"🔄 数据已更新（{table}{'，池塘 #' + str(pond_id) if pond_id else ''}），页面已刷新")
+        st.rerun(scope="app")
 # ================== ② AI 问答专用函数 ==================
+AI_MODEL = os.getenv("SHIWA_AI_MODEL", "qwen-plus")
+
 def get_ai_client():
-    """统一拿到 DashScope 兼容 OpenAI 客户端"""
+    """统一拿到 DashScope 兼容 OpenAI 客户端；DASHSCOPE_BASE_URL 可指向本地桩服务做离线测试"""
     api_key = os.getenv("DASHSCOPE_API_KEY")
     if not api_key:
         raise RuntimeError("请在 .env 里配置 DASHSCOPE_API_KEY")
     return OpenAI(api_key=api_key,
-                  base_url="https://dashscope.aliyuncs.com/compatible-mode/v1")
+                  base_url=os.getenv("DASHSCOPE_BASE_URL",
+                                     "https://dashscope.aliyuncs.com/compatible-mode/v1"))
+
+AI_SCHEMA_TTL = 6 * 3600  # 表结构很少变，跨进程缓存 6 小时
 
 @st.cache_data(show_spinner=False)
 def get_db_schema_for_ai():
-    """一次性把 schema 抓回来给 AI，只抓表名-列名-类型，不做数据"""
+    """一次性把 schema 抓回来给 AI，只抓表名-列名-类型-注释-外键，不做数据"""
+    return get_result_cache().get_or_compute("ai_schema", "v8", _fetch_db_schema_for_ai, ttl=AI_SCHEMA_TTL)
+
+def _fetch_db_schema_for_ai():
     engine = create_engine(DATABASE_URL)
     inspector = inspect(engine)
     schema = {}
-    for t in inspector.get_table_names():
-        schema[t] = [{"col": c["name"], "type": str(c["type"])}
-                     for c in inspector.get_columns(t)]
+    for t in inspector.get_table_names() + inspector.get_materialized_view_names():
+        schema[t] = {
+            "columns": [{"col": c["name"], "type": str(c["type"]), "comment": c.get("comment")}
+                        for c in inspector.get_columns(t)],
+            "fks": [(fk["constrained_columns"][0], fk["referred_table"], fk["referred_columns"][0])
+                    for fk in inspector.get_foreign_keys(t) if len(fk["constrained_columns"]) == 1],
+        }
     return schema
 
+@st.cache_data(show_spinner=False, max_entries=2)
+def get_schema_digest(schema_hash):
+    """每个 schema 版本只生成一次 DDL 摘要（schema_hash 只用作缓存键）"""
+    schema = get_db_schema_for_ai()
+    digest = build_schema_digest(schema)
+    full_tokens = estimate_tokens(json.dumps(schema, ensure_ascii=False, indent=2))
+    return digest, full_tokens
 
+def build_schema_prompt(question):
+    """按问题挑相关表拼成 schema 提示，并记录比原来整份 JSON 省了多少 token"""
+    schema = get_db_schema_for_ai()
+    digest, full_tokens = get_schema_digest(get_schema_hash())
+    tables = select_tables(question, {t: schema[t] for t in digest})
+    prompt = "\n".join(digest[t] for t in tables)
+    prompt_tokens = estimate_tokens(prompt)
+    print(f"[ai-schema] 选中 {len(tables)}/{len(digest)} 张表，约 {prompt_tokens} tokens"
+          f"（整份 JSON 约 {full_tokens}，节省 {full_tokens - prompt_tokens}）")
+    return prompt
 
-def ai_ask_database(question: str):
-    """两阶段：生成 SQL -> 自然语言回答"""
-    client = get_ai_client()
+
+
+# -----------------------------
+# AI 问答缓存（存在结果缓存里，所有进程共享）
+# -----------------------------
+# ai_sql：   (规范化问题) → SQL，版本 = schema 哈希，表结构变了整体失效
+# ai_answer：(规范化问题, SQL, 相关表版本号) → (回答, 结果)，数据没变时两次 LLM 调用都省掉；
+#            再加 TTL，兜住"本周""今天"这类随时间变化的问题和不带版本号的表
+AI_SQL_NS = "ai_sql"
+AI_ANSWER_NS = "ai_answer"
+AI_ANSWER_TTL = int(os.getenv("SHIWA_AI_ANSWER_TTL", "3600"))
+
+def normalize_question(question: str) -> str:
+    """全角转半角、去空白和句末标点、小写：同一个问题的不同写法落到同一个键"""
+    q = unicodedata.normalize("NFKC", question).lower()
+    q = re.sub(r"\s+", "", q)
+    return q.rstrip("?？。.!！~～")
+
+@st.cache_data(show_spinner=False)
+def get_schema_hash():
     schema = get_db_schema_for_ai()
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def ai_answer_version(sql, versions):
+    """SQL 里出现的表的版本号，任一表有写入 → 缓存的回答失效"""
+    return tuple(sorted((t, v) for t, v in versions.items() if re.search(rf"\b{t}\b", sql)))
+
+def ai_ask_database(question: str, client=None):
+    """
+    两阶段：生成 SQL -> 自然语言回答（两阶段都先查缓存）。
+    SQL 执行完就返回 (回答文本块迭代器, sql, df)：页面先显示 SQL 和行数，再边迭代边显示回答；
+    迭代结束后写缓存并记录各阶段耗时（ai_metrics_shiwa）。
+    client 默认 get_ai_client()，测试时可传入指向本地桩服务的客户端。
+    """
+    timings = {"started": monotonic()}
+    # 常见问题先走模板：不调大模型，离线可用
+    match = match_template(question, load_pond_type_names())
+    if match:
+        return _ai_answer_from_template(question, match, timings)
+
+    client = client or get_ai_client()
+    cache = get_result_cache()
+    schema_hash = get_schema_hash()
+    norm_q = normalize_question(question)
+
+    try:
+        hit, sql = cache.get(AI_SQL_NS, schema_hash, (norm_q,))
+        if hit:
+            answer_args = (norm_q, sql, ai_answer_version(sql, get_data_versions()))
+            hit, cached = cache.get(AI_ANSWER_NS, schema_hash, answer_args)
+            if hit:
+                answer, df = cached
+                record_ai_metrics(question, timings, len(df), cache_hit="answer")
+                return iter([answer]), sql, df
+            cache_hit = "sql"
+        else:
+            cache_hit = None
+            stage_start = monotonic()
+            sql = _ai_generate_sql(question, client)
+            timings["llm1"] = monotonic() - stage_start
+
+        # 版本号在查询前读：查询期间有写入时，结果只会记在旧版本号下，不会冒充新数据
+        answer_args = (norm_q, sql, ai_answer_version(sql, get_data_versions()))
+        stage_start = monotonic()
+        df = run_cancellable(execute_safe_select, sql, label="正在执行查询")
+        timings["sql"] = monotonic() - stage_start
+    except Exception as e:
+        record_ai_metrics(question, timings, None, error=str(e))
+        raise
+    # 能跑通的 SQL 才缓存
+    cache.set(AI_SQL_NS, schema_hash, sql, args=(norm_q,))
+
+    def answer_stream():
+        chunks = []
+        stage_start = monotonic()
+        try:
+            for piece in _ai_answer_stream(question, df, client):
+                if not chunks:
+                    timings["llm2_first"] = monotonic() - stage_start
+                chunks.append(piece)
+                yield piece
+        except Exception as e:
+            record_ai_metrics(question, timings, len(df), cache_hit=cache_hit, error=str(e))
+            raise
+        timings["llm2"] = monotonic() - stage_start
+        answer = "".join(chunks).strip()
+        cache.set(AI_ANSWER_NS, schema_hash, (answer, df), args=answer_args, ttl=AI_ANSWER_TTL)
+        record_ai_metrics(question, timings, len(df), cache_hit=cache_hit)
+
+    return answer_stream(), sql, df
+
+# 每个会话保留最近一次问答的结果，追问（筛选 / 分组 / 排序）直接在内存里算
+AI_LAST_RESULT_MAX_BYTES = int(float(os.getenv("SHIWA_AI_LAST_RESULT_MAX_MB", "5")) * 1024 * 1024)
+
+def remember_ai_result(question, df):
+    """超过大小上限时按比例截掉尾部行"""
+    size = int(df.memory_usage(deep=True).sum())
+    if size > AI_LAST_RESULT_MAX_BYTES:
+        df = df.head(len(df) * AI_LAST_RESULT_MAX_BYTES // size)
+    st.session_state.ai_last_result = {"question": question, "df": df}
+
+def answer_followup_locally(question):
+    """追问能在上一次结果上处理时返回 (回答迭代器, 说明, df)，否则返回 None"""
+    last = st.session_state.get("ai_last_result")
+    if not last:
+        return None
+    timings = {"started": monotonic()}
+    handled = apply_followup(question, last["df"], last["question"])
+    if handled is None:
+        return None
+    df, description = handled
+    record_ai_metrics(question, timings, len(df), cache_hit="followup")
+    return (iter([format_followup_answer(df, description)]),
+            f"-- 基于上一次结果：{last['question']}\n-- {description}", df)
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def load_pond_type_names():
+    return list(get_pond_type_map())
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def load_frog_type_names():
+    return [name for _id, name in get_frog_types()]
+
+def _ai_answer_from_template(question, match, timings):
+    """模板命中：执行预置的参数化 SQL，按模板组织回答"""
+    stage_start = monotonic()
+    conn = get_report_connection(query_class="page")
+    try:
+        df = pd.read_sql(match.sql, conn, params=match.params)
+    except Exception as e:
+        record_ai_metrics(question, timings, None, cache_hit="template", error=str(e))
+        raise
+    finally:
+        conn.close()
+    timings["sql"] = monotonic() - stage_start
+    answer = match.format_answer(df)
+    record_ai_metrics(question, timings, len(df), cache_hit="template")
+    return iter([answer]), f"-- 模板：{match.name}\n{match.sql.strip()}", df
+
+def record_ai_metrics(question, timings, row_count, cache_hit=None, error=None):
+    """写一行各阶段耗时（毫秒）；统计失败不影响问答"""
+    def ms(stage):
+        return round(timings[stage] * 1000) if stage in timings else None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO ai_metrics_shiwa
+            (question, llm1_ms, sql_ms, llm2_first_ms, llm2_ms, total_ms, row_count, cache_hit, error)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+        """, (question, ms("llm1"), ms("sql"), ms("llm2_first"), ms("llm2"),
+              round((monotonic() - timings["started"]) * 1000), row_count, cache_hit, error))
+        conn.commit()
+        cur.close()
+        conn.close()
+    except psycopg2.Error as e:
+        print(f"[ai-metrics] 写入失败，忽略：{e}")
+
+def get_ai_stage_latency(days=7):
+    """最近 N 天各阶段 p50 / p95（毫秒）"""
+    conn = get_report_connection(query_class="page")
+    try:
+        return pd.read_sql("""
+            SELECT stage AS 阶段,
+                   COUNT(ms) AS 次数,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY ms) AS p50,
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY ms) AS p95
+            FROM ai_metrics_shiwa m
+            CROSS JOIN LATERAL (VALUES
+                (1, '生成 SQL', m.llm1_ms), (2, '执行 SQL', m.sql_ms),
+                (3, '回答首字', m.llm2_first_ms), (4, '完整回答', m.llm2_ms), (5, '总耗时', m.total_ms)
+            ) AS s(ord, stage, ms)
+            WHERE m.asked_at >= NOW() - make_interval(days => %s) AND m.error IS NULL
+            GROUP BY s.ord, s.stage
+            ORDER BY s.ord;
+        """, conn, params=(days,))
+    finally:
+        conn.close()
+
+def purge_ai_cache():
+    cache = get_result_cache()
+    cache.purge(AI_SQL_NS)
+    cache.purge(AI_ANSWER_NS)
+
+def _ai_generate_sql(question: str, client):
+    """第一阶段：让模型生成 SQL"""
+    schema_prompt = build_schema_prompt(question)
 
     tools = [{
         "type": "function",
@@ -1001,17 +2332,18 @@ def ai_ask_database(question: str):
     }]
 
     sys_prompt = f"""
-你是石蛙养殖场数据分析师，数据库 schema 如下（仅使用存在的表和字段）：
-{json.dumps(schema, ensure_ascii=False, indent=2)}
+你是石蛙养殖场数据分析师，数据库 schema 如下（PostgreSQL，a->b.c 表示外键；仅使用存在的表和字段）：
+{schema_prompt}
 
 必须调用 execute_sql_query 函数，规则：
 - 只生成 SELECT
+- 优先查询 *_mv 视图（名称已关联好，不用再 JOIN 类型表），视图没有的字段再用原表
 - 表名/字段严格与上面一致
 - 用中文写 explanation
 """
 
     response = client.chat.completions.create(
-        model="qwen-plus",
+        model=AI_MODEL,
         messages=[{"role": "system", "content": sys_prompt},
                   {"role": "user", "content": question}],
         tools=tools,
@@ -1020,19 +2352,22 @@ def ai_ask_database(question: str):
     )
 
     args = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
-    sql = args["sql"]
-    df = execute_safe_select(sql)
+    return args["sql"]
 
-    # 第二阶段：用数据回答用户
-    second = client.chat.completions.create(
-        model="qwen-plus",
+def _ai_answer_stream(question: str, df, client):
+    """第二阶段：用数据回答用户（流式，逐块 yield 文本）"""
+    stream = client.chat.completions.create(
+        model=AI_MODEL,
         messages=[
             {"role": "system", "content": "你是石蛙养殖场场长，用简洁中文直接回答用户问题，不要提 SQL 或技术词汇。"},
             {"role": "user", "content": f"用户问题：{question}\n查询结果：\n{df.head(15).to_string(index=False)}"}
         ],
-        temperature=0.3
+        temperature=0.3,
+        stream=True
     )
-    return second.choices[0].message.content.strip(), sql, df
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
 # =======================================================
 # ----------------------------- ① 池子分组 -----------------------------
 def group_ponds_by_type(pond_dict):
@@ -1056,6 +2391,22 @@ def pond_selector(label, candidate_dict, grouped, key):
                                     format_func=lambda x: next(p[1] for p in grouped[type_pick] if p[0] == x),
                                     key=f"{key}_pond")
         return pid_pick
+
+def search_picker(label, search_fn, format_func, key, fixed_options=()):
+    """
+    搜索框 + 下拉：每次输入只向数据库取前 K 条，页面渲染量与池子 / 客户总数无关。
+    fixed_options：固定放在最前面的 (值, 显示文本)，例如"新建客户"。
+    返回 (选中的值, 选中的行或 None)。
+    """
+    query = st.text_input(f"🔍 搜索{label}", key=f"{key}_query", placeholder="输入名称或电话的一部分…")
+    rows = {r[0]: r for r in page_query(search_fn, query, default=[], label=label)}
+    labels = dict(fixed_options)
+    labels.update({rid: format_func(r) for rid, r in rows.items()})
+    if not labels:
+        return None, None
+    caption = f"（前 {len(rows)} 条匹配）" if len(rows) >= SEARCH_PICKER_LIMIT else ""
+    pick = st.selectbox(f"{label}{caption}", options=list(labels), format_func=labels.get, key=f"{key}_pick")
+    return pick, rows.get(pick)
 def show_login_page():
     st.title("🔐 用户登录 - 中益石蛙基地")
     with st.form("login_form"):
@@ -1063,15 +2414,16 @@ def show_login_page():
         password = st.text_input("密码", type="password")
         submitted = st.form_submit_button("登录")
         if submitted:
-            user = get_user_by_username(username)
-            if user and verify_password(password, user[2]):
+            user, wait = authenticate(username.strip(), password)
+            if wait:
+                st.error(f"❌ 密码错误次数过多，请 {wait} 秒后再试")
+            elif user:
                 st.session_state.logged_in = True
-                st.session_state.user = {
-                    "id": user[0],
-                    "username": user[1],
-                    "department": user[3],
-                    "role": user[4]
-                }
+                st.session_state.user = user
+                # 令牌写进地址栏：断线重连 / 刷新页面后直接恢复登录
+                token = get_session_store().issue(user)
+                st.session_state.session_token = token
+                st.query_params[SESSION_PARAM] = token
                 st.success("登录成功！")
                 st.rerun()
             else:
@@ -1165,17 +2517,30 @@ def run():
         st.session_state.logged_in = False
         st.session_state.user = None
 
-    if not st.session_state.logged_in:
+    if not st.session_state.logged_in and not resume_session():
         show_login_page()
         return
+    renew_session()
 
     # ========== ✅ 登录后主界面 ==========
     st.title("🐸 中益石蛙基地养殖系统")
     st.markdown(f"欢迎，{st.session_state.user['username']}（{st.session_state.user['department']}）")
     if st.button("🚪 退出登录"):
-        st.session_state.logged_in = False
-        st.session_state.user = None
+        end_session()
         st.rerun()
+
+    # ========== 数据版本：每次 rerun 只读一次，供各 Tab 的缓存读取使用 ==========
+    versions = get_data_versions()
+
+    # ========== 变更通知：其他进程/终端写入后自动刷新（可选）==========
+    change_feed = start_change_listener()
+    start_view_refresher(change_feed)
+    start_water_quality_detector(change_feed)
+    # 照片后台线程池：进程首次创建时恢复上次中断的照片任务
+    get_image_worker_pool()
+    st.session_state.change_seq_seen = change_feed.seq
+    if st.toggle("🔄 其他终端有变更时自动刷新", key="auto_refresh_on_change"):
+        change_auto_refresh(change_feed)
     # >>>>>>>>>>>>>>>>>> 在这里插入新函数定义 <<<<<<<<<<<<<<<<<<
     def get_frog_purchase_types_with_qty():
         """获取蛙型 + 数量（含 quantity 字段）"""
@@ -1241,95 +2606,174 @@ def run():
             with st.chat_message("user"):
                 st.write(q)
             with st.chat_message("assistant"):
-                with st.spinner("AI 正在查询数据库..."):
-                    try:
-                        answer, sql, df = ai_ask_database(q)
-                        st.write(answer)
-                        with st.expander("🔍 技术详情（点击展开）"):
-                            st.code(sql, language="sql")
-                            st.dataframe(df.head(20), width='stretch')
-                        st.session_state.ai_chat_history.append((q, answer))
-                    except Exception as e:
-                        st.error(f"查询失败：{e}")
+                try:
+                    followup = answer_followup_locally(q)
+                    if followup:
+                        answer_stream, sql, df = followup
+                    else:
+                        with st.spinner("AI 正在查询数据库..."):
+                            answer_stream, sql, df = ai_ask_database(q)
+                    # 先给出 SQL 和行数，再流式显示回答
+                    with st.expander(f"🔍 技术详情（{len(df)} 行，点击展开）"):
+                        st.code(sql, language="sql")
+                        st.dataframe(df.head(20), width='stretch')
+                        if df.attrs.get("truncated"):
+                            st.caption(f"结果超过 {AI_ROW_CAP} 行，只取回前 {AI_ROW_CAP} 行")
+                    answer = st.write_stream(answer_stream)
+                    st.session_state.ai_chat_history.append((q, answer))
+                    remember_ai_result(q, df)
+                except Exception as e:
+                    st.error(f"查询失败：{e}")
 
         if st.button("🗑️ 清空对话"):
             st.session_state.ai_chat_history.clear()
+            st.session_state.pop("ai_last_result", None)
             st.rerun()
+        if st.session_state.user["department"] == "管理部":
+            with st.expander("🧠 AI 问答缓存"):
+                ai_stats = get_result_cache().stats()
+                for ns, label in ((AI_SQL_NS, "问题→SQL"), (AI_ANSWER_NS, "回答")):
+                    ns_stats = ai_stats.get(ns, {"entries": 0, "bytes": 0, "hits": 0, "misses": 0})
+                    lookups = ns_stats["hits"] + ns_stats["misses"]
+                    hit_rate = ns_stats["hits"] / lookups if lookups else 0
+                    st.caption(f"{label}：{ns_stats['entries']} 条，命中 {ns_stats['hits']} / {lookups}"
+                               f"（{hit_rate:.0%}），{ns_stats['bytes'] / 1024:.1f} KB")
+                st.markdown("**最近 7 天各阶段耗时（毫秒）**")
+                st.dataframe(page_query(get_ai_stage_latency, default=pd.DataFrame(), label="耗时统计"),
+                             hide_index=True, width='stretch')
+                if st.button("🧹 清空 AI 缓存", key="purge_ai_cache"):
+                    purge_ai_cache()
+                    st.toast("✅ AI 缓存已清空")
+                    st.rerun()
+        # ---- 水质异常告警（后台线程检测写入，见 start_water_quality_detector）----
+        alert_days = 7
+        alerts = page_query(load_water_quality_alerts, data_version_key(versions, *WATER_QUALITY_FLAG_TABLES),
+                            alert_days, default=[], label="水质告警")
+        if alerts:
+            with st.expander(f"🚨 水质异常告警（最近 {alert_days} 天 {len(alerts)} 条未处理）", expanded=True):
+                alert_labels = {}
+                for flag_id, log_date, pond_name, pond_type, metric, method, value, baseline, score in alerts:
+                    direction = "偏高" if score > 0 else "偏低"
+                    alert_labels[flag_id] = (f"{log_date} {pond_name}（{pond_type}）{WATER_METRIC_LABELS[metric]}"
+                                             f"{direction}：{float(value):g}，{METHOD_LABELS[method]}"
+                                             f"（基准 {float(baseline or 0):g}，偏离度 {abs(float(score)):.1f}）")
+                for flag_id in list(alert_labels)[:5]:
+                    st.warning(alert_labels[flag_id])
+                if len(alerts) > 5:
+                    st.caption(f"另有 {len(alerts) - 5} 条，可在下方选择处理")
+                ack_ids = st.multiselect("已排查 / 已处理的告警", options=list(alert_labels),
+                                         format_func=alert_labels.get, key="wq_ack_ids")
+                if st.button("✅ 标记已处理", disabled=not ack_ids, key="wq_ack"):
+                    acknowledge_water_quality_flags(ack_ids, st.session_state.user["username"])
+                    st.toast(f"✅ 已处理 {len(ack_ids)} 条水质告警")
+                    st.rerun()
+
         # =======================================================
         st.subheader("📊 所有池塘状态")
-        ponds = get_all_ponds()
-        
-        if not ponds:
+        pond_version = data_version_key(versions, *POND_OVERVIEW_TABLES)
+
+        # 可选：筛选器（全选时不下推条件）
+        all_frog_types = load_frog_type_names()
+        all_pond_types = load_pond_type_names()
+        col1, col2, col3 = st.columns([2, 2, 1])
+        with col1:
+            frog_filter = st.multiselect("按蛙种筛选", options=all_frog_types, default=all_frog_types)
+        with col2:
+            type_filter = st.multiselect("按池类型筛选", options=all_pond_types, default=all_pond_types)
+        with col3:
+            sort_key = st.selectbox("排序", list(POND_SORT_OPTIONS), key="pond_overview_sort")
+        frog_sel = None if set(frog_filter) == set(all_frog_types) else tuple(sorted(frog_filter))
+        type_sel = None if set(type_filter) == set(all_pond_types) else tuple(sorted(type_filter))
+
+        summary_rows = page_query(load_pond_summary, pond_version, frog_sel, type_sel,
+                                  default=None, label="池塘汇总")
+        summary = pd.DataFrame(
+            summary_rows or [],
+            columns=["池类型", "蛙种", "层级", "池数", "总容量", "当前数量", "占用率 (%)"]
+        )
+        total = summary[summary["层级"] == "合计"].iloc[0] if summary_rows else None
+
+        if total is None:
+            pass  # 汇总查询超时，page_query 已提示
+        elif total["池数"] == 0 and frog_sel is None and type_sel is None:
             st.warning("暂无池塘。请在「池塘创建」Tab 中添加，或点击「一键初始化示例数据」。")
+        elif total["池数"] == 0:
+            st.info("没有匹配的池塘。")
         else:
-            # 转为 DataFrame 便于展示和绘图
-            df = pd.DataFrame(
-                ponds,
-                columns=["ID", "名称", "池类型", "蛙种", "最大容量", "当前数量"]
-            )
-            df["占用率 (%)"] = (df["当前数量"] / df["最大容量"] * 100).round(1)
-            df["占用率 (%)"] = df["占用率 (%)"].clip(upper=100)  # 防止超容显示 >100
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("池塘数", f"{total['池数']:,}")
+            m2.metric("总容量", f"{total['总容量']:,}")
+            m3.metric("当前数量", f"{total['当前数量']:,}")
+            m4.metric("占用率", f"{total['占用率 (%)'] or 0:.1f}%")
 
-            # 可选：筛选器
-            col1, col2 = st.columns(2)
-            with col1:
-                frog_filter = st.multiselect(
-                    "按蛙种筛选",
-                    options=df["蛙种"].unique(),
-                    default=df["蛙种"].unique()
-                )
-            with col2:
-                type_filter = st.multiselect(
-                    "按池类型筛选",
-                    options=df["池类型"].unique(),
-                    default=df["池类型"].unique()
-                )
+            # ---- 池塘总览分页（LIMIT / OFFSET 在数据库里做）----
+            page_size = 20
+            # 筛选或排序变了回到第一页
+            filter_sig = (frog_sel, type_sel, sort_key)
+            if st.session_state.get("pond_overview_filter") != filter_sig:
+                st.session_state.pond_overview_filter = filter_sig
+                st.session_state.pond_overview_page = 0
 
-            # 应用筛选
-            filtered_df = df[
-                (df["蛙种"].isin(frog_filter)) &
-                (df["池类型"].isin(type_filter))
-            ].copy()
+            total_rows = int(total["池数"])
+            total_pages = (total_rows + page_size - 1) // page_size
+            current_page = max(0, min(st.session_state.pond_overview_page, total_pages - 1))  # 防越界
 
-            if filtered_df.empty:
-                st.info("没有匹配的池塘。")
-            else:
-                # ---- 池塘总览分页 ----
-                page_size = 20
-                if "pond_overview_page" not in st.session_state:
-                    st.session_state.pond_overview_page = 0
-
-                total_rows = len(filtered_df)
-                total_pages = (total_rows + page_size - 1) // page_size
-                current_page = st.session_state.pond_overview_page
-                current_page = max(0, min(current_page, total_pages - 1))  # 防越界
-
-                col_prev, col_next, col_info = st.columns([1, 1, 3])
-                with col_prev:
-                    if st.button("⬅️ 上一页", disabled=(current_page == 0), key="pond_overview_prev"):
-                        st.session_state.pond_overview_page -= 1
-                        st.rerun()
-                with col_next:
-                    if st.button("下一页 ➡️", disabled=(current_page >= total_pages - 1), key="pond_overview_next"):
-                        st.session_state.pond_overview_page += 1
-                        st.rerun()
-                with col_info:
-                    st.caption(f"第 {current_page + 1} 页 / 共 {total_pages} 页（每页 {page_size} 条）")
+            col_prev, col_next, col_info = st.columns([1, 1, 3])
+            with col_prev:
+                if st.button("⬅️ 上一页", disabled=(current_page == 0), key="pond_overview_prev"):
+                    st.session_state.pond_overview_page = current_page - 1
+                    st.rerun()
+            with col_next:
+                if st.button("下一页 ➡️", disabled=(current_page >= total_pages - 1), key="pond_overview_next"):
+                    st.session_state.pond_overview_page = current_page + 1
+                    st.rerun()
+            with col_info:
+                st.caption(f"第 {current_page + 1} 页 / 共 {total_pages} 页（每页 {page_size} 条，共 {total_rows} 个池塘）")
 
-                start_idx = current_page * page_size
-                end_idx = start_idx + page_size
-                page_df = filtered_df.iloc[start_idx:end_idx]
+            page_rows, _ = page_query(load_pond_page, pond_version, frog_sel, type_sel, sort_key, current_page,
+                                      page_size, default=([], 0), label="池塘列表")
+            page_df = pd.DataFrame(
+                page_rows,
+                columns=["ID", "名称", "池类型", "蛙种", "最大容量", "当前数量", "占用率 (%)"]
+            )
+            st.dataframe(
+                page_df[["名称", "池类型", "蛙种", "当前数量", "最大容量", "占用率 (%)"]],
+                width='stretch',
+                hide_index=True
+            )
 
-                st.dataframe(
-                    page_df[["名称", "池类型", "蛙种", "当前数量", "最大容量", "占用率 (%)"]],
-                    width='stretch',
-                    hide_index=True
-                )
+            with st.expander("📋 分类汇总（池类型 / 蛙种）"):
+                st.dataframe(summary[summary["层级"] != "合计"], width='stretch', hide_index=True)
 
-                # === 图表展示 ===
-                st.markdown("### 📈 池塘容量占用率")
-                chart_data = filtered_df.set_index("名称")["占用率 (%)"]
-                st.bar_chart(chart_data, height=400)
+            # === 图表展示：汇总 / 前 N 个，汇总可下钻到某一类的池子 ===
+            st.markdown("### 📈 池塘容量占用率")
+            chart_mode = st.radio(
+                "图表", ["按池类型汇总", "按蛙种汇总", "占用率最高", "占用率最低"],
+                horizontal=True, key="pond_chart_mode", label_visibility="collapsed"
+            )
+            top_n = st.slider("显示池塘数", 5, 50, 20, step=5, key="pond_chart_top_n")
+            if chart_mode in ("按池类型汇总", "按蛙种汇总"):
+                group_col = "池类型" if chart_mode == "按池类型汇总" else "蛙种"
+                groups = summary[summary["层级"] == group_col].set_index(group_col)
+                st.bar_chart(groups["占用率 (%)"].astype(float), height=300)
+                drill = st.selectbox(f"下钻查看某个{group_col}里占用率最高的池子",
+                                     ["（不下钻）"] + list(groups.index), key=f"pond_drill_{group_col}")
+                if drill != "（不下钻）":
+                    drill_frog = (drill,) if group_col == "蛙种" else frog_sel
+                    drill_type = (drill,) if group_col == "池类型" else type_sel
+                    drill_rows, drill_total = page_query(load_pond_page, pond_version, drill_frog, drill_type,
+                                                         "占用率从高到低", 0, top_n, default=([], 0), label="下钻")
+                    st.caption(f"{drill}：共 {drill_total} 个池子，显示占用率最高的 {len(drill_rows)} 个")
+                    st.bar_chart(pd.Series([float(r[6] or 0) for r in drill_rows],
+                                           index=[r[1] for r in drill_rows], name="占用率 (%)"),
+                                 height=400)
+            else:
+                order = "占用率从高到低" if chart_mode == "占用率最高" else "占用率从低到高"
+                top_rows, _ = page_query(load_pond_page, pond_version, frog_sel, type_sel, order, 0, top_n,
+                                         default=([], 0), label="图表")
+                st.bar_chart(pd.Series([float(r[6] or 0) for r in top_rows],
+                                       index=[r[1] for r in top_rows], name="占用率 (%)"),
+                             height=400)
 
 
     # ===================== ① 标准库导入（放在文件顶部即可） =====================
@@ -1340,7 +2784,7 @@ def run():
     # ===================== ② Tab2  喂养记录（录入 + 总览） =====================
     with tab2:
         # ---- 0. 基础数据（只拉一次） ----
-        all_ponds   = get_all_ponds()
+        all_ponds   = page_query(get_all_ponds, default=[], label="池塘")
         pond_types  = get_pond_types()
         feed_types  = get_feed_types()
         type_2_ponds = defaultdict(list)
@@ -1501,19 +2945,15 @@ def run():
             # ================= 月度投喂成本 =================
             st.markdown("---")
             st.subheader("📊 月度投喂总成本")
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT DATE_TRUNC('month', fr.fed_at) AS 月份,
-                    SUM(fr.total_cost)            AS 月总成本
-                FROM feeding_record_shiwa fr
-                GROUP BY 月份
-                ORDER BY 月份 DESC;
-            """)
-            month_rows = cur.fetchall()
-            cur.close()
-            conn.close()
-            if not month_rows:
+            try:
+                month_rows = run_cancellable(load_monthly_feed_cost,
+                                             data_version_key(versions, *MONTHLY_FEED_TABLES),
+                                             label="月度成本统计中")
+            except ReportNotReady:
+                month_rows = None
+            if month_rows is None:
+                show_report_pending("月度投喂成本", "monthly_feed_retry")
+            elif not month_rows:
                 st.info("暂无投喂记录")
             else:
                 df_month = pd.DataFrame(month_rows,
@@ -1530,60 +2970,122 @@ def run():
 
         # ================ 养殖日志（每日记录） ================
         with st.expander("📝 每日养殖日志（水温 / pH / 光照 / 溶氧 / 湿度等）", expanded=False):
-            # 池子联动：类型选在外部，保证切换时页面不卡
-            if "log_pt_sel" not in st.session_state:
-                st.session_state.log_pt_sel = pond_types[0][1]
-            log_pt_sel = st.selectbox("① 池塘类型",
-                                    options=[pt[1] for pt in pond_types],
-                                    key="log_pt_sel")
-            log_ponds_of_type = type_2_ponds.get(log_pt_sel, [])
-            with st.form("daily_log_form"):
-                if not log_ponds_of_type:
-                    st.warning(f"暂无【{log_pt_sel}】类型的池塘")
-                    st.form_submit_button("✅ 保存每日日志", disabled=True)
+            log_mode = st.radio("录入方式", ["📋 批量表格录入", "✏️ 逐池录入"], horizontal=True, key="daily_log_mode")
+            if log_mode == "📋 批量表格录入":
+                g1, g2 = st.columns(2)
+                with g1:
+                    grid_pt = st.selectbox("池塘类型", ["全部"] + [pt[1] for pt in pond_types], key="log_grid_pt")
+                with g2:
+                    grid_date = st.date_input("日期", value=datetime.today(), key="log_grid_date")
+                grid_rows = page_query(get_daily_log_grid, None if grid_pt == "全部" else grid_pt, grid_date,
+                                       default=[], label="日志表格")
+                if not grid_rows:
+                    st.warning(f"暂无【{grid_pt}】类型的池塘")
                 else:
-                    # ② 单选池子（同类型内选择）
-                    log_pond_dict = {p["id"]: f"{p['name']}  （当前 {p['current']} 只）" for p in log_ponds_of_type}
-                    pond_id = st.selectbox("② 具体池子",
-                                        options=list(log_pond_dict.keys()),
-                                        format_func=lambda x: log_pond_dict.get(x, f"未知池({x})"))
-                    # ③ 日期
-                    log_date = st.date_input("③ 日期", value=datetime.today())
-                    # ④ 环境四件套：水温、 pH 、溶氧、湿度
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        water_temp = st.number_input("水温 (℃)", min_value=0.0, max_value=50.0, step=0.1, value=22.0)
-                        ph_value = st.number_input("pH 值", min_value=0.0, max_value=14.0, step=0.1, value=7.0)
-                    with col2:
-                        do_value = st.number_input("溶氧量 (mg/L)", min_value=0.0, step=0.1, value=5.0)
-                        humidity = st.number_input("湿度 (%)", min_value=0.0, max_value=100.0, step=1.0, value=70.0)
-                    # ---- 天气选择（原光照）----
-                    weather_opts = ["高温天气", "晴天", "阴天", "小雨", "大雨", "暴雨", "小雪", "大雪", "冰雹"]
-                    weather = st.selectbox("当日天气", weather_opts, index=1)
-                    # ---- 水源选择----
-                    water_source = st.selectbox("水来源", ["山泉水", "地下水"])
-                    # ⑥ 观察记录
-                    quick_observe = st.selectbox("快捷观察", COMMON_REMARKS["每日观察"])
-                    observation = st.text_area("观察记录（可记录卵块、行为、异常等）",
-                                            value=quick_observe, height=120)
-                    # ⑦ 提交
-                    submitted = st.form_submit_button("✅ 保存每日日志", type="primary")
-                    if submitted:
-                        current_user = st.session_state.user['username']
-                        add_daily_log(
-                            pond_id     = pond_id,
-                            log_date    = log_date,
-                            water_temp  = water_temp,
-                            ph_value    = ph_value,
-                            weather     = weather,
-                            observation = observation.strip(),
-                            do_value    = do_value,
-                            humidity    = humidity,
-                            water_source= water_source,
-                            recorded_by = current_user
-                        )
-                        st.success("✅ 每日日志已保存！")
-                        st.rerun()
+                    grid_cols = ["pond_id", "池塘", "池类型", "已记录"] + DAILY_LOG_GRID_FIELDS
+                    base_df = pd.DataFrame(grid_rows, columns=grid_cols).set_index("pond_id")
+                    for f in ("water_temp", "ph_value", "do_value", "humidity"):
+                        base_df[f] = base_df[f].astype(float)
+                    st.caption(f"共 {len(base_df)} 个池子，当天已记录 {int(base_df['已记录'].sum())} 个；"
+                               "未记录的池子已用前一天的数值预填，只保存改动过的行。")
+                    edited_df = st.data_editor(
+                        base_df,
+                        column_config={
+                            "池塘": st.column_config.TextColumn(disabled=True),
+                            "池类型": st.column_config.TextColumn(disabled=True),
+                            "已记录": st.column_config.CheckboxColumn(disabled=True),
+                            "water_temp": st.column_config.NumberColumn("水温 (℃)", min_value=0.0, max_value=50.0, step=0.1),
+                            "ph_value": st.column_config.NumberColumn("pH 值", min_value=0.0, max_value=14.0, step=0.1),
+                            "do_value": st.column_config.NumberColumn("溶氧量 (mg/L)", min_value=0.0, step=0.1),
+                            "humidity": st.column_config.NumberColumn("湿度 (%)", min_value=0.0, max_value=100.0, step=1.0),
+                            "weather": st.column_config.SelectboxColumn("当日天气", options=DAILY_WEATHER_OPTIONS),
+                            "water_source": st.column_config.SelectboxColumn("水来源", options=DAILY_WATER_SOURCES),
+                            "observation": st.column_config.TextColumn("观察记录"),
+                        },
+                        hide_index=True,
+                        width='stretch',
+                        num_rows="fixed",
+                        # 日期 / 类型 / 保存次数变了就换一个编辑器，丢掉旧的编辑状态
+                        key=f"log_grid_{grid_pt}_{grid_date}_{st.session_state.get('log_grid_rev', 0)}",
+                    )
+                    include_prefilled = st.checkbox("当天还没记录、也没改动的池子，按预填数值一并保存",
+                                                    key="log_grid_include_prefilled")
+                    # 只发改动过的行（NaN 与 NaN 视为相同）
+                    before = base_df[DAILY_LOG_GRID_FIELDS].astype(object).where(base_df[DAILY_LOG_GRID_FIELDS].notna(), None)
+                    after = edited_df[DAILY_LOG_GRID_FIELDS].astype(object).where(edited_df[DAILY_LOG_GRID_FIELDS].notna(), None)
+                    changed = (~((before == after) | (before.isna() & after.isna()))).any(axis=1)
+                    if include_prefilled:
+                        changed |= ~base_df["已记录"]
+                    # 全部字段为空的行不写，免得留下空日志被当成"已记录"
+                    to_save = after[changed & after.notna().any(axis=1)]
+                    if st.button(f"✅ 保存 {len(to_save)} 个池子的日志", type="primary",
+                                 disabled=to_save.empty, key="log_grid_save"):
+                        try:
+                            saved = bulk_upsert_daily_logs(
+                                grid_date,
+                                [(int(pid), *row) for pid, row in zip(to_save.index, to_save.itertuples(index=False))],
+                                st.session_state.user['username']
+                            )
+                        except psycopg2.Error as e:
+                            st.error(f"保存失败：{e}")
+                        else:
+                            st.session_state.log_grid_rev = st.session_state.get("log_grid_rev", 0) + 1
+                            st.toast(f"✅ 已保存 {saved} 个池子的日志")
+                            st.rerun()
+            else:
+                # 池子联动：类型选在外部，保证切换时页面不卡
+                if "log_pt_sel" not in st.session_state:
+                    st.session_state.log_pt_sel = pond_types[0][1]
+                log_pt_sel = st.selectbox("① 池塘类型",
+                                        options=[pt[1] for pt in pond_types],
+                                        key="log_pt_sel")
+                log_ponds_of_type = type_2_ponds.get(log_pt_sel, [])
+                with st.form("daily_log_form"):
+                    if not log_ponds_of_type:
+                        st.warning(f"暂无【{log_pt_sel}】类型的池塘")
+                        st.form_submit_button("✅ 保存每日日志", disabled=True)
+                    else:
+                        # ② 单选池子（同类型内选择）
+                        log_pond_dict = {p["id"]: f"{p['name']}  （当前 {p['current']} 只）" for p in log_ponds_of_type}
+                        pond_id = st.selectbox("② 具体池子",
+                                            options=list(log_pond_dict.keys()),
+                                            format_func=lambda x: log_pond_dict.get(x, f"未知池({x})"))
+                        # ③ 日期
+                        log_date = st.date_input("③ 日期", value=datetime.today())
+                        # ④ 环境四件套：水温、 pH 、溶氧、湿度
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            water_temp = st.number_input("水温 (℃)", min_value=0.0, max_value=50.0, step=0.1, value=22.0)
+                            ph_value = st.number_input("pH 值", min_value=0.0, max_value=14.0, step=0.1, value=7.0)
+                        with col2:
+                            do_value = st.number_input("溶氧量 (mg/L)", min_value=0.0, step=0.1, value=5.0)
+                            humidity = st.number_input("湿度 (%)", min_value=0.0, max_value=100.0, step=1.0, value=70.0)
+                        # ---- 天气选择（原光照）----
+                        weather = st.selectbox("当日天气", DAILY_WEATHER_OPTIONS, index=1)
+                        # ---- 水源选择----
+                        water_source = st.selectbox("水来源", DAILY_WATER_SOURCES)
+                        # ⑥ 观察记录
+                        quick_observe = st.selectbox("快捷观察", COMMON_REMARKS["每日观察"])
+                        observation = st.text_area("观察记录（可记录卵块、行为、异常等）",
+                                                value=quick_observe, height=120)
+                        # ⑦ 提交
+                        submitted = st.form_submit_button("✅ 保存每日日志", type="primary")
+                        if submitted:
+                            current_user = st.session_state.user['username']
+                            add_daily_log(
+                                pond_id     = pond_id,
+                                log_date    = log_date,
+                                water_temp  = water_temp,
+                                ph_value    = ph_value,
+                                weather     = weather,
+                                observation = observation.strip(),
+                                do_value    = do_value,
+                                humidity    = humidity,
+                                water_source= water_source,
+                                recorded_by = current_user
+                            )
+                            st.success("✅ 每日日志已保存！")
+                            st.rerun()
 
             # ---- 历史日志列表（带分页）----
             st.markdown("### 📖 历史每日日志")
@@ -1654,6 +3156,32 @@ def run():
                     st.warning("没有更多数据了")
                     st.session_state.daily_log_page -= 1
 
+            # ---- 单池水质趋势（降采样在数据库里做）----
+            st.markdown("### 📈 单池水质趋势")
+            trend_pond, _ = search_picker("池塘", search_ponds, lambda r: f"{r[1]}（{r[2]}）", key="wq_trend_pond")
+            if trend_pond is not None:
+                trend_col1, trend_col2 = st.columns([2, 1])
+                with trend_col1:
+                    today = datetime.today().date()
+                    trend_range = st.date_input("时间范围", value=(today - timedelta(days=90), today),
+                                                key="wq_trend_range")
+                with trend_col2:
+                    trend_source = st.radio("数据来源", WATER_TREND_SOURCES, horizontal=True, key="wq_trend_source")
+                if len(trend_range) == 2:
+                    trend, bucket = load_water_quality_trend(data_version_key(versions, *WATER_QUALITY_TABLES),
+                                                     trend_pond, trend_range[0], trend_range[1], trend_source)
+                    if trend.dropna(how="all").empty:
+                        st.info("该时间段没有水质数据")
+                    else:
+                        unit = "天" if trend_source == "每日日志" else "小时"
+                        st.caption(f"共 {len(trend)} 个点，每点为 {bucket} {unit}的平均值")
+                        trend_metrics = st.multiselect("指标", list(trend.columns), default=list(trend.columns),
+                                                       key="wq_trend_metrics")
+                        # 各指标量纲不同，分开画
+                        for metric_name in trend_metrics:
+                            st.markdown(f"**{metric_name}**")
+                            st.line_chart(trend[metric_name].dropna(), height=180)
+
         with tab3:
                     # ========== 创建新池塘（放入 expander）==========
             with st.expander("➕ 创建新池塘", expanded=False):  # 默认展开，方便操作
@@ -1708,7 +3236,7 @@ def run():
             with st.expander("🔍 查看已建池塘", expanded=False):
                 # ========== 已创建的池塘 ==========
                 st.markdown("### 📋 已创建的池塘")
-                ponds_now = get_all_ponds()
+                ponds_now = page_query(get_all_ponds, default=[], label="池塘")
                 if not ponds_now:
                     st.info("暂无池塘，快去创建第一个吧！")
                 else:
@@ -1724,7 +3252,7 @@ def run():
                 # ========== 变更池塘用途（仅当数量为 0）==========
                 st.markdown("### 🔄 变更池塘用途（仅当数量为 0 时可用）")
                 st.caption("适用于：已完成养殖周期的空池，重新赋予新用途")
-                empty_ponds = [p for p in get_all_ponds() if p[5] == 0]
+                empty_ponds = [p for p in page_query(get_all_ponds, default=[], label="池塘") if p[5] == 0]
                 if not empty_ponds:
                     st.info("暂无空池，无法变更用途")
                 else:
@@ -1796,7 +3324,7 @@ def run():
                 # ========== 修正创建错误（仅限从未使用过的池塘）==========
                 st.markdown("### ✏️ 修正创建错误（仅限从未使用过的池塘）")
                 st.caption("适用于：刚创建但未进行任何操作的池塘，可修改全部字段")
-                all_ponds = get_all_ponds()
+                all_ponds = page_query(get_all_ponds, default=[], label="池塘")
                 unused_ponds = [p for p in all_ponds if is_pond_unused(p[0])]
                 if not unused_ponds:
                     st.info("暂无符合条件的池塘（需从未参与任何操作）")
@@ -1936,7 +3464,7 @@ def run():
         with st.expander("🔄 转池 / 外购 / 孵化 / 死亡操作", expanded=False):
             operation = st.radio("操作类型", ["转池", "外购", "孵化", "死亡"],
                                 horizontal=True, key="tab4_op_radio")
-            ponds = get_all_ponds()
+            ponds = page_query(get_all_ponds, default=[], label="池塘")
             if not ponds:
                 st.warning("请先创建至少一个池塘！")
                 st.stop()
@@ -2269,7 +3797,8 @@ def run():
             with col_info_d:
                 st.caption(f"第 {current_page_d + 1} 页（每页 {page_size_death} 条）")
             offset_d = current_page_d * page_size_death
-            death_records = get_recent_death_records(limit=page_size_death, offset=offset_d)
+            death_records = page_query(get_recent_death_records, limit=page_size_death, offset=offset_d,
+                                       default=[], label="死亡记录")
             if death_records:
                 for record in death_records:
                     mid, pond, qty, desc, moved_at, operator, img_paths = record
@@ -2280,13 +3809,10 @@ def run():
                             cols_per_row = 3
                             for i in range(0, len(img_paths), cols_per_row):
                                 cols = st.columns(cols_per_row)
-                                for j, img_path in enumerate(img_paths[i:i+cols_per_row]):
-                                    if os.path.exists(img_path):
-                                        with cols[j]:
-                                            st.image(img_path, caption=f"照片 {i+j+1}", width='stretch')
-                                    else:
-                                        with cols[j]:
-                                            st.caption(f"照片 {i+j+1} 不存在")
+                                for j, (img_path, img_status, img_attempts) in enumerate(img_paths[i:i+cols_per_row]):
+                                    with cols[j]:
+                                        show_death_photo(img_path, f"照片 {i+j+1}", key=f"death_img_{mid}_{i+j}",
+                                                         status=img_status, attempts=img_attempts)
                         else:
                             st.caption("🖼️ 无照片")
                 if len(death_records) == page_size_death:
@@ -2299,6 +3825,29 @@ def run():
                 else:
                     st.warning("没有更多数据了")
                     st.session_state.death_page -= 1
+
+            with st.expander("🗄️ 照片存储统计（按月）"):
+                conn = get_report_connection(query_class="page")
+                try:
+                    usage = storage_usage_by_month(conn)
+                finally:
+                    conn.close()
+                if usage:
+                    df_usage = pd.DataFrame(usage, columns=["月份", "照片数", "引用字节", "实际存储字节"])
+                    df_usage["引用占用(MB)"] = (df_usage["引用字节"] / 1024 / 1024).round(2)
+                    df_usage["实际存储(MB)"] = (df_usage["实际存储字节"] / 1024 / 1024).round(2)
+                    st.dataframe(df_usage[["月份", "照片数", "引用占用(MB)", "实际存储(MB)"]],
+                                 width='stretch', hide_index=True)
+                    st.caption("相同照片只存一份；无引用文件由 `python death_image_store.py gc` 清理")
+                else:
+                    st.caption("暂无照片")
+                cache_stats = get_rendition_cache().stats()
+                st.caption(
+                    f"缩略图内存缓存：命中率 {cache_stats['hit_rate']:.0%}"
+                    f"（{cache_stats['hits']} / {cache_stats['hits'] + cache_stats['misses']}），"
+                    f"{cache_stats['entries']} 张，"
+                    f"{cache_stats['bytes'] / 1024 / 1024:.1f} / {cache_stats['max_bytes'] / 1024 / 1024:.0f} MB"
+                )
                     
     with tab5:
         current_user = st.session_state.user["username"]
@@ -2414,6 +3963,43 @@ def run():
             finally:
                 cur.close(); conn.close()
 
+        # ==================== 0. 饲料库存预测 / 补货建议 ====================
+        today = datetime.today().date()
+        feed_forecast_version = data_version_key(versions, *FEED_FORECAST_TABLES)
+        try:
+            refresh_feed_forecast(feed_forecast_version, today)
+        except Exception as e:  # 预测只是辅助信息，算不出来也不能挡住采购页
+            print(f"[feed-forecast] 刷新失败，显示上次结果：{e}")
+        feed_forecast = page_query(load_feed_forecast, data_version_key(versions, *FEED_FORECAST_RESULT_TABLES),
+                                   today, default=[], label="饲料预测")
+        to_reorder = [r for r in feed_forecast if r[8] and r[8] > 0]
+        for name, stock, _, _, days_left, lead_time, _, _, suggested in to_reorder:
+            st.warning(f"🛒 「{name}」库存 {float(stock):g} kg，约可用 {float(days_left):g} 天"
+                       f"（到货需 {lead_time} 天），建议尽快采购约 {float(suggested):,.0f} kg")
+        with st.expander("📉 饲料消耗速度与补货建议", expanded=bool(to_reorder)):
+            if feed_forecast:
+                df = pd.DataFrame(
+                    [(r[0], r[1], round(r[2], 2), round(r[3], 2), r[4], r[5], r[6], r[7], r[8]) for r in feed_forecast],
+                    columns=["饲料", "库存(kg)", "近7天日用量(kg)", "近28天日用量(kg)", "可用天数",
+                             "到货天数", "补货点(kg)", "最晚下单日", "建议采购(kg)"])
+                st.dataframe(df, width='stretch', hide_index=True)
+                st.caption("日用量为按天的指数加权平均，取两者较大的计算；补货点 = 日用量 ×（到货天数 + "
+                           f"{FEED_SAFETY_DAYS} 天安全库存），低于补货点时建议补足 {FEED_COVER_DAYS} 天用量")
+                lt_col1, lt_col2, lt_col3 = st.columns([2, 1, 1])
+                with lt_col1:
+                    lt_feed = st.selectbox("调整到货天数", [r[0] for r in feed_forecast], key="feed_lead_time_name")
+                with lt_col2:
+                    lt_days = st.number_input("天", min_value=0, max_value=120, step=1, key=f"feed_lead_time_days_{lt_feed}",
+                                              value=int(next(r[5] for r in feed_forecast if r[0] == lt_feed)))
+                with lt_col3:
+                    st.write("")
+                    if st.button("💾 保存", key="feed_lead_time_save"):
+                        set_feed_lead_time(lt_feed, lt_days)
+                        st.toast(f"✅ 「{lt_feed}」到货天数已改为 {lt_days} 天")
+                        st.rerun()
+            else:
+                st.info("暂无饲料")
+
         # ==================== 1. 查看库存变动（放入 expander） ====================
         with st.expander("📄 查看库存变动", expanded=False):
             col1, col2 = st.columns(2)
@@ -2421,7 +4007,9 @@ def run():
                 st.markdown("#### 🌾 饲料库存")
                 feed_summary = get_feed_stock_summary()
                 if feed_summary:
-                    df = pd.DataFrame(feed_summary, columns=["名称", "库存(kg)"])
+                    days_left = {r[0]: r[4] for r in feed_forecast}
+                    df = pd.DataFrame([(name, stock, days_left.get(name)) for name, stock in feed_summary],
+                                      columns=["名称", "库存(kg)", "可用天数"])
                     st.dataframe(df, width='stretch', hide_index=True)
                     for name, _ in feed_summary:
                         if st.button(f"🔍 查看「{name}」流水", key=f"feed_detail_{name}"):
@@ -2759,203 +4347,206 @@ def run():
 
             # ========== 月度采购汇总 ==========
             st.markdown("##### 月度采购汇总")
-            conn = get_db_connection()
-            feed_month = pd.read_sql("""
-                SELECT date_trunc('month', purchased_at) AS 月份,
-                    SUM(quantity_kg) AS 采购量_kg,
-                    SUM(total_amount) AS 采购金额_元
-                FROM feed_purchase_record_shiwa
-                GROUP BY 月份
-                ORDER BY 月份 DESC;
-            """, conn)
-            frog_month = pd.read_sql("""
-                SELECT date_trunc('month', purchased_at) AS 月份,
-                    SUM(quantity) AS 采购量_只,
-                    SUM(total_amount) AS 采购金额_元
-                FROM frog_purchase_record_shiwa
-                GROUP BY 月份
-                ORDER BY 月份 DESC;
-            """, conn)
-            conn.close()
-
-            col1, col2 = st.columns(2)
-            with col1:
-                st.caption("饲料采购")
-                if not feed_month.empty:
-                    feed_month["月份"] = feed_month["月份"].dt.strftime("%Y-%m")
-                    st.dataframe(feed_month.style.format({"采购量_kg": "{:.2f}", "采购金额_元": "¥{:,.2f}"}),
-                                width='stretch', hide_index=True)
-                else:
-                    st.info("暂无饲料采购记录")
-            with col2:
-                st.caption("蛙型采购")
-                if not frog_month.empty:
-                    frog_month["月份"] = frog_month["月份"].dt.strftime("%Y-%m")
-                    st.dataframe(frog_month.style.format({"采购量_只": "{:.0f}", "采购金额_元": "¥{:,.2f}"}),
-                                width='stretch', hide_index=True)
-                else:
-                    st.info("暂无蛙型采购记录")
+            try:
+                feed_month, frog_month = run_cancellable(
+                    load_monthly_purchase_summary,
+                    data_version_key(versions, *MONTHLY_PURCHASE_TABLES),
+                    label="月度采购汇总中")
+            except ReportNotReady:
+                show_report_pending("月度采购汇总", "monthly_purchase_retry")
+            else:
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.caption("饲料采购")
+                    if not feed_month.empty:
+                        feed_month["月份"] = feed_month["月份"].dt.strftime("%Y-%m")
+                        st.dataframe(feed_month.style.format({"采购量_kg": "{:.2f}", "采购金额_元": "¥{:,.2f}"}),
+                                    width='stretch', hide_index=True)
+                    else:
+                        st.info("暂无饲料采购记录")
+                with col2:
+                    st.caption("蛙型采购")
+                    if not frog_month.empty:
+                        frog_month["月份"] = frog_month["月份"].dt.strftime("%Y-%m")
+                        st.dataframe(frog_month.style.format({"采购量_只": "{:.0f}", "采购金额_元": "¥{:,.2f}"}),
+                                    width='stretch', hide_index=True)
+                    else:
+                        st.info("暂无蛙型采购记录")
         # -----------------------------tab6 销售模块
     with tab6:
         st.subheader("💰 销售记录（按斤计算，1只 ≈ 4斤）")
-        ponds = get_all_ponds()
         sale_error = None  # ← 用于收集错误，不中断渲染
 
-        if not ponds:
-            st.warning("暂无可销售池塘")
-        else:
-            SALEABLE_POND_TYPES = ["商品蛙池", "三年蛙池", "四年蛙池", "五年蛙池", "六年蛙池", "种蛙池"]
-            cand = [p for p in ponds if p[2] in SALEABLE_POND_TYPES and p[5] > 0]
-            if not cand:
-                st.info("没有可销售的蛙（仅显示：商品蛙池、三年~六年蛙池）")
+        # ========== 池塘选择（按名称搜索，只取前 K 个有库存的可售池）==========
+        st.markdown("#### 📋 选择要销售的池塘（可按名称搜索）")
+        selected_pond_id, info = search_picker(
+            "池塘",
+            lambda q: search_ponds(q, pond_types=SALEABLE_POND_TYPES, min_count=1),
+            lambda p: f"[{p[3]}] {p[1]}（{p[2]}｜现存 {p[5]} 只 ≈ {p[5] * 4} 斤）",
+            key="sale_pond"
+        )
+        if info is None:
+            if st.session_state.get("sale_pond_query"):
+                st.info("没有匹配的可销售池塘，换个关键字试试。")
             else:
-                # ========== 池塘选择 ==========
-                st.markdown("#### 📋 待销售池塘清单（点击选择）")
-                pond_options = []
-                pond_id_list = []
-                for p in cand:
-                    pid, name, pond_type, frog_type, max_cap, current = p
-                    label = f"[{frog_type}] {name}（{pond_type}｜现存 {current} 只 ≈ {current * 4} 斤）"
-                    pond_options.append(label)
-                    pond_id_list.append(pid)
-                # 安全初始化：确保 selected_sale_pond_id 在当前可选范围内
-                if "selected_sale_pond_id" not in st.session_state or st.session_state.selected_sale_pond_id not in pond_id_list:
-                    st.session_state.selected_sale_pond_id = pond_id_list[0]  # 默认选第一个
-
-                # 获取当前选中池塘在列表中的索引
-                try:
-                    current_index = pond_id_list.index(st.session_state.selected_sale_pond_id)
-                except ValueError:
-                    current_index = 0
-                    st.session_state.selected_sale_pond_id = pond_id_list[0]
-
-                selected_label = st.radio(
-                    "选择要销售的池塘",
-                    options=pond_options,
-                    index=current_index,
-                    key="sale_pond_radio"
+                st.info("没有可销售的蛙（仅显示：商品蛙池、三年~六年蛙池、种蛙池）")
+        else:
+            st.info(f"✅ 已选：{info[1]}｜类型：{info[2]}｜蛙种：{info[3]}｜库存：{info[5]} 只（≈ {info[5] * 4} 斤）")
+            st.markdown("---")
+            # ========== 客户选择（按姓名 / 电话搜索）==========
+            st.markdown("#### 1. 选择客户")
+            c1, c2 = st.columns([3, 1])
+            with c1:
+                cust_sel, _ = search_picker(
+                    "客户", search_customers,
+                    lambda c: f"{c[1]} ({c[3]})" + (f" {c[2]}" if c[2] else ""),
+                    key="sale_customer", fixed_options=[("new", "新建客户")]
                 )
-                selected_pond_id = pond_id_list[pond_options.index(selected_label)]
-                st.session_state.selected_sale_pond_id = selected_pond_id
-                info = next(p for p in cand if p[0] == selected_pond_id)
-                st.info(f"✅ 已选：{info[1]}｜类型：{info[2]}｜蛙种：{info[3]}｜库存：{info[5]} 只（≈ {info[5] * 4} 斤）")
-                st.markdown("---")
-                # ========== 客户选择 ==========
-                st.markdown("#### 1. 选择客户")
-                customers = get_customers() or []
-                c1, c2 = st.columns([3, 1])
-                with c1:
-                    cust_opt = ["新建客户"] + [f"{c[1]} ({c[3]})" for c in customers]
-                    cust_sel = st.selectbox("客户", cust_opt, key="sale_customer")
-                new_cust = cust_sel == "新建客户"
-                with c2:
-                    sale_type = st.radio("销售类型", ["零售", "批发"], horizontal=True, key="sale_type")
-                customer_id = None
-                if new_cust:
-                    with st.form("new_customer"):
-                        name = st.text_input("客户姓名（单位/个人）*")
-                        contact = st.text_input("联系人", placeholder="如：张先生 / 李阿姨")
-                        phone = st.text_input("电话", max_chars=20)
-                        if st.form_submit_button("添加客户"):
-                            if not name.strip():
-                                sale_error = "请输入客户姓名！"
-                            else:
-                                full_name = f"{name.strip()}（{contact.strip()}）" if contact.strip() else name.strip()
-                                customer_id = add_customer(full_name, phone, sale_type)
-                                st.success(f"✅ 客户 {full_name} 已创建")
-                                st.rerun()
-                else:
-                    if customers:
-                        customer_id = customers[cust_opt.index(cust_sel) - 1][0]
-                # ========== 销售表单 ==========
-                if customer_id is not None:
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-                    cur.execute("SELECT name, phone, type FROM customer_shiwa WHERE id = %s;", (customer_id,))
-                    cust_detail = cur.fetchone()
-                    cur.close()
-                    conn.close()
-                    if cust_detail:
-                        name, phone, ctype = cust_detail
-                        phone_str = f"｜电话：{phone}" if phone else ""
-                        st.info(f"已选客户：{name}（{ctype}）{phone_str}")
-
-                    st.markdown("#### 2. 销售明细（按实际称重斤数，自动换算扣库存只数）")
-                    with st.form("sale_form"):
-                        pond_id = st.session_state.selected_sale_pond_id
-                        pond_info = next(c for c in cand if c[0] == pond_id)
-                        max_zhi = pond_info[5]
-                        weight_per_frog = st.number_input(
-                            "每只约多少斤（建议 0.2~0.3）",
-                            min_value=0.01,
-                            max_value=1.0,
-                            value=0.25,
-                            step=0.01,
-                            format="%.2f"
-                        )
-                        weight_jin = st.number_input(
-                            "实际称重销售重量 (斤)",
+            new_cust = cust_sel == "new"
+            with c2:
+                sale_type = st.radio("销售类型", ["零售", "批发"], horizontal=True, key="sale_type")
+            customer_id = None
+            if new_cust:
+                with st.form("new_customer"):
+                    name = st.text_input("客户姓名（单位/个人）*")
+                    contact = st.text_input("联系人", placeholder="如：张先生 / 李阿姨")
+                    phone = st.text_input("电话", max_chars=20)
+                    if st.form_submit_button("添加客户"):
+                        if not name.strip():
+                            sale_error = "请输入客户姓名！"
+                        else:
+                            full_name = f"{name.strip()}（{contact.strip()}）" if contact.strip() else name.strip()
+                            customer_id = add_customer(full_name, phone, sale_type)
+                            st.success(f"✅ 客户 {full_name} 已创建")
+                            st.rerun()
+            else:
+                customer_id = cust_sel
+            # ========== 销售表单 ==========
+            if customer_id is not None:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute("SELECT name, phone, type FROM customer_shiwa WHERE id = %s;", (customer_id,))
+                cust_detail = cur.fetchone()
+                cur.close()
+                conn.close()
+                if cust_detail:
+                    name, phone, ctype = cust_detail
+                    phone_str = f"｜电话：{phone}" if phone else ""
+                    st.info(f"已选客户：{name}（{ctype}）{phone_str}")
+
+                st.markdown("#### 2. 销售明细（按实际称重斤数，自动换算扣库存只数）")
+                with st.form("sale_form"):
+                    pond_id = selected_pond_id
+                    max_zhi = info[5]
+                    weight_per_frog = st.number_input(
+                        "每只约多少斤（建议 0.2~0.3）",
+                        min_value=0.01,
+                        max_value=1.0,
+                        value=0.25,
+                        step=0.01,
+                        format="%.2f"
+                    )
+                    weight_jin = st.number_input(
+                        "实际称重销售重量 (斤)",
+                        min_value=0.1,
+                        step=0.1,
+                        value=min(10.0, max_zhi * weight_per_frog)
+                    )
+                    if weight_per_frog <= 0:
+                        quantity_zhi = 0
+                    else:
+                        quantity_zhi = round(weight_jin / weight_per_frog)
+
+                    if quantity_zhi <= 0:
+                        st.error("换算后数量 ≤ 0，请检查输入！")
+                        st.form_submit_button("✅ 确认销售", disabled=True)
+                    elif quantity_zhi > max_zhi:
+                        st.error(f"❌ 换算后需扣 {quantity_zhi} 只，但库存仅 {max_zhi} 只！")
+                        st.form_submit_button("✅ 确认销售", disabled=True)
+                    else:
+                        st.info(f"→ **将扣减库存：{quantity_zhi} 只**（称重 {weight_jin} 斤 ÷ {weight_per_frog} 斤/只）")
+                        default_price_per_jin = 60.0 if sale_type == "零售" else 45.0
+                        price_per_jin = st.number_input(
+                            "单价 (元/斤)",
                             min_value=0.1,
-                            step=0.1,
-                            value=min(10.0, max_zhi * weight_per_frog)
+                            value=default_price_per_jin,
+                            step=0.5
                         )
-                        if weight_per_frog <= 0:
-                            quantity_zhi = 0
-                        else:
-                            quantity_zhi = round(weight_jin / weight_per_frog)
-
-                        if quantity_zhi <= 0:
-                            st.error("换算后数量 ≤ 0，请检查输入！")
-                            st.form_submit_button("✅ 确认销售", disabled=True)
-                        elif quantity_zhi > max_zhi:
-                            st.error(f"❌ 换算后需扣 {quantity_zhi} 只，但库存仅 {max_zhi} 只！")
-                            st.form_submit_button("✅ 确认销售", disabled=True)
-                        else:
-                            st.info(f"→ **将扣减库存：{quantity_zhi} 只**（称重 {weight_jin} 斤 ÷ {weight_per_frog} 斤/只）")
-                            default_price_per_jin = 60.0 if sale_type == "零售" else 45.0
-                            price_per_jin = st.number_input(
-                                "单价 (元/斤)",
-                                min_value=0.1,
-                                value=default_price_per_jin,
-                                step=0.5
-                            )
-                            note = st.text_area("备注")
-                            submitted = st.form_submit_button("✅ 确认销售", type="primary")
-                            if submitted:
-                                current_user = st.session_state.user['username']
-                                unit_price_per_zhi = price_per_jin * weight_per_frog
-                                do_sale(
-                                    pond_id=pond_id,
-                                    customer_id=customer_id,
-                                    sale_type=sale_type,
-                                    qty_zhi=quantity_zhi,
-                                    unit_price_per_zhi=unit_price_per_zhi,
-                                    weight_jin=weight_jin,
-                                    note=note,
-                                    sold_by=current_user
-                                )
-                                total_yuan = weight_jin * price_per_jin
-                                st.success(f"✅ 销售成功：{weight_jin} 斤 × {price_per_jin} 元/斤 = **{total_yuan:.2f} 元**")
+                        note = st.text_area("备注")
+                        b1, b2 = st.columns(2)
+                        add_to_order = b1.form_submit_button("➕ 加入订单（继续选其他池塘）")
+                        submitted = b2.form_submit_button("✅ 确认销售", type="primary")
+                        if add_to_order or submitted:
+                            cart = st.session_state.get("sale_cart")
+                            if cart and (cart["customer_id"], cart["sale_type"]) != (customer_id, sale_type):
+                                sale_error = "订单里已有其他客户 / 销售类型的明细，请先提交或清空订单"
+                            else:
+                                cart = cart or {"customer_id": customer_id, "sale_type": sale_type, "lines": []}
+                                # 同一池塘再加一次：以最新填写的为准
+                                cart["lines"] = [l for l in cart["lines"] if l["pond_id"] != pond_id] + [{
+                                    "pond_id": pond_id, "pond_name": info[1], "qty_zhi": quantity_zhi,
+                                    "unit_price_per_zhi": price_per_jin * weight_per_frog,
+                                    "weight_jin": weight_jin, "price_per_jin": price_per_jin,
+                                }]
+                                cart["note"] = note
+                                st.session_state.sale_cart = cart
+                                if submitted:
+                                    st.session_state.sale_submit_order = True
                                 st.rerun()
 
-        # ========== 销售记录总览（始终显示）==========
-        st.markdown("#### 3. 最近销售记录")
+                # ========== 本单明细（多池塘一单，一个事务提交）==========
+                cart = st.session_state.get("sale_cart")
+                if cart and cart["lines"]:
+                    st.markdown("##### 🧾 本单明细")
+                    cart_df = pd.DataFrame(cart["lines"])
+                    cart_df["金额"] = cart_df["weight_jin"] * cart_df["price_per_jin"]
+                    st.dataframe(
+                        cart_df[["pond_name", "weight_jin", "qty_zhi", "price_per_jin", "金额"]].rename(columns={
+                            "pond_name": "池塘", "weight_jin": "重量_斤", "qty_zhi": "扣库存_只", "price_per_jin": "元/斤"
+                        }),
+                        width='stretch', hide_index=True
+                    )
+                    order_total = cart_df["金额"].sum()
+                    st.markdown(f"**合计：{cart_df['weight_jin'].sum():.2f} 斤 / {cart_df['qty_zhi'].sum()} 只 / "
+                                f"¥{order_total:,.2f}**")
+                    o1, o2 = st.columns(2)
+                    submit_order = o1.button("✅ 提交整单", type="primary", key="sale_submit_cart")
+                    if o2.button("🗑️ 清空订单", key="sale_clear_cart"):
+                        st.session_state.pop("sale_cart", None)
+                        st.rerun()
+                    if submit_order or st.session_state.pop("sale_submit_order", False):
+                        try:
+                            order_id = do_sale_order(
+                                customer_id=cart["customer_id"],
+                                sale_type=cart["sale_type"],
+                                lines=cart["lines"],
+                                note=cart.get("note", ""),
+                                sold_by=st.session_state.user['username']
+                            )
+                        except (ValueError, psycopg2.Error) as e:
+                            st.error(f"❌ 下单失败，整单未扣库存：{e}")
+                        else:
+                            st.session_state.pop("sale_cart", None)
+                            st.toast(f"✅ 订单 #{order_id} 销售成功：{len(cart['lines'])} 个池塘，合计 ¥{order_total:,.2f}")
+                            st.rerun()
+
+        if sale_error:
+            st.error(sale_error)
+
+        # ========== 销售记录总览（始终显示，按订单分页）==========
+        st.markdown("#### 3. 最近销售订单")
         page_size = 20
         if "sale_page" not in st.session_state:
             st.session_state.sale_page = 0
 
-        # 获取总记录数
-        conn_count = get_db_connection()
-        cur_count = conn_count.cursor()
-        cur_count.execute("SELECT COUNT(*) FROM sale_record_shiwa;")
-        total_sales = cur_count.fetchone()[0]
-        cur_count.close()
-        conn_count.close()
-
-        total_pages = (total_sales + page_size - 1) // page_size if total_sales > 0 else 1
-        current_page = st.session_state.sale_page
-        current_page = max(0, min(current_page, total_pages - 1))
-        st.session_state.sale_page = current_page
+        orders, order_lines, total_orders = page_query(get_sale_orders_page, st.session_state.sale_page, page_size,
+                                                       default=([], [], 0), label="销售订单")
+        total_pages = (total_orders + page_size - 1) // page_size if total_orders > 0 else 1
+        current_page = max(0, min(st.session_state.sale_page, total_pages - 1))
+        if current_page != st.session_state.sale_page:
+            st.session_state.sale_page = current_page
+            orders, order_lines, total_orders = page_query(get_sale_orders_page, current_page, page_size,
+                                                           default=([], [], 0), label="销售订单")
 
         col_prev, col_next, col_info = st.columns([1, 1, 3])
         with col_prev:
@@ -2967,72 +4558,63 @@ def run():
                 st.session_state.sale_page += 1
                 st.rerun()
         with col_info:
-            st.caption(f"第 {current_page + 1} 页 / 共 {total_pages} 页（每页 {page_size} 条）")
+            st.caption(f"第 {current_page + 1} 页 / 共 {total_pages} 页（每页 {page_size} 单，共 {total_orders} 单）")
 
-        offset = current_page * page_size
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT sr.id, p.name pond, c.name customer, sr.sale_type, sr.quantity,
-                sr.unit_price, sr.total_amount, sr.sold_at, sr.note, sr.weight_jin, sr.sold_by
-            FROM sale_record_shiwa sr
-            JOIN pond_shiwa p ON p.id = sr.pond_id
-            JOIN customer_shiwa c ON c.id = sr.customer_id
-            ORDER BY sr.sold_at DESC
-            LIMIT %s OFFSET %s;
-        """, (page_size, offset))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-
-        if rows:
+        if orders:
             df = pd.DataFrame(
-                rows,
-                columns=["ID", "池塘", "客户", "类型", "数量_只", "单价_元每只", "总金额", "时间", "备注", "原始斤数", "销售人"]
+                orders,
+                columns=["订单号", "客户", "类型", "数量_只", "原始斤数", "总金额", "销售人", "时间", "备注"]
             )
-            # ✅ 修复：正确计算“元/斤” = 总金额 / 原始斤数（若原始斤数为 NULL，则用 4 斤/只估算）
-            def calc_price_per_jin(row):
-                if pd.notna(row["原始斤数"]) and row["原始斤数"] > 0:
-                    return row["总金额"] / row["原始斤数"]
-                else:
-                    return row["单价_元每只"] / 4  # 兜底
-            df["单价_元每斤"] = df.apply(calc_price_per_jin, axis=1)
+            lines_df = pd.DataFrame(
+                order_lines,
+                columns=["订单号", "池塘", "数量_只", "单价_元每只", "原始斤数", "金额"]
+            )
+            df[["原始斤数", "总金额"]] = df[["原始斤数", "总金额"]].astype(float)
+            df["池塘"] = df["订单号"].map(lines_df.groupby("订单号")["池塘"].agg("、".join))
+            # 元/斤 = 总金额 / 原始斤数（老数据没有斤数时按 4 斤/只估算）
             df["重量_斤"] = df["原始斤数"].fillna(df["数量_只"] * 4)
+            df["单价_元每斤"] = df["总金额"] / df["重量_斤"].where(df["重量_斤"] > 0)
 
-            df_display = df[["池塘", "客户", "类型", "重量_斤", "单价_元每斤", "总金额", "销售人", "时间", "备注"]]
+            df_display = df[["订单号", "池塘", "客户", "类型", "重量_斤", "单价_元每斤", "总金额", "销售人", "时间", "备注"]]
             st.dataframe(
                 df_display.style.format({
                     "重量_斤": "{:.2f} 斤",
-                    "单价_元每斤": "¥{:.2f}/斤",   # ← 直接显示正确单价
+                    "单价_元每斤": "¥{:.2f}/斤",
                     "总金额": "¥{:.2f}"
-                }),
+                }, na_rep="-"),
                 width='stretch',
                 hide_index=True
             )
+            multi = df.loc[lines_df.groupby("订单号").size().reindex(df["订单号"]).values > 1, "订单号"]
+            if not multi.empty:
+                with st.expander(f"📦 多池塘订单明细（本页 {len(multi)} 单）"):
+                    st.dataframe(lines_df[lines_df["订单号"].isin(multi)], width='stretch', hide_index=True)
             csv = df_display.to_csv(index=False)
             st.download_button(
                 "📥 导出当前页 CSV",
                 csv,
                 file_name=f"sale_page_{current_page + 1}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv"
             )
-            if len(rows) == page_size:
+            if current_page < total_pages - 1:
                 st.info("✅ 还有更多记录，请点击「下一页」查看")
             else:
                 st.success("已到最后一页")
         else:
-            if current_page == 0:
-                st.info("暂无销售记录")
-            else:
-                st.warning("没有更多数据了")
-                st.session_state.sale_page -= 1
+            st.info("暂无销售记录")
     # ----------------------------- Tab 7: 投资回报 ROI -----------------------------
     with tab7:
         st.subheader("📈 蛙种投资回报率（ROI）分析")
         st.caption("ROI = (销售收入 - 总成本) / 总成本 × 100% | 外购成本按 20 元/只估算（若未填单价）")
 
         # ========== 汇总视图 ==========
-        roi_data = get_roi_data()
-        if roi_data:
+        try:
+            roi_data = run_cancellable(load_roi_summary, data_version_key(versions, *ROI_SUMMARY_TABLES),
+                                       label="ROI 汇总计算中")
+        except ReportNotReady:
+            roi_data = None
+        if roi_data is None:
+            show_report_pending("ROI 汇总", "roi_summary_retry")
+        elif roi_data:
             df_roi = pd.DataFrame(roi_data)
             st.dataframe(
                 df_roi.style.format({
@@ -3066,9 +4648,15 @@ def run():
         st.subheader("🔍 ROI 明细：按池塘查看成本与收入")
 
         # ========== 明细视图 ==========
-        feedings, purchases, sales = get_pond_roi_details()
-        
-        if not (feedings or purchases or sales):
+        try:
+            feedings, purchases, sales = run_cancellable(
+                load_pond_roi_details, data_version_key(versions, *ROI_TABLES), label="ROI 明细加载中")
+        except ReportNotReady:
+            feedings = purchases = sales = None
+
+        if feedings is None:
+            show_report_pending("ROI 明细", "roi_details_retry")
+        elif not (feedings or purchases or sales):
             st.info("暂无喂养、外购或销售明细记录")
         else:
             # 按池塘分组
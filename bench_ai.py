@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - AI 问答离线压测
+- 固定题库 bench_ai_questions.json（100 题：约 30 题走模板，其余带录好的 SQL）
+- 本地起一个兼容 OpenAI 的桩服务：第一阶段按题库返回 tool call，第二阶段按固定延迟流式返回回答，
+  不花钱、不联网，每次跑的"大模型耗时"都一样，差异只来自我们自己的代码和数据库
+- 对一个独立的压测库建表、灌固定种子数据，逐题调用 app.ai_ask_database，
+  从 ai_metrics_shiwa 读各阶段耗时，输出 p50 / p95（第 1 轮冷缓存，之后是热缓存）
+- --out 保存结果，--baseline 与上一次结果对比
+
+用法：
+    python bench_ai.py --db-url postgresql://.../shiwa_bench --out after.json --baseline before.json
+压测库必须单独指定（--db-url 或 SHIWA_BENCH_DATABASE_URL），不会碰 .env 里的生产库。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUESTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_ai_questions.json")
+FALLBACK_SQL = "SELECT COUNT(*) FROM pond_shiwa"
+STAGES = ("llm1_ms", "sql_ms", "llm2_first_ms", "llm2_ms", "total_ms")
+FAKE_ANSWER = "根据查询结果，目前场里的情况正常，具体数字见上方表格。"
+
+
+# -----------------------------
+# 本地 OpenAI 桩服务
+# -----------------------------
+class FakeLLM:
+    def __init__(self, sql_by_question, llm1_ms, llm2_first_ms, token_ms, jitter, seed=42):
+        self.sql_by_question = sql_by_question
+        self.llm1_ms = llm1_ms
+        self.llm2_first_ms = llm2_first_ms
+        self.token_ms = token_ms
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, ms):
+        with self.lock:
+            factor = 1 + self.rng.uniform(-self.jitter, self.jitter)
+        time.sleep(max(ms * factor, 0) / 1000)
+
+    def sql_for(self, messages):
+        question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        return self.sql_by_question.get(question.strip()) or FALLBACK_SQL
+
+
+def make_handler(llm):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if body.get("stream"):
+                self._stream_answer(body)
+            else:
+                self._tool_call(body)
+
+        def _tool_call(self, body):
+            llm.delay(llm.llm1_ms)
+            args = json.dumps({"sql": llm.sql_for(body["messages"]), "explanation": "压测"}, ensure_ascii=False)
+            payload = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "tool_calls", "message": {
+                    "role": "assistant", "content": None,
+                    "tool_calls": [{"id": "call_bench", "type": "function",
+                                    "function": {"name": "execute_sql_query", "arguments": args}}],
+                }}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _stream_answer(self, body):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            llm.delay(llm.llm2_first_ms)
+            for i, ch in enumerate(FAKE_ANSWER):
+                if i:
+                    llm.delay(llm.token_ms)
+                chunk = {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body["model"],
+                         "choices": [{"index": 0, "delta": {"content": ch}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def start_fake_llm(llm):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(llm))
+    threading.Thread(target=server.serve_forever, daemon=True, name="bench-llm").start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+# -----------------------------
+# 压测库：建表 + 固定种子数据
+# -----------------------------
+def seed_database(app, seed=42):
+    """灌一份固定的数据（同一个 seed 每次完全一样），已有数据时先清空业务表"""
+    from psycopg2.extras import execute_values
+
+    rng = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    conn = app.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        TRUNCATE death_image_shiwa, pond_life_cycle_shiwa, pond_change_log, sale_record_shiwa, sale_order_shiwa,
+                 stock_movement_shiwa, daily_log_shiwa, feeding_record_shiwa, pond_shiwa,
+                 customer_shiwa, feed_type_shiwa, frog_purchase_type_shiwa,
+                 feed_purchase_record_shiwa, frog_purchase_record_shiwa, ai_metrics_shiwa
+        RESTART IDENTITY CASCADE;
+    """)
+    cur.execute("SELECT id FROM pond_type_shiwa ORDER BY id;")
+    pond_type_ids = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT id FROM frog_type_shiwa ORDER BY id;")
+    frog_type_ids = [r[0] for r in cur.fetchall()]
+
+    feeds = [("饲料A-膨化颗粒", 6.5), ("饲料B-黄粉虫", 18.0), ("饲料C-蝇蛆", 12.0), ("饲料D-开口料", 22.0)]
+    execute_values(cur, "INSERT INTO feed_type_shiwa (name, unit_price, stock_kg, supplier) VALUES %s",
+                   [(n, p, rng.randint(50, 800), f"供应商{i % 2 + 1}") for i, (n, p) in enumerate(feeds)])
+
+    ponds = []
+    for i in range(60):
+        cap = rng.choice([500, 1000, 2000, 5000])
+        ponds.append((f"{i // 10 + 1}区-{i % 10 + 1:02d}号池", rng.choice(pond_type_ids),
+                      rng.choice(frog_type_ids), cap, rng.randint(0, cap)))
+    execute_values(cur, """
+        INSERT INTO pond_shiwa (name, pond_type_id, frog_type_id, max_capacity, current_count) VALUES %s
+    """, ponds)
+    pond_ids = list(range(1, len(ponds) + 1))
+
+    execute_values(cur, "INSERT INTO customer_shiwa (name, phone, type) VALUES %s",
+                   [(f"客户{i:03d}", f"138{rng.randint(10000000, 99999999)}", rng.choice(["零售", "批发"]))
+                    for i in range(1, 41)])
+
+    days = 400
+    feedings, logs, movements, orders, sales = [], [], [], [], []
+    for d in range(days):
+        day = now - timedelta(days=d)
+        for pond_id in pond_ids:
+            if rng.random() < 0.7:
+                feed_id = rng.randint(1, len(feeds))
+                feedings.append((pond_id, feed_id, round(rng.uniform(0.5, 8), 2), feeds[feed_id - 1][1],
+                                 day - timedelta(hours=rng.randint(0, 10)), rng.choice(["张三", "李四", "王五"])))
+            if rng.random() < 0.5:
+                logs.append((pond_id, day.date(), round(rng.uniform(14, 26), 1), round(rng.uniform(6.5, 8.2), 1),
+                             round(rng.uniform(3.5, 9), 1), round(rng.uniform(60, 95), 1),
+                             rng.choice(["晴", "阴", "小雨", "大雨"]), rng.choice(["山泉水", "井水"]), "李四"))
+        for _ in range(rng.randint(0, 6)):
+            mtype = rng.choice(["death", "death", "transfer", "purchase", "hatch"])
+            src = rng.choice(pond_ids) if mtype in ("death", "transfer") else None
+            dst = rng.choice(pond_ids) if mtype in ("transfer", "purchase", "hatch") else None
+            price = round(rng.uniform(2, 8), 2) if mtype == "purchase" else None
+            movements.append((mtype, src, dst, rng.randint(1, 60), price, "王五",
+                              day - timedelta(hours=rng.randint(0, 10))))
+        # 与 do_sale_order 相同的形状：一张订单头 + 1~3 个不同池塘的明细，合计写回订单头
+        for _ in range(rng.randint(0, 3)):
+            order_id = len(orders) + 1
+            customer_id, sale_type = rng.randint(1, 40), rng.choice(["零售", "批发"])
+            sold_at = day - timedelta(hours=rng.randint(0, 10))
+            lines = []
+            for pond_id in rng.sample(pond_ids, rng.randint(1, 3)):
+                qty = rng.randint(10, 400)
+                lines.append((pond_id, customer_id, sale_type, qty, round(rng.uniform(8, 20), 2),
+                              round(qty / 6, 2), sold_at, "张三", order_id))
+            orders.append((order_id, customer_id, sale_type, sum(l[3] for l in lines),
+                           round(sum(l[5] for l in lines), 2), round(sum(l[3] * l[4] for l in lines), 2),
+                           sold_at, "张三"))
+            sales.extend(lines)
+
+    execute_values(cur, """
+        INSERT INTO feeding_record_shiwa (pond_id, feed_type_id, feed_weight_kg, unit_price_at_time, fed_at, fed_by)
+        VALUES %s
+    """, feedings, page_size=5000)
+    execute_values(cur, """
+        INSERT INTO daily_log_shiwa (pond_id, log_date, water_temp, ph_value, do_value, humidity,
+                                     weather, water_source, recorded_by)
+        VALUES %s ON CONFLICT DO NOTHING
+    """, logs, page_size=5000)
+    execute_values(cur, """
+        INSERT INTO stock_movement_shiwa (movement_type, from_pond_id, to_pond_id, quantity, unit_price,
+                                          created_by, moved_at)
+        VALUES %s
+    """, movements, page_size=5000)
+    execute_values(cur, """
+        INSERT INTO sale_order_shiwa (id, customer_id, sale_type, total_quantity, total_weight_jin, total_amount,
+                                      sold_at, sold_by)
+        VALUES %s
+    """, orders, page_size=5000)
+    cur.execute("SELECT setval(pg_get_serial_sequence('sale_order_shiwa', 'id'), %s, %s);",
+                (max(len(orders), 1), bool(orders)))
+    execute_values(cur, """
+        INSERT INTO sale_record_shiwa (pond_id, customer_id, sale_type, quantity, unit_price, weight_jin,
+                                       sold_at, sold_by, order_id)
+        VALUES %s
+    """, sales, page_size=5000)
+    execute_values(cur, """
+        INSERT INTO feed_purchase_record_shiwa (feed_type_name, quantity_kg, unit_price, supplier, purchased_at)
+        VALUES %s
+    """, [(rng.choice(feeds)[0], rng.randint(50, 500), round(rng.uniform(5, 20), 2), f"供应商{rng.randint(1, 3)}",
+           now - timedelta(days=rng.randint(0, days))) for _ in range(120)])
+    execute_values(cur, """
+        INSERT INTO frog_purchase_record_shiwa (frog_type_name, quantity, unit_price, supplier, purchased_at)
+        VALUES %s
+    """, [(rng.choice(["细皮蛙苗", "粗皮蛙苗"]), rng.randint(100, 2000), round(rng.uniform(2, 8), 2),
+           f"蛙苗场{rng.randint(1, 2)}", now - timedelta(days=rng.randint(0, days))) for _ in range(40)])
+    conn.commit()
+    cur.close()
+    conn.close()
+    app.refresh_reporting_views(list(app.REPORTING_VIEW_DEPS))
+    print(f"[bench] 种子数据：{len(ponds)} 个池子，{len(feedings)} 条喂养，{len(logs)} 条日志，"
+          f"{len(movements)} 条变动，{len(orders)} 张订单 / {len(sales)} 条销售明细")
+
+
+def database_is_empty(app):
+    conn = app.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM pond_shiwa);")
+    empty = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return empty
+
+
+# -----------------------------
+# 跑题库 + 统计
+# -----------------------------
+def percentile(values, q):
+    """线性插值分位数，与 PostgreSQL percentile_cont 一致"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize(rows, wall_ms):
+    stages = {}
+    for stage in STAGES:
+        values = [r[stage] for r in rows if r[stage] is not None and r["error"] is None]
+        stages[stage] = {"n": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+    cache_hits = {}
+    for r in rows:
+        key = r["cache_hit"] or "miss"
+        cache_hits[key] = cache_hits.get(key, 0) + 1
+    return {
+        "stages": stages,
+        "cache_hits": cache_hits,
+        "errors": sum(1 for r in rows if r["error"]),
+        "wall_ms": {"p50": percentile(wall_ms, 0.5), "p95": percentile(wall_ms, 0.95)},
+    }
+
+
+def run_round(app, client, questions):
+    conn = app.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM ai_metrics_shiwa;")
+    start_id = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+
+    wall_ms = []
+    for item in questions:
+        started = time.perf_counter()
+        try:
+            stream, _sql, _df = app.ai_ask_database(item["question"], client=client)
+            for _ in stream:
+                pass
+        except Exception as e:
+            print(f"[bench] 失败：{item['question']} -> {e}")
+        wall_ms.append((time.perf_counter() - started) * 1000)
+
+    conn = app.get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT {', '.join(STAGES)}, cache_hit, error FROM ai_metrics_shiwa WHERE id > %s ORDER BY id;
+    """, (start_id,))
+    names = [d[0] for d in cur.description]
+    rows = [dict(zip(names, r)) for r in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return summarize(rows, wall_ms)
+
+
+def _fmt_ms(v):
+    return "-" if v is None else f"{v:,.0f}"
+
+
+def print_report(result, baseline=None):
+    for i, rnd in enumerate(result["rounds"]):
+        title = "冷缓存" if i == 0 else "热缓存"
+        print(f"\n=== 第 {i + 1} 轮（{title}）  命中：{rnd['cache_hits']}  失败：{rnd['errors']} ===")
+        base = baseline["rounds"][i] if baseline and i < len(baseline["rounds"]) else None
+        print(f"{'阶段':<14}{'n':>5}{'p50':>10}{'p95':>10}" + (f"{'Δp50':>10}{'Δp95':>10}" if base else ""))
+        lines = list(rnd["stages"].items()) + [("client_wall_ms", dict(n=len(result["questions"]), **rnd["wall_ms"]))]
+        for stage, s in lines:
+            line = f"{stage:<14}{s['n']:>5}{_fmt_ms(s['p50']):>10}{_fmt_ms(s['p95']):>10}"
+            if base:
+                b = base["stages"].get(stage) if stage in base["stages"] else base["wall_ms"]
+                for q in ("p50", "p95"):
+                    if s[q] is None or b.get(q) in (None, 0):
+                        line += f"{'-':>10}"
+                    else:
+                        line += f"{(s[q] - b[q]) / b[q]:>+10.1%}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI 问答离线压测（本地桩大模型 + 独立压测库）")
+    parser.add_argument("--db-url", default=os.getenv("SHIWA_BENCH_DATABASE_URL"),
+                        help="压测库连接串（默认取 SHIWA_BENCH_DATABASE_URL）")
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    parser.add_argument("--rounds", type=int, default=2, help="第 1 轮前清空 AI 缓存（冷），之后为热缓存")
+    parser.add_argument("--seed", action="store_true", help="重新灌种子数据（压测库为空时会自动灌）")
+    parser.add_argument("--llm1-ms", type=float, default=800, help="桩服务生成 SQL 的延迟")
+    parser.add_argument("--llm2-first-ms", type=float, default=400, help="桩服务回答首字延迟")
+    parser.add_argument("--token-ms", type=float, default=20, help="桩服务每个字的间隔")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延迟随机抖动比例")
+    parser.add_argument("--out", help="结果保存为 JSON")
+    parser.add_argument("--baseline", help="上一次 --out 的 JSON，输出对比")
+    args = parser.parse_args()
+
+    if not args.db_url:
+        sys.exit("请用 --db-url 或 SHIWA_BENCH_DATABASE_URL 指定单独的压测库（不要用生产库）")
+
+    # 必须在 import app / init_shiwa_db 之前设置：两者在导入时读取连接串
+    os.environ["DATABASE_SHIWA_URL"] = args.db_url
+    os.environ.pop("DATABASE_SHIWA_REPLICA_URL", None)
+    os.environ["SHIWA_RESULT_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="shiwa-bench-"), "cache.sqlite")
+
+    import init_shiwa_db
+    init_shiwa_db.main()
+    import app
+    from openai import OpenAI
+
+    if args.seed or database_is_empty(app):
+        seed_database(app)
+
+    with open(args.questions, encoding="utf-8") as f:
+        questions = json.load(f)
+    llm = FakeLLM({q["question"]: q["sql"] for q in questions if q.get("sql")},
+                  args.llm1_ms, args.llm2_first_ms, args.token_ms, args.jitter)
+    server, base_url = start_fake_llm(llm)
+    client = OpenAI(api_key="bench", base_url=base_url)
+
+    rounds = []
+    try:
+        app.purge_ai_cache()
+        for i in range(args.rounds):
+            print(f"[bench] 第 {i + 1}/{args.rounds} 轮，{len(questions)} 题…")
+            rounds.append(run_round(app, client, questions))
+    finally:
+        server.shutdown()
+
+    result = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "questions": [q["question"] for q in questions],
+        "settings": {k: getattr(args, k) for k in ("llm1_ms", "llm2_first_ms", "token_ms", "jitter", "rounds")},
+        "rounds": rounds,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n[bench] 结果已保存：{args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 死亡照片处理
+- 上传时：按 EXIF 方向摆正，生成限制尺寸的展示图 + 小缩略图，原图原样保留
+- 图库页只加载缩略图，点开后才加载展示图 / 原图
+- 提交表单时只把原始字节落到 staging/（每次上传一个文件，记在 death_image_shiwa.staged_path），
+  事务提交后再由后台线程生成渲染图并移到正式位置
+- 按内容寻址存储：objects/<sha 前 2 位>/<sha 3~4 位>/<sha256>.<ext>，同一张照片只存一份，
+  death_image_shiwa.content_sha256 相同的行数就是该文件的引用计数
+
+命令行（在 app.py 所在目录执行，需要 DATABASE_SHIWA_URL 的命令会读 .env）：
+    python death_image_store.py backfill [--force]        补齐缩略图 / 展示图
+    python death_image_store.py migrate                   把旧的 uuid 文件名照片迁入内容寻址目录
+    python death_image_store.py gc [--dry-run] [--grace-hours N]   删除没有任何记录引用的文件
+    python death_image_store.py report                    按月统计照片存储占用
+"""
+import os
+import io
+import sys
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+DEATH_IMAGE_DIR = "death_images"
+STAGING_DIR = os.path.join(DEATH_IMAGE_DIR, "staging")
+OBJECTS_DIR = os.path.join(DEATH_IMAGE_DIR, "objects")
+
+# GC 不删最近这段时间内修改过的文件（可能是还没提交的上传）
+GC_GRACE_SECONDS = 3600
+
+# death_image_shiwa.status 取值
+STATUS_PENDING = "pending"
+STATUS_PROCESSING = "processing"  # 已被某个进程的后台线程认领（claimed_at 起算租约）
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+# 展示图最长边 / 缩略图最长边（像素）
+DISPLAY_MAX_PX = 1600
+THUMB_MAX_PX = 320
+JPEG_QUALITY = {"display": 85, "thumb": 75}
+RENDITION_SIZES = {"display": DISPLAY_MAX_PX, "thumb": THUMB_MAX_PX}
+ALLOWED_EXTS = (".png", ".jpg", ".jpeg")
+
+
+def rendition_path(image_path, kind):
+    """原图路径 → 对应的展示图 / 缩略图路径（death_images/<kind>/<原文件名>.jpg）"""
+    base = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(os.path.dirname(image_path), kind, f"{base}.jpg")
+
+
+def _render(img, max_px, quality):
+    out = img.copy()
+    out.thumbnail((max_px, max_px), Image.LANCZOS)
+    buf = io.BytesIO()
+    out.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+
+def make_renditions(data: bytes):
+    """原图字节 → {"display": bytes, "thumb": bytes}（已按 EXIF 摆正、转 RGB）"""
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG 直接按目标尺寸降采样解码，4~8 MB 的手机照片省掉大部分解码开销
+        img.draft("RGB", (DISPLAY_MAX_PX, DISPLAY_MAX_PX))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            # PNG 透明背景铺白，避免转 JPEG 后变黑
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            background.paste(rgba, mask=rgba.split()[-1])
+            img = background
+        return {kind: _render(img, RENDITION_SIZES[kind], JPEG_QUALITY[kind])
+                for kind in RENDITION_SIZES}
+
+
+def write_renditions(image_path, data=None):
+    """为一张原图写出展示图和缩略图；data 为空时从磁盘读原图"""
+    if data is None:
+        with open(image_path, "rb") as f:
+            data = f.read()
+    for kind, payload in make_renditions(data).items():
+        path = rendition_path(image_path, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(payload)
+
+
+def ensure_rendition(image_path, kind):
+    """返回渲染图路径，缺失时现场补生成（兼容未 backfill 的历史照片）；原图不存在返回 None"""
+    path = rendition_path(image_path, kind)
+    if os.path.exists(path):
+        return path
+    if not os.path.exists(image_path):
+        return None
+    try:
+        write_renditions(image_path)
+    except (OSError, Image.DecompressionBombError) as e:
+        print(f"[death-image] 生成缩略图失败 {image_path}：{e}")
+        return image_path if kind == "display" else None
+    return path
+
+
+class RenditionCache:
+    """
+    进程内渲染图字节缓存（按总字节数限容的 LRU），所有会话共用。
+    键是 (内容键, 渲染类型)：内容寻址文件名就是 sha256，旧 uuid 文件名同样不会被覆盖写，
+    所以文件内容不变，缓存不需要失效。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_key(image_path):
+        return os.path.splitext(os.path.basename(image_path))[0]
+
+    def get(self, image_path, kind):
+        """返回渲染图字节；原图不存在返回 None"""
+        key = (self.content_key(image_path), kind)
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        path = ensure_rendition(image_path, kind)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        self._put(key, data)
+        return data
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def object_path(sha256, ext):
+    """内容哈希 → 正式存储路径（两级目录打散，避免单目录文件过多）"""
+    ext = ".jpg" if ext == ".jpeg" else ext
+    return os.path.join(OBJECTS_DIR, sha256[:2], sha256[2:4], f"{sha256}{ext}")
+
+
+def touch_object(final_path):
+    """刷新正式文件及其渲染图的修改时间，让 GC 的宽限期保护住刚被新记录引用的文件；文件不存在返回 False"""
+    try:
+        os.utime(final_path)
+    except FileNotFoundError:
+        return False
+    for kind in RENDITION_SIZES:
+        try:
+            os.utime(rendition_path(final_path, kind))
+        except FileNotFoundError:
+            pass  # 缺了展示时会现场补生成
+    return True
+
+
+def stage_upload(data: bytes, ext: str):
+    """
+    把上传的原始字节写进 staging/，返回 (staging 路径, 最终原图路径, sha256, 字节数)。
+    staging 文件名是 <sha256>.<uuid><ext>，并发上传同一张照片时各用各的，回滚只删自己那份。
+    同样内容的文件已经在库里时不再落盘（刷新它的修改时间，免得提交前被 GC 当成无引用删掉），
+    后台任务发现正式文件已存在会直接标记 ready。
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    final_path = object_path(sha256, ext)
+    staged_path = os.path.join(STAGING_DIR, f"{sha256}.{uuid.uuid4().hex}{os.path.splitext(final_path)[1]}")
+    if not touch_object(final_path):
+        os.makedirs(STAGING_DIR, exist_ok=True)
+        tmp_path = f"{staged_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, staged_path)
+    return staged_path, final_path, sha256, len(data)
+
+
+def staged_path_for(image_path):
+    """旧版 staging 路径（与最终原图文件名相同）；staged_path 列为空的记录按这个找"""
+    return os.path.join(STAGING_DIR, os.path.basename(image_path))
+
+
+def finalize_staged(staged_path, final_path):
+    """生成渲染图，再把原图从 staging 原子移动到正式位置（中断后可重复执行）"""
+    if touch_object(final_path):
+        # 相同内容已入库（并发上传同一张照片），丢掉这份 staging 即可
+        discard_staged([staged_path])
+        return
+    try:
+        with open(staged_path, "rb") as f:
+            data = f.read()
+        write_renditions(final_path, data)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(staged_path, final_path)
+    except FileNotFoundError:
+        # 另一个进程刚处理完（staging 已移走、正式文件已在）也算成功
+        if not os.path.exists(final_path):
+            raise
+
+
+def discard_staged(staged_paths):
+    """事务回滚时清理已落盘的 staging 文件"""
+    for path in staged_paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def iter_original_images(image_dir=DEATH_IMAGE_DIR):
+    """遍历所有原图（旧版在目录第一层，新版在 objects/ 下；跳过渲染图和 staging）"""
+    skip_dirs = set(RENDITION_SIZES) | {os.path.basename(STAGING_DIR)}
+    for root, dirs, files in os.walk(image_dir):
+        dirs[:] = sorted(d for d in dirs if d not in skip_dirs)
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in ALLOWED_EXTS:
+                yield os.path.join(root, name)
+
+
+def backfill(image_dir=DEATH_IMAGE_DIR, force=False):
+    """为已有照片补齐展示图 / 缩略图，返回 (处理数, 跳过数, 失败数)"""
+    done = skipped = failed = 0
+    for path in iter_original_images(image_dir):
+        if not force and all(os.path.exists(rendition_path(path, k)) for k in RENDITION_SIZES):
+            skipped += 1
+            continue
+        try:
+            write_renditions(path)
+            done += 1
+        except (OSError, Image.DecompressionBombError) as e:
+            failed += 1
+            print(f"❌ {path}：{e}")
+    return done, skipped, failed
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def migrate_legacy(conn):
+    """把 content_sha256 为空的旧照片迁入内容寻址目录，重复内容只保留一份；返回迁移行数"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, image_path FROM death_image_shiwa
+        WHERE content_sha256 IS NULL AND status = 'ready'
+        ORDER BY id;
+    """)
+    migrated = 0
+    for image_id, old_path in cur.fetchall():
+        if not os.path.exists(old_path):
+            print(f"⚠️ #{image_id} 文件不存在，跳过：{old_path}")
+            continue
+        sha256 = _file_sha256(old_path)
+        size = os.path.getsize(old_path)
+        new_path = object_path(sha256, os.path.splitext(old_path)[1].lower())
+        if not os.path.exists(new_path):
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(old_path, new_path)
+            write_renditions(new_path)
+        cur.execute("""
+            UPDATE death_image_shiwa
+            SET image_path = %s, content_sha256 = %s, size_bytes = %s
+            WHERE id = %s;
+        """, (new_path, sha256, size, image_id))
+        conn.commit()  # 逐行提交：中途失败时已迁移的行不丢
+        migrated += 1
+        # 重复内容的旧文件和旧渲染图不在这里删，交给 gc 统一清理
+    cur.close()
+    return migrated
+
+
+def collect_garbage(conn, image_dir=DEATH_IMAGE_DIR, grace_seconds=GC_GRACE_SECONDS, dry_run=False):
+    """
+    标记-清除：
+    - 标记：death_image_shiwa 里所有 image_path 及其渲染图；未完成的行再加上它的 staging 文件
+      （去重命中已有文件时上传会刷新它的修改时间，提交前的这段空档由宽限期保护）
+    - 清除：目录下其余文件（超过 grace_seconds 未修改的才删，避免误删正在上传的 staging）
+    返回 (删除的文件列表, 释放字节数)
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT image_path, status, staged_path FROM death_image_shiwa;")
+    keep = set()
+    for path, status, staged_path in cur.fetchall():
+        keep.add(os.path.normpath(path))
+        for kind in RENDITION_SIZES:
+            keep.add(os.path.normpath(rendition_path(path, kind)))
+        if status != STATUS_READY:
+            keep.add(os.path.normpath(staged_path or staged_path_for(path)))
+    cur.close()
+
+    now = time.time()
+    removed, freed = [], 0
+    for root, _dirs, files in os.walk(image_dir):
+        for name in files:
+            path = os.path.normpath(os.path.join(root, name))
+            if path in keep:
+                continue
+            stat = os.stat(path)
+            if now - stat.st_mtime < grace_seconds:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed.append(path)
+            freed += stat.st_size
+    return removed, freed
+
+
+def storage_usage_by_month(conn):
+    """
+    按死亡记录月份统计照片存储：
+    照片数 / 引用字节（不去重）/ 实际存储字节（同一文件只算在首次出现的月份）
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        WITH refs AS (
+            SELECT date_trunc('month', sm.moved_at) AS month,
+                   di.content_sha256, di.size_bytes, sm.moved_at
+            FROM death_image_shiwa di
+            JOIN stock_movement_shiwa sm ON sm.id = di.death_movement_id
+        ),
+        firsts AS (
+            SELECT DISTINCT ON (content_sha256) month, size_bytes
+            FROM refs
+            WHERE content_sha256 IS NOT NULL
+            ORDER BY content_sha256, moved_at
+        )
+        SELECT to_char(r.month, 'YYYY-MM') AS month,
+               COUNT(*) AS images,
+               COALESCE(SUM(r.size_bytes), 0) AS referenced_bytes,
+               COALESCE((SELECT SUM(f.size_bytes) FROM firsts f WHERE f.month = r.month), 0) AS stored_bytes
+        FROM refs r
+        GROUP BY r.month
+        ORDER BY r.month DESC;
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def _get_conn():
+    """命令行用：按 .env 里的 DATABASE_SHIWA_URL 连库（与 init_shiwa_db.py 相同）"""
+    import psycopg2
+    from urllib.parse import urlparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_SHIWA_URL")
+    if not db_url:
+        raise RuntimeError("请先 export DATABASE_SHIWA_URL=postgresql://...")
+    url = urlparse(db_url)
+    return psycopg2.connect(host=url.hostname, port=url.port or 5432, database=url.path[1:],
+                            user=url.username, password=url.password)
+
+
+def _format_mb(n):
+    return f"{n / 1024 / 1024:.1f} MB"
+
+
+def main(argv):
+    commands = ("backfill", "migrate", "gc", "report")
+    if not argv or argv[0] not in commands:
+        print(__doc__)
+        return 1
+    if not os.path.isdir(DEATH_IMAGE_DIR):
+        print(f"目录 {DEATH_IMAGE_DIR} 不存在，请在 app.py 所在目录执行")
+        return 1
+    command, args = argv[0], argv[1:]
+
+    if command == "backfill":
+        done, skipped, failed = backfill(force="--force" in args)
+        print(f"✅ 缩略图补齐完成：生成 {done} 张，跳过 {skipped} 张，失败 {failed} 张")
+        return 1 if failed else 0
+
+    conn = _get_conn()
+    try:
+        if command == "migrate":
+            print(f"✅ 已迁移 {migrate_legacy(conn)} 张旧照片，可执行 gc 清理旧文件")
+        elif command == "gc":
+            grace = GC_GRACE_SECONDS
+            if "--grace-hours" in args:
+                grace = float(args[args.index("--grace-hours") + 1]) * 3600
+            dry_run = "--dry-run" in args
+            removed, freed = collect_garbage(conn, grace_seconds=grace, dry_run=dry_run)
+            for path in removed:
+                print(("[dry-run] " if dry_run else "🗑️ ") + path)
+            print(f"✅ {'可' if dry_run else '已'}清理 {len(removed)} 个无引用文件，共 {_format_mb(freed)}")
+        else:
+            print(f"{'月份':<8}{'照片数':>8}{'引用占用':>14}{'实际存储':>14}")
+            for month, images, referenced, stored in storage_usage_by_month(conn):
+                print(f"{month:<10}{images:>8}{_format_mb(referenced):>14}{_format_mb(stored):>14}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
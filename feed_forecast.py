@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 饲料库存预测 / 补货建议
+- 日用量：feed_usage_daily_shiwa，由 feeding_record_shiwa 上的触发器增量维护（init_shiwa_db.py 9.1）
+- 消耗速度：按天的指数加权平均（EWMA），span 7 天看近期、28 天看长期，取两者较大的做计划（宁可早补）
+- 增量：feed_forecast_shiwa 记着每种饲料已累加到哪一天（through_day），每次只把之后的完整天数折进去；
+  补录 / 修改了 through_day 之前的喂养记录时触发器写 dirty_from，这种饲料改为用最近 HISTORY_DAYS 天重算
+- 补货：补货点 = 日用量 ×（到货天数 lead_time_days + SAFETY_DAYS），库存低于补货点时
+  建议补到能用（到货天数 + SAFETY_DAYS + COVER_DAYS）天
+- 页面只读 feed_forecast_shiwa 这张小表
+
+命令行（在 app.py 所在目录执行，读 .env 里的 DATABASE_SHIWA_URL）：
+    python feed_forecast.py refresh     立即刷新一次
+"""
+import sys
+from datetime import date, timedelta
+
+EWMA_SPANS = (7, 28)
+# 从头重算时回看的天数：span 28 的权重衰减到 (1 - 2/29)^140 ≈ 0.00005，更早的数据可以忽略
+HISTORY_DAYS = 140
+SAFETY_DAYS = 3
+COVER_DAYS = 30
+# 日用量低于这个值（kg/天）按"最近没有消耗"处理：EWMA 只会无限趋近 0，不加下限的话可用天数会大到溢出
+MIN_RATE_KG = 0.01
+# 可用天数 / 最晚下单日最多往后算这么多天（days_left 列是 NUMERIC(8,1)）
+MAX_HORIZON_DAYS = 3650
+# pg_try_advisory_xact_lock 的键：多个进程同时触发时只跑一个
+FORECAST_LOCK = 0x5368696666
+
+
+def ewma_fold(value, daily_kg, span):
+    """把按天排好、缺的天已补 0 的用量依次折进 EWMA（alpha = 2 / (span + 1)）"""
+    alpha = 2.0 / (span + 1)
+    for kg in daily_kg:
+        value = alpha * kg + (1 - alpha) * value
+    return value
+
+
+def plan(stock_kg, rate, lead_time_days, today):
+    """由日用量算 (可用天数, 补货点, 最晚下单日, 建议采购量)；没有消耗时只返回补货点 0"""
+    if rate < MIN_RATE_KG:
+        return None, 0.0, None, 0.0
+    reorder_point = rate * (lead_time_days + SAFETY_DAYS)
+    days_left = min(stock_kg / rate, MAX_HORIZON_DAYS)
+    reorder_by = today + timedelta(days=min(MAX_HORIZON_DAYS, max(0, int((stock_kg - reorder_point) / rate))))
+    suggested = 0.0
+    if stock_kg <= reorder_point:
+        suggested = rate * (lead_time_days + SAFETY_DAYS + COVER_DAYS) - stock_kg
+    return round(days_left, 1), round(reorder_point, 2), reorder_by, round(suggested, 2)
+
+
+def refresh(conn, today=None):
+    """折入到昨天为止的用量并重算补货建议，返回更新的饲料种数；别的进程正在跑时返回 0"""
+    from psycopg2.extras import execute_values
+
+    today = today or date.today()
+    through = today - timedelta(days=1)  # 今天还没过完，不计入
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (FORECAST_LOCK,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return 0
+        # 刷新期间挡住触发器写 dirty_from，免得读完用量之后的补录标记被下面的 dirty_from = NULL 覆盖
+        cur.execute("LOCK TABLE feed_forecast_shiwa IN SHARE ROW EXCLUSIVE MODE;")
+        cur.execute("""
+            SELECT f.id, COALESCE(f.stock_kg, 0), f.lead_time_days,
+                   s.through_day, s.dirty_from, s.ewma_7, s.ewma_28
+            FROM feed_type_shiwa f
+            LEFT JOIN feed_forecast_shiwa s ON s.feed_type_id = f.id;
+        """)
+        feeds = cur.fetchall()
+        if not feeds:
+            conn.rollback()
+            return 0
+
+        # 每种饲料从哪天开始折：新饲料 / 有补录的从 HISTORY_DAYS 天前重算，其余接着 through_day
+        starts, rebuild = {}, set()
+        for feed_id, _, _, through_day, dirty_from, _, _ in feeds:
+            if through_day is None or dirty_from is not None:
+                starts[feed_id] = through - timedelta(days=HISTORY_DAYS - 1)
+                rebuild.add(feed_id)
+            else:
+                starts[feed_id] = through_day + timedelta(days=1)
+        cur.execute("""
+            SELECT feed_type_id, day, kg FROM feed_usage_daily_shiwa
+            WHERE day BETWEEN %s AND %s;
+        """, (min(starts.values()), through))
+        usage = {}
+        for feed_id, day, kg in cur.fetchall():
+            usage.setdefault(feed_id, {})[day] = float(kg)
+
+        rows = []
+        for feed_id, stock_kg, lead_time_days, through_day, dirty_from, ewma_7, ewma_28 in feeds:
+            start = starts[feed_id]
+            if feed_id in rebuild:
+                ewma_7 = ewma_28 = 0.0
+            daily = usage.get(feed_id, {})
+            series = [daily.get(start + timedelta(days=i), 0.0) for i in range((through - start).days + 1)]
+            ewma_7 = ewma_fold(ewma_7, series, EWMA_SPANS[0])
+            ewma_28 = ewma_fold(ewma_28, series, EWMA_SPANS[1])
+            days_left, reorder_point, reorder_by, suggested = plan(
+                float(stock_kg), max(ewma_7, ewma_28), lead_time_days, today)
+            rows.append((feed_id, through, ewma_7, ewma_28, stock_kg, days_left,
+                         reorder_point, reorder_by, suggested))
+        execute_values(cur, """
+            INSERT INTO feed_forecast_shiwa
+            (feed_type_id, through_day, ewma_7, ewma_28, stock_kg, days_left,
+             reorder_point_kg, reorder_by, suggested_order_kg)
+            VALUES %s
+            ON CONFLICT (feed_type_id) DO UPDATE
+            SET through_day = EXCLUDED.through_day, dirty_from = NULL,
+                ewma_7 = EXCLUDED.ewma_7, ewma_28 = EXCLUDED.ewma_28,
+                stock_kg = EXCLUDED.stock_kg, days_left = EXCLUDED.days_left,
+                reorder_point_kg = EXCLUDED.reorder_point_kg, reorder_by = EXCLUDED.reorder_by,
+                suggested_order_kg = EXCLUDED.suggested_order_kg, updated_at = NOW();
+        """, rows, page_size=len(rows))
+    conn.commit()
+    return len(rows)
+
+
+def main(argv):
+    if argv != ["refresh"]:
+        print(__doc__)
+        return 1
+    from sensor_ingest import _get_conn
+
+    conn = _get_conn()
+    try:
+        print(f"✅ 刷新完成：{refresh(conn)} 种饲料")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -7,6 +7,7 @@
 - 多次运行安全无害
 """
 import os
+import hashlib
 import psycopg2
 from urllib.parse import urlparse
 from dotenv import load_dotenv
@@ -26,6 +27,122 @@ conn_params = {
     "password": url.password,
 }
 
+# 需要维护数据版本号的表（与 app.py 中的缓存读取函数对应）
+VERSIONED_TABLES = [
+    "pond_shiwa",
+    "feeding_record_shiwa",
+    "stock_movement_shiwa",
+    "sale_record_shiwa",
+    "sale_order_shiwa",
+    "daily_log_shiwa",
+    "customer_shiwa",
+    "feed_type_shiwa",
+    "frog_purchase_type_shiwa",
+    "feed_purchase_record_shiwa",
+    "frog_purchase_record_shiwa",
+    "water_quality_flag_shiwa",
+    "feed_forecast_shiwa",
+]
+# 写入触发器 NOTIFY 的频道名（与 app.py 的 CHANGE_CHANNEL 一致）
+CHANGE_CHANNEL = "shiwa_change"
+# 报表物化视图（与 app.py 的 REPORTING_VIEW_DEPS 一致）：AI 问答和报表页直接查这些视图，
+# 应用端在相关表有写入后 REFRESH ... CONCURRENTLY，并给视图名的版本号 +1
+# 定义的哈希记在视图的 COMMENT 里，改了定义重跑本脚本会自动 DROP 重建
+REPORTING_VIEWS = {
+    "daily_feed_mv": """
+        SELECT fr.fed_at::date AS fed_date,
+               COALESCE(fr.pond_id, 0) AS pond_id,
+               p.name AS pond_name,
+               pt.name AS pond_type,
+               ft.name AS frog_type,
+               COALESCE(fr.feed_type_id, 0) AS feed_type_id,
+               fdt.name AS feed_type,
+               SUM(fr.feed_weight_kg) AS feed_kg,
+               SUM(fr.total_cost) AS feed_cost,
+               COUNT(*) AS feedings
+        FROM feeding_record_shiwa fr
+        LEFT JOIN pond_shiwa p ON fr.pond_id = p.id
+        LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+        LEFT JOIN feed_type_shiwa fdt ON fr.feed_type_id = fdt.id
+        GROUP BY fr.fed_at::date, COALESCE(fr.pond_id, 0), p.name, pt.name, ft.name,
+                 COALESCE(fr.feed_type_id, 0), fdt.name
+    """,
+    "movements_labeled_mv": """
+        SELECT sm.id AS movement_id,
+               sm.movement_type,
+               CASE sm.movement_type
+                   WHEN 'transfer' THEN '转池'
+                   WHEN 'purchase' THEN '外购'
+                   WHEN 'hatch'    THEN '孵化'
+                   WHEN 'sale'     THEN '销售出库'
+                   WHEN 'death'    THEN '死亡'
+               END AS movement_label,
+               sm.from_pond_id,
+               fp.name AS from_pond_name,
+               fpt.name AS from_pond_type,
+               sm.to_pond_id,
+               tp.name AS to_pond_name,
+               tpt.name AS to_pond_type,
+               COALESCE(tft.name, fft.name) AS frog_type,
+               sm.quantity,
+               sm.unit_price,
+               sm.quantity * sm.unit_price AS amount,
+               sm.description,
+               sm.created_by,
+               sm.moved_at,
+               sm.moved_at::date AS moved_date
+        FROM stock_movement_shiwa sm
+        LEFT JOIN pond_shiwa fp ON sm.from_pond_id = fp.id
+        LEFT JOIN pond_type_shiwa fpt ON fp.pond_type_id = fpt.id
+        LEFT JOIN frog_type_shiwa fft ON fp.frog_type_id = fft.id
+        LEFT JOIN pond_shiwa tp ON sm.to_pond_id = tp.id
+        LEFT JOIN pond_type_shiwa tpt ON tp.pond_type_id = tpt.id
+        LEFT JOIN frog_type_shiwa tft ON tp.frog_type_id = tft.id
+    """,
+    "sales_labeled_mv": """
+        SELECT sr.id AS sale_id,
+               sr.sold_at,
+               sr.sold_at::date AS sold_date,
+               sr.pond_id,
+               p.name AS pond_name,
+               pt.name AS pond_type,
+               ft.name AS frog_type,
+               sr.customer_id,
+               c.name AS customer_name,
+               c.type AS customer_type,
+               sr.sale_type,
+               sr.quantity,
+               sr.unit_price,
+               sr.total_amount,
+               sr.weight_jin,
+               sr.sold_by
+        FROM sale_record_shiwa sr
+        LEFT JOIN pond_shiwa p ON sr.pond_id = p.id
+        LEFT JOIN pond_type_shiwa pt ON p.pond_type_id = pt.id
+        LEFT JOIN frog_type_shiwa ft ON p.frog_type_id = ft.id
+        LEFT JOIN customer_shiwa c ON sr.customer_id = c.id
+    """,
+}
+# REFRESH ... CONCURRENTLY 需要的唯一索引
+REPORTING_VIEW_KEYS = {
+    "daily_feed_mv": "fed_date, pond_id, feed_type_id",
+    "movements_labeled_mv": "movement_id",
+    "sales_labeled_mv": "sale_id",
+}
+
+# 已经不用的视图，重跑本脚本时删掉（pond_status_mv：池塘现状要实时，页面和 AI 都直接查 pond_shiwa）
+RETIRED_REPORTING_VIEWS = ["pond_status_mv"]
+
+
+def view_definition_tag(query):
+    """视图定义 → 记在 COMMENT 里的短哈希（忽略空白差异）"""
+    return "def:" + hashlib.sha256(" ".join(query.split()).encode("utf-8")).hexdigest()[:16]
+
+# AI 问答执行 SQL 时切换到的只读角色（与 app.py 的 SHIWA_AI_ROLE 一致），看不到账号表
+AI_DB_ROLE = os.getenv("SHIWA_AI_ROLE", "shiwa_ai_reader")
+AI_HIDDEN_TABLES = ["user_shiwa", "ai_metrics_shiwa"]
+
 def get_conn():
     return psycopg2.connect(**conn_params)
 
@@ -235,7 +352,14 @@ def main():
                 CREATE TABLE IF NOT EXISTS death_image_shiwa (
                     id SERIAL PRIMARY KEY,
                     death_movement_id INTEGER REFERENCES stock_movement_shiwa(id) ON DELETE CASCADE,
-                    image_path TEXT NOT NULL
+                    image_path TEXT NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'ready'
+                        CHECK (status IN ('pending','processing','ready','failed')),
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    content_sha256 CHAR(64),
+                    size_bytes BIGINT,
+                    staged_path TEXT
                 );
             """)
 
@@ -270,6 +394,77 @@ def main():
                 );
             """)
 
+            # ========== 4.1 销售订单（表头）：一单可含多个池塘的明细行（sale_record_shiwa）==========
+            # total_* 在下单事务里由明细汇总写入
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sale_order_shiwa (
+                    id SERIAL PRIMARY KEY,
+                    customer_id INTEGER REFERENCES customer_shiwa(id),
+                    sale_type VARCHAR(20) CHECK (sale_type IN ('零售','批发')),
+                    total_quantity INTEGER NOT NULL DEFAULT 0,
+                    total_weight_jin NUMERIC(12,2),
+                    total_amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+                    note TEXT,
+                    sold_at TIMESTAMP DEFAULT NOW(),
+                    sold_by VARCHAR(50)
+                );
+            """)
+
+            # ========== 4.2 水质异常告警（water_quality.py 增量检测写入）==========
+            # method：self_z 偏离本池近期水平 / peer_iqr 偏离同一天同类型池子；score 为 z 分数或超出 IQR 的倍数
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS water_quality_flag_shiwa (
+                    id BIGSERIAL PRIMARY KEY,
+                    pond_id INTEGER NOT NULL REFERENCES pond_shiwa(id) ON DELETE CASCADE,
+                    log_date DATE NOT NULL,
+                    metric VARCHAR(20) NOT NULL CHECK (metric IN ('water_temp','ph_value','do_value','humidity')),
+                    method VARCHAR(10) NOT NULL CHECK (method IN ('self_z','peer_iqr')),
+                    value NUMERIC(8,2) NOT NULL,
+                    baseline NUMERIC(8,2),
+                    score NUMERIC(8,2) NOT NULL,
+                    created_at TIMESTAMP DEFAULT NOW(),
+                    acknowledged_by VARCHAR(50),
+                    acknowledged_at TIMESTAMP,
+                    UNIQUE (pond_id, log_date, metric, method)
+                );
+            """)
+            # 检测水位线：已检测完的最后一天
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS water_quality_state_shiwa (
+                    name VARCHAR(20) PRIMARY KEY,
+                    last_date DATE NOT NULL
+                );
+            """)
+
+            # ========== 4.3 饲料日用量 + 库存预测（feed_forecast.py 维护）==========
+            # 日用量由 feeding_record_shiwa 上的行级触发器增量维护（见 9.1）
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS feed_usage_daily_shiwa (
+                    feed_type_id INTEGER NOT NULL REFERENCES feed_type_shiwa(id) ON DELETE CASCADE,
+                    day DATE NOT NULL,
+                    kg NUMERIC(12,2) NOT NULL DEFAULT 0,
+                    feedings INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (feed_type_id, day)
+                );
+            """)
+            # 每种饲料一行：EWMA 日用量已累加到 through_day；补录 / 修改了 through_day 之前的记录时
+            # 触发器写 dirty_from，下次刷新从头重算
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS feed_forecast_shiwa (
+                    feed_type_id INTEGER PRIMARY KEY REFERENCES feed_type_shiwa(id) ON DELETE CASCADE,
+                    through_day DATE NOT NULL,
+                    dirty_from DATE,
+                    ewma_7 DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    ewma_28 DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    stock_kg NUMERIC(12,2),
+                    days_left NUMERIC(8,1),
+                    reorder_point_kg NUMERIC(12,2),
+                    reorder_by DATE,
+                    suggested_order_kg NUMERIC(12,2),
+                    updated_at TIMESTAMP DEFAULT NOW()
+                );
+            """)
+
             # ========== 5. 自动修复：检查缺失字段并添加 ==========
             # 5.1 feed_purchase_record_shiwa.notes
             if not column_exists(cur, 'feed_purchase_record_shiwa', 'notes'):
@@ -287,6 +482,72 @@ def main():
                     REFERENCES frog_purchase_type_shiwa(id);
                 """)
 
+            # 5.4 death_image_shiwa 后台处理状态（历史照片都已处理完，默认 ready）
+            if not column_exists(cur, 'death_image_shiwa', 'status'):
+                cur.execute("""
+                    ALTER TABLE death_image_shiwa
+                    ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'ready'
+                    CHECK (status IN ('pending','ready','failed'));
+                """)
+            # processing：已被某个进程认领，claimed_at 超过租约未完成的可被重新认领
+            cur.execute("ALTER TABLE death_image_shiwa DROP CONSTRAINT IF EXISTS death_image_shiwa_status_check;")
+            cur.execute("""
+                ALTER TABLE death_image_shiwa ADD CONSTRAINT death_image_shiwa_status_check
+                CHECK (status IN ('pending','processing','ready','failed'));
+            """)
+            if not column_exists(cur, 'death_image_shiwa', 'claimed_at'):
+                cur.execute("ALTER TABLE death_image_shiwa ADD COLUMN claimed_at TIMESTAMP;")
+            if not column_exists(cur, 'death_image_shiwa', 'attempts'):
+                cur.execute("ALTER TABLE death_image_shiwa ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;")
+            if not column_exists(cur, 'death_image_shiwa', 'error'):
+                cur.execute("ALTER TABLE death_image_shiwa ADD COLUMN error TEXT;")
+
+            # 5.5 death_image_shiwa 内容哈希（旧照片为空，用 death_image_store.py migrate 补齐）
+            if not column_exists(cur, 'death_image_shiwa', 'content_sha256'):
+                cur.execute("ALTER TABLE death_image_shiwa ADD COLUMN content_sha256 CHAR(64);")
+            if not column_exists(cur, 'death_image_shiwa', 'size_bytes'):
+                cur.execute("ALTER TABLE death_image_shiwa ADD COLUMN size_bytes BIGINT;")
+            # 每次上传单独的 staging 文件名（为空的旧行按 staging/<原图文件名> 找）
+            if not column_exists(cur, 'death_image_shiwa', 'staged_path'):
+                cur.execute("ALTER TABLE death_image_shiwa ADD COLUMN staged_path TEXT;")
+
+            # 5.6 sale_record_shiwa.order_id：历史销售每条补一个单行订单，之后按订单分页
+            if not column_exists(cur, 'sale_record_shiwa', 'order_id'):
+                cur.execute("ALTER TABLE sale_record_shiwa ADD COLUMN order_id INTEGER REFERENCES sale_order_shiwa(id);")
+            # 一条语句完成：先给每条销售预取订单号，插入订单头，再按销售 id 回填
+            cur.execute("""
+                WITH src AS (
+                    SELECT id AS sale_id, nextval(pg_get_serial_sequence('sale_order_shiwa', 'id')) AS order_id,
+                           customer_id, sale_type, quantity, weight_jin, total_amount, note, sold_at, sold_by
+                    FROM sale_record_shiwa
+                    WHERE order_id IS NULL
+                ), orders AS (
+                    INSERT INTO sale_order_shiwa
+                    (id, customer_id, sale_type, total_quantity, total_weight_jin, total_amount, note, sold_at, sold_by)
+                    SELECT order_id, customer_id, sale_type, quantity, weight_jin, total_amount, note, sold_at, sold_by
+                    FROM src
+                    RETURNING id
+                )
+                UPDATE sale_record_shiwa s
+                SET order_id = src.order_id
+                FROM src
+                WHERE s.id = src.sale_id;
+            """)
+
+            # 5.7 feed_type_shiwa.lead_time_days：供应商从下单到送达的天数，补货点 = 日用量 ×（到货天数 + 安全天数）
+            if not column_exists(cur, 'feed_type_shiwa', 'lead_time_days'):
+                cur.execute("ALTER TABLE feed_type_shiwa ADD COLUMN lead_time_days INTEGER NOT NULL DEFAULT 7;")
+
+            # 5.8 ai_metrics_shiwa.cache_hit 取值加了 template / followup：老库上的 CHECK 要替换
+            #     （表在第 10 节创建，新库那里已是新约束，这里只处理已存在的表）
+            cur.execute("SELECT to_regclass('ai_metrics_shiwa') IS NOT NULL;")
+            if cur.fetchone()[0]:
+                cur.execute("ALTER TABLE ai_metrics_shiwa DROP CONSTRAINT IF EXISTS ai_metrics_shiwa_cache_hit_check;")
+                cur.execute("""
+                    ALTER TABLE ai_metrics_shiwa ADD CONSTRAINT ai_metrics_shiwa_cache_hit_check
+                    CHECK (cache_hit IN ('sql','answer','template','followup'));
+                """)
+
             # ========== 6. 创建索引 ==========
             indexes = [
                 ("idx_pond_type", "pond_shiwa(pond_type_id)"),
@@ -295,15 +556,45 @@ def main():
                 ("idx_movement_to", "stock_movement_shiwa(to_pond_id)"),
                 ("idx_feed_pond", "feeding_record_shiwa(pond_id)"),
                 ("idx_sale_pond", "sale_record_shiwa(pond_id)"),
+                ("idx_sale_order", "sale_record_shiwa(order_id)"),
+                ("idx_sale_order_time", "sale_order_shiwa(sold_at DESC, id DESC)"),
                 ("idx_daily_pond", "daily_log_shiwa(pond_id)"),
+                ("idx_wq_flag_open", "water_quality_flag_shiwa(log_date DESC) WHERE acknowledged_at IS NULL"),
                 ("idx_feed_purchase_time", "feed_purchase_record_shiwa(purchased_at)"),
                 ("idx_frog_purchase_time", "frog_purchase_record_shiwa(purchased_at)"),
                 ("idx_movement_frog_purchase", "stock_movement_shiwa(frog_purchase_type_id)"),
+                ("idx_death_image_movement", "death_image_shiwa(death_movement_id)"),
+                ("idx_death_image_unfinished", "death_image_shiwa(id) WHERE status <> 'ready'"),
+                ("idx_death_image_sha256", "death_image_shiwa(content_sha256)"),
             ]
             for idx_name, cols in indexes:
                 if not index_exists(cur, idx_name):
                     cur.execute(f"CREATE INDEX {idx_name} ON {cols};")
 
+            # ========== 6.1 选池 / 选客户搜索索引 ==========
+            # 前缀匹配（name LIKE '张%'）走 pattern_ops B-tree，任何 locale 都能用
+            search_indexes = [
+                ("idx_pond_name_prefix", "pond_shiwa(name varchar_pattern_ops)"),
+                ("idx_customer_name_prefix", "customer_shiwa(name varchar_pattern_ops)"),
+                ("idx_customer_phone_prefix", "customer_shiwa(phone varchar_pattern_ops)"),
+            ]
+            # 包含匹配（ILIKE '%3号%'）走 pg_trgm GIN；没有权限装扩展时跳过，搜索仍可用，只是包含匹配要扫表
+            cur.execute("SAVEPOINT trgm;")
+            try:
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+                cur.execute("RELEASE SAVEPOINT trgm;")
+                search_indexes += [
+                    ("idx_pond_name_trgm", "pond_shiwa USING gin (name gin_trgm_ops)"),
+                    ("idx_customer_name_trgm", "customer_shiwa USING gin (name gin_trgm_ops)"),
+                    ("idx_customer_phone_trgm", "customer_shiwa USING gin (phone gin_trgm_ops)"),
+                ]
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT trgm;")
+                print(f"⚠️ 无法启用 pg_trgm，跳过包含匹配索引：{e}")
+            for idx_name, cols in search_indexes:
+                if not index_exists(cur, idx_name):
+                    cur.execute(f"CREATE INDEX {idx_name} ON {cols};")
+
             # ========== 7. 创建视图 ==========
             cur.execute("""
                 CREATE OR REPLACE VIEW pond_reminder_v AS
@@ -328,6 +619,204 @@ def main():
                 WHERE p.current_count > 0;
             """)
 
+            # 7.1 报表物化视图：COMMENT 里的定义哈希对不上（定义改过 / 旧版本建的）就 DROP 重建
+            for view in RETIRED_REPORTING_VIEWS:
+                cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view};")
+            for view, query in REPORTING_VIEWS.items():
+                tag = view_definition_tag(query)
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL, obj_description(to_regclass(%s), 'pg_class');",
+                            (view, view))
+                exists, current = cur.fetchone()
+                if current != tag:
+                    if exists:
+                        print(f"🔁 视图 {view} 定义有变化，重建")
+                    cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view};")
+                    cur.execute(f"CREATE MATERIALIZED VIEW {view} AS {query};")
+                    cur.execute(f"COMMENT ON MATERIALIZED VIEW {view} IS %s;", (tag,))
+                cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{view} ON {view}({REPORTING_VIEW_KEYS[view]});")
+
+            # ========== 8. 数据版本计数器（缓存失效用）==========
+            # 每张表一行 version，语句级触发器在任何写入后 +1；
+            # 应用端每次 rerun 只读这一张小表，版本号进缓存键，数据没变就命中缓存
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS data_version_shiwa (
+                    table_name VARCHAR(64) PRIMARY KEY,
+                    version BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT NOW()
+                );
+            """)
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION bump_data_version_shiwa() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO data_version_shiwa (table_name, version, updated_at)
+                    VALUES (TG_TABLE_NAME, 1, NOW())
+                    ON CONFLICT (table_name) DO UPDATE
+                    SET version = data_version_shiwa.version + 1,
+                        updated_at = NOW();
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            # 物化视图没有触发器，版本号由应用端 REFRESH 后 +1
+            cur.execute("DELETE FROM data_version_shiwa WHERE table_name = ANY(%s);", (RETIRED_REPORTING_VIEWS,))
+            for view in REPORTING_VIEWS:
+                cur.execute(
+                    "INSERT INTO data_version_shiwa (table_name) VALUES (%s) ON CONFLICT DO NOTHING;",
+                    (view,)
+                )
+            for table in VERSIONED_TABLES:
+                cur.execute(
+                    "INSERT INTO data_version_shiwa (table_name) VALUES (%s) ON CONFLICT DO NOTHING;",
+                    (table,)
+                )
+                cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_version ON {table};")
+                cur.execute(f"""
+                    CREATE TRIGGER trg_{table}_version
+                    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version_shiwa();
+                """)
+
+            # ========== 9. 变更通知（LISTEN/NOTIFY，多进程缓存失效）==========
+            # 行级触发器发送 {"table": ..., "pond_id": ...}；同一事务内相同 payload 会被 PG 自动合并
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION notify_change_shiwa() RETURNS trigger AS $$
+                DECLARE
+                    row_json JSONB;
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        row_json := to_jsonb(OLD);
+                    ELSE
+                        row_json := to_jsonb(NEW);
+                    END IF;
+                    IF TG_TABLE_NAME = 'pond_shiwa' THEN
+                        PERFORM pg_notify('{CHANGE_CHANNEL}', json_build_object(
+                            'table', TG_TABLE_NAME, 'pond_id', row_json->'id')::text);
+                    ELSIF TG_TABLE_NAME = 'stock_movement_shiwa' THEN
+                        PERFORM pg_notify('{CHANGE_CHANNEL}', json_build_object(
+                            'table', TG_TABLE_NAME, 'pond_id', row_json->'from_pond_id')::text);
+                        PERFORM pg_notify('{CHANGE_CHANNEL}', json_build_object(
+                            'table', TG_TABLE_NAME, 'pond_id', row_json->'to_pond_id')::text);
+                    ELSE
+                        PERFORM pg_notify('{CHANGE_CHANNEL}', json_build_object(
+                            'table', TG_TABLE_NAME, 'pond_id', row_json->'pond_id')::text);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            for table in VERSIONED_TABLES:
+                cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_notify ON {table};")
+                cur.execute(f"""
+                    CREATE TRIGGER trg_{table}_notify
+                    AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION notify_change_shiwa();
+                """)
+
+            # ========== 9.1 饲料日用量增量汇总 ==========
+            # 每条喂养记录写入 / 修改 / 删除时调整当天的合计，预测不用再扫全部喂养记录
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION feed_usage_daily_apply_shiwa() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.feed_type_id IS NOT NULL THEN
+                        UPDATE feed_usage_daily_shiwa
+                        SET kg = kg - OLD.feed_weight_kg, feedings = feedings - 1
+                        WHERE feed_type_id = OLD.feed_type_id AND day = OLD.fed_at::date;
+                        UPDATE feed_forecast_shiwa SET dirty_from = LEAST(dirty_from, OLD.fed_at::date)
+                        WHERE feed_type_id = OLD.feed_type_id AND OLD.fed_at::date <= through_day;
+                    END IF;
+                    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.feed_type_id IS NOT NULL THEN
+                        INSERT INTO feed_usage_daily_shiwa (feed_type_id, day, kg, feedings)
+                        VALUES (NEW.feed_type_id, NEW.fed_at::date, NEW.feed_weight_kg, 1)
+                        ON CONFLICT (feed_type_id, day) DO UPDATE
+                        SET kg = feed_usage_daily_shiwa.kg + EXCLUDED.kg,
+                            feedings = feed_usage_daily_shiwa.feedings + 1;
+                        UPDATE feed_forecast_shiwa SET dirty_from = LEAST(dirty_from, NEW.fed_at::date)
+                        WHERE feed_type_id = NEW.feed_type_id AND NEW.fed_at::date <= through_day;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS trg_feeding_record_usage ON feeding_record_shiwa;")
+            cur.execute("""
+                CREATE TRIGGER trg_feeding_record_usage
+                AFTER INSERT OR UPDATE OR DELETE ON feeding_record_shiwa
+                FOR EACH ROW EXECUTE FUNCTION feed_usage_daily_apply_shiwa();
+            """)
+            # 每次初始化都按喂养记录重建一次（同一事务内，TRUNCATE 期间的新写入会等待），预测全部重算
+            cur.execute("TRUNCATE feed_usage_daily_shiwa;")
+            cur.execute("""
+                INSERT INTO feed_usage_daily_shiwa (feed_type_id, day, kg, feedings)
+                SELECT feed_type_id, fed_at::date, SUM(feed_weight_kg), COUNT(*)
+                FROM feeding_record_shiwa
+                WHERE feed_type_id IS NOT NULL
+                GROUP BY feed_type_id, fed_at::date;
+            """)
+            cur.execute("UPDATE feed_forecast_shiwa SET dirty_from = through_day;")
+
+            # ========== 10. AI 问答耗时统计 ==========
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ai_metrics_shiwa (
+                    id BIGSERIAL PRIMARY KEY,
+                    asked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    question TEXT NOT NULL,
+                    llm1_ms INTEGER,
+                    sql_ms INTEGER,
+                    llm2_first_ms INTEGER,
+                    llm2_ms INTEGER,
+                    total_ms INTEGER NOT NULL,
+                    row_count INTEGER,
+                    cache_hit VARCHAR(10) CHECK (cache_hit IN ('sql','answer','template','followup')),
+                    error TEXT
+                );
+            """)
+            if not index_exists(cur, "idx_ai_metrics_time"):
+                cur.execute("CREATE INDEX idx_ai_metrics_time ON ai_metrics_shiwa(asked_at);")
+
+            # ========== 10.1 水质探头读数（sensor_ingest.py 写入）==========
+            # 原始读数只追加、不建主键，按时间 BRIN 索引；metric：1 水温 / 2 pH / 3 溶氧（与 sensor_ingest.METRICS 一致）
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sensor_reading_shiwa (
+                    pond_id INTEGER NOT NULL,
+                    metric SMALLINT NOT NULL,
+                    value REAL NOT NULL,
+                    read_at TIMESTAMP NOT NULL
+                );
+            """)
+            if not index_exists(cur, "idx_sensor_reading_time"):
+                cur.execute("CREATE INDEX idx_sensor_reading_time ON sensor_reading_shiwa USING brin (read_at);")
+            for rollup_table, bucket in (("sensor_hourly_shiwa", "hour TIMESTAMP"), ("sensor_daily_shiwa", "day DATE")):
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {rollup_table} (
+                        pond_id INTEGER NOT NULL,
+                        metric SMALLINT NOT NULL,
+                        {bucket} NOT NULL,
+                        n INTEGER NOT NULL,
+                        min_value REAL,
+                        max_value REAL,
+                        avg_value DOUBLE PRECISION,
+                        PRIMARY KEY (pond_id, metric, {bucket.split()[0]})
+                    );
+                """)
+            # 汇总水位线：已汇总到的最后一个小时
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sensor_rollup_state_shiwa (
+                    name VARCHAR(20) PRIMARY KEY,
+                    last_hour TIMESTAMP NOT NULL
+                );
+            """)
+
+            # ========== 11. AI 问答只读角色 ==========
+            # NOLOGIN 角色，应用账号通过 SET LOCAL ROLE 临时切换；新建表后重跑本脚本即可补授权
+            cur.execute("SELECT 1 FROM pg_roles WHERE rolname = %s;", (AI_DB_ROLE,))
+            if cur.fetchone() is None:
+                cur.execute(f'CREATE ROLE "{AI_DB_ROLE}" NOLOGIN;')
+            cur.execute(f'GRANT "{AI_DB_ROLE}" TO CURRENT_USER;')
+            cur.execute(f'GRANT USAGE ON SCHEMA public TO "{AI_DB_ROLE}";')
+            cur.execute(f'GRANT SELECT ON ALL TABLES IN SCHEMA public TO "{AI_DB_ROLE}";')
+            for table in AI_HIDDEN_TABLES:
+                cur.execute(f'REVOKE ALL ON {table} FROM "{AI_DB_ROLE}";')
+
         conn.commit()
 
     print("✅ 中益石蛙基地数据库已初始化或自动修复完成！")
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 跨进程结果缓存
+- st.cache_data 只在单个进程内有效，多开 Streamlit 进程时每个进程都要重算一遍报表
+- 这里提供可插拔的缓存后端，默认是本机 SQLite 文件，同一台机器上的所有进程共享
+- 支持：容量上限 + LRU 淘汰、TTL、pickle / Arrow IPC 两种序列化、按数据版本号失效、按 namespace 的命中统计
+
+环境变量：
+    SHIWA_RESULT_CACHE           sqlite（默认）| none
+    SHIWA_RESULT_CACHE_PATH      缓存文件路径，默认 .cache/shiwa_result_cache.sqlite
+    SHIWA_RESULT_CACHE_MAX_MB    缓存总容量上限（MB），默认 256
+"""
+import os
+import io
+import time
+import pickle
+import sqlite3
+import hashlib
+from contextlib import closing
+
+try:
+    import pyarrow as pa
+    import pandas as pd
+except ImportError:  # 没装 pyarrow 时 DataFrame 也走 pickle
+    pa = None
+
+FMT_PICKLE = "pickle"
+FMT_ARROW = "arrow"
+
+
+def _serialize(value):
+    """DataFrame 优先用 Arrow IPC（跨版本稳定、读取快），其余用 pickle"""
+    if pa is not None and isinstance(value, pd.DataFrame):
+        try:
+            table = pa.Table.from_pandas(value)
+            sink = io.BytesIO()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return FMT_ARROW, sink.getvalue()
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass  # 混合类型列等 Arrow 不支持的情况
+    return FMT_PICKLE, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _deserialize(fmt, payload):
+    if fmt == FMT_ARROW:
+        return pa.ipc.open_stream(io.BytesIO(payload)).read_all().to_pandas()
+    return pickle.loads(payload)
+
+
+def make_key(namespace, version, args=()):
+    raw = repr((namespace, version, args)).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class ResultCache:
+    """缓存后端接口；NullResultCache 即"不缓存"，方便单机调试时关闭"""
+
+    def get(self, namespace, version, args=()):
+        """返回 (hit, value)"""
+        return False, None
+
+    def set(self, namespace, version, value, args=(), ttl=None):
+        pass
+
+    def purge(self, namespace=None):
+        pass
+
+    def stats(self):
+        return {}
+
+    def get_or_compute(self, namespace, version, compute, args=(), ttl=None):
+        hit, value = self.get(namespace, version, args)
+        if hit:
+            return value
+        value = compute(*args)
+        self.set(namespace, version, value, args=args, ttl=ttl)
+        return value
+
+
+NullResultCache = ResultCache
+
+
+class SQLiteResultCache(ResultCache):
+    """本机 SQLite 文件缓存（WAL 模式，多进程并发读写安全）"""
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    key TEXT PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    fmt TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL,
+                    last_access REAL NOT NULL
+                );
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_lru ON result_cache(last_access);")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_ns ON result_cache(namespace, version);")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache_stats (
+                    namespace TEXT PRIMARY KEY,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0
+                );
+            """)
+
+    def _connect(self):
+        # 自动提交模式，需要事务的地方显式 BEGIN；用 closing 保证连接关闭
+        return closing(sqlite3.connect(self.path, timeout=5, isolation_level=None))
+
+    def get(self, namespace, version, args=()):
+        key = make_key(namespace, version, args)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT fmt, payload, expires_at FROM result_cache WHERE key = ?;", (key,)
+                ).fetchone()
+                if row is None:
+                    self._count(conn, namespace, hit=False)
+                    return False, None
+                fmt, payload, expires_at = row
+                if expires_at is not None and expires_at < now:
+                    conn.execute("DELETE FROM result_cache WHERE key = ?;", (key,))
+                    self._count(conn, namespace, hit=False)
+                    return False, None
+                conn.execute("UPDATE result_cache SET last_access = ? WHERE key = ?;", (now, key))
+                self._count(conn, namespace, hit=True)
+            return True, _deserialize(fmt, payload)
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError) as e:
+            # 缓存坏了不影响业务，按未命中处理
+            print(f"[result-cache] 读取失败，按未命中处理：{e}")
+            return False, None
+
+    def set(self, namespace, version, value, args=(), ttl=None):
+        key = make_key(namespace, version, args)
+        fmt, payload = _serialize(value)
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        version = repr(version)
+        try:
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE;")
+                # 同一 namespace 的旧版本永远不会再命中，直接删掉
+                conn.execute(
+                    "DELETE FROM result_cache WHERE namespace = ? AND version <> ?;",
+                    (namespace, version)
+                )
+                conn.execute("""
+                    INSERT OR REPLACE INTO result_cache
+                    (key, namespace, version, fmt, payload, size, created_at, expires_at, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+                """, (key, namespace, version, fmt, payload, len(payload), now, expires_at, now))
+                self._evict(conn, now)
+                conn.execute("COMMIT;")
+        except sqlite3.Error as e:
+            print(f"[result-cache] 写入失败，忽略：{e}")
+
+    @staticmethod
+    def _count(conn, namespace, hit):
+        """命中 / 未命中计数（所有进程累计）"""
+        column = "hits" if hit else "misses"
+        conn.execute(f"""
+            INSERT INTO result_cache_stats (namespace, {column}) VALUES (?, 1)
+            ON CONFLICT(namespace) DO UPDATE SET {column} = {column} + 1;
+        """, (namespace,))
+
+    def _evict(self, conn, now):
+        """先清过期，再按 last_access 从旧到新淘汰，直到总大小低于上限"""
+        conn.execute("DELETE FROM result_cache WHERE expires_at IS NOT NULL AND expires_at < ?;", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache;").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+            "SELECT key, size FROM result_cache ORDER BY last_access ASC;"
+        ).fetchall():
+            conn.execute("DELETE FROM result_cache WHERE key = ?;", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def purge(self, namespace=None):
+        with self._connect() as conn:
+            if namespace is None:
+                conn.execute("DELETE FROM result_cache;")
+                conn.execute("DELETE FROM result_cache_stats;")
+            else:
+                conn.execute("DELETE FROM result_cache WHERE namespace = ?;", (namespace,))
+                conn.execute("DELETE FROM result_cache_stats WHERE namespace = ?;", (namespace,))
+
+    def stats(self):
+        """{namespace: {entries, bytes, hits, misses}}"""
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT s.namespace, COUNT(c.key), COALESCE(SUM(c.size), 0), s.hits, s.misses
+                FROM result_cache_stats s
+                LEFT JOIN result_cache c ON c.namespace = s.namespace
+                GROUP BY s.namespace
+                UNION ALL
+                SELECT c.namespace, COUNT(*), COALESCE(SUM(c.size), 0), 0, 0
+                FROM result_cache c
+                WHERE c.namespace NOT IN (SELECT namespace FROM result_cache_stats)
+                GROUP BY c.namespace
+                ORDER BY 1;
+            """).fetchall()
+        return {ns: {"entries": n, "bytes": size, "hits": hits, "misses": misses}
+                for ns, n, size, hits, misses in rows}
+
+
+def build_result_cache():
+    """按环境变量创建缓存后端"""
+    backend = os.getenv("SHIWA_RESULT_CACHE", "sqlite").lower()
+    if backend == "none":
+        return NullResultCache()
+    if backend != "sqlite":
+        raise RuntimeError(f"不支持的 SHIWA_RESULT_CACHE：{backend}（可选 sqlite / none）")
+    path = os.getenv("SHIWA_RESULT_CACHE_PATH", os.path.join(".cache", "shiwa_result_cache.sqlite"))
+    max_mb = float(os.getenv("SHIWA_RESULT_CACHE_MAX_MB", "256"))
+    return SQLiteResultCache(path, max_bytes=int(max_mb * 1024 * 1024))
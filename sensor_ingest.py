@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 水质探头数据接入
+- 探头每分钟上报水温 / pH / 溶氧，写入只追加的 sensor_reading_shiwa（一行 4 列，不建主键）
+- 上报先进内存缓冲，攒够一批或超过 1 秒就用一次 COPY 写库，单核每秒可接收上千条
+- 两种接入方式：
+    HTTP：POST /readings，JSON 数组 [{"pond_id": 3, "metric": "temp", "value": 21.5, "ts": "2025-05-01T08:00:00"}]
+          或 CSV 文本（pond_id,metric,value,ts 每行一条），返回 202 和接收 / 丢弃条数；
+          默认只监听 127.0.0.1，设置了 SHIWA_SENSOR_TOKEN 时请求须带 Authorization: Bearer <token>，
+          要监听其他地址（--host 0.0.0.0）必须先设置 token
+    目录：把 CSV 文件放进投递目录，处理完移到 done/（格式同上，可带表头）；
+          请先写成 *.tmp 再改名为 *.csv，直接写 .csv 的要等文件 WATCH_SETTLE_SECONDS 秒不再变化才导入
+- 汇总：按小时、按天保存每池每项指标的 条数 / 最小 / 最大 / 平均，并把日平均写进 daily_log_shiwa
+  （手工录入过的字段不覆盖，只补空缺；传感器自己写的行每次汇总都更新）
+
+命令行（在 app.py 所在目录执行，读 .env 里的 DATABASE_SHIWA_URL）：
+    python sensor_ingest.py serve [--port 8765] [--host 127.0.0.1]   启动 HTTP 接入（同时每 5 分钟汇总一次）
+    python sensor_ingest.py watch DIR               监视 CSV 投递目录（同时每 5 分钟汇总一次）
+    python sensor_ingest.py rollup                  立即汇总一次
+"""
+import os
+import io
+import sys
+import csv
+import hmac
+import json
+import time
+import threading
+from datetime import datetime
+
+# 指标编号（与 init_shiwa_db.py 的 SENSOR_METRICS 一致）→ (daily_log_shiwa 字段, 合理范围)
+METRICS = {"temp": 1, "ph": 2, "do": 3}
+METRIC_RANGES = {1: (-5.0, 50.0), 2: (0.0, 14.0), 3: (0.0, 30.0)}
+DAILY_LOG_COLUMNS = {1: "water_temp", 2: "ph_value", 3: "do_value"}
+SENSOR_RECORDED_BY = "传感器"
+
+FLUSH_ROWS = int(os.getenv("SHIWA_SENSOR_FLUSH_ROWS", "500"))
+FLUSH_SECONDS = float(os.getenv("SHIWA_SENSOR_FLUSH_SECONDS", "1"))
+ROLLUP_SECONDS = int(os.getenv("SHIWA_SENSOR_ROLLUP_SECONDS", "300"))
+# 迟到的数据：每次汇总从水位线往前再重算这么多小时
+ROLLUP_LOOKBACK_HOURS = int(os.getenv("SHIWA_SENSOR_ROLLUP_LOOKBACK_HOURS", "2"))
+WATCH_POLL_SECONDS = 2
+# 直接写 .csv 的文件最后一次修改后要等这么久才导入，避免读到写了一半的文件
+WATCH_SETTLE_SECONDS = float(os.getenv("SHIWA_SENSOR_WATCH_SETTLE_SECONDS", "5"))
+SENSOR_TOKEN = os.getenv("SHIWA_SENSOR_TOKEN", "")
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+def parse_reading(pond_id, metric, value, ts=None):
+    """返回 (pond_id, 指标编号, 数值, 时间) 或 None（格式不对 / 超出合理范围）"""
+    try:
+        metric_id = METRICS[str(metric).strip().lower()]
+        value = float(value)
+        pond_id = int(pond_id)
+        read_at = datetime.fromisoformat(str(ts).strip()) if ts not in (None, "") else datetime.now()
+    except (KeyError, ValueError, TypeError):
+        return None
+    low, high = METRIC_RANGES[metric_id]
+    if not low <= value <= high:
+        return None
+    if read_at.tzinfo is not None:
+        # 带时区的时间（如 ...Z）先换算成本机时间，库里按本地时间存、按本地小时 / 天汇总
+        read_at = read_at.astimezone().replace(tzinfo=None)
+    return pond_id, metric_id, value, read_at
+
+
+def parse_csv_lines(lines):
+    """pond_id,metric,value[,ts]，表头行和坏行跳过；返回 (有效读数列表, 丢弃条数)"""
+    readings, rejected = [], 0
+    for row in csv.reader(lines):
+        if not row or row[0].strip().lower() == "pond_id":
+            continue
+        reading = parse_reading(*row[:4]) if len(row) >= 3 else None
+        if reading is None:
+            rejected += 1
+        else:
+            readings.append(reading)
+    return readings, rejected
+
+
+class ReadingBuffer:
+    """
+    接入线程只往列表里 append；攒够 FLUSH_ROWS 条或距上次写库超过 FLUSH_SECONDS 秒时，
+    由后台线程用一次 COPY 写入。写库失败时数据放回缓冲下次重试。
+    """
+
+    def __init__(self, conn_factory, flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS):
+        self.conn_factory = conn_factory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.pending = []
+        self.wake = threading.Event()
+        self.stop = threading.Event()
+        self.written = 0
+        self.conn = None
+        self.thread = threading.Thread(target=self._loop, daemon=True, name="sensor-copy")
+        self.thread.start()
+
+    def add(self, readings):
+        with self.lock:
+            self.pending.extend(readings)
+            full = len(self.pending) >= self.flush_rows
+        if full:
+            self.wake.set()
+
+    def close(self):
+        self.stop.set()
+        self.wake.set()
+        self.thread.join()
+
+    def _loop(self):
+        while True:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+            if self.stop.is_set():
+                self.flush()
+                break
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        buf = io.StringIO()
+        for pond_id, metric_id, value, read_at in batch:
+            buf.write(f"{pond_id}\t{metric_id}\t{value}\t{read_at.isoformat(sep=' ')}\n")
+        buf.seek(0)
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = self.conn_factory()
+            with self.conn.cursor() as cur:
+                cur.copy_expert("COPY sensor_reading_shiwa (pond_id, metric, value, read_at) FROM STDIN", buf)
+            self.conn.commit()
+            self.written += len(batch)
+        except Exception as e:
+            print(f"[sensor] COPY 失败，{len(batch)} 条稍后重试：{e}")
+            if self.conn is not None and not self.conn.closed:
+                self.conn.rollback()
+            with self.lock:
+                self.pending[:0] = batch
+            time.sleep(self.flush_seconds)
+
+
+def rollup(conn, lookback_hours=ROLLUP_LOOKBACK_HOURS):
+    """
+    从水位线往前 lookback_hours 小时开始重算小时汇总，再重算受影响日期的日汇总，
+    最后把日平均写进 daily_log_shiwa。返回 (重算的小时数, 重算的天数)。
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT last_hour FROM sensor_rollup_state_shiwa WHERE name = 'hourly';")
+        row = cur.fetchone()
+        cur.execute("SELECT date_trunc('hour', MIN(read_at)), date_trunc('hour', MAX(read_at)) FROM sensor_reading_shiwa"
+                    + (" WHERE read_at >= %s - make_interval(hours => %s);" if row else ";"),
+                    (row[0], lookback_hours) if row else None)
+        start_hour, end_hour = cur.fetchone()
+        if start_hour is None:
+            return 0, 0
+
+        cur.execute("""
+            INSERT INTO sensor_hourly_shiwa (pond_id, metric, hour, n, min_value, max_value, avg_value)
+            SELECT pond_id, metric, date_trunc('hour', read_at), COUNT(*), MIN(value), MAX(value), AVG(value)
+            FROM sensor_reading_shiwa
+            WHERE read_at >= %s
+            GROUP BY 1, 2, 3
+            ON CONFLICT (pond_id, metric, hour) DO UPDATE
+            SET n = EXCLUDED.n, min_value = EXCLUDED.min_value,
+                max_value = EXCLUDED.max_value, avg_value = EXCLUDED.avg_value;
+        """, (start_hour,))
+        hours = cur.rowcount
+
+        # 日汇总由小时汇总加权得到，只重算涉及的日期
+        cur.execute("""
+            INSERT INTO sensor_daily_shiwa (pond_id, metric, day, n, min_value, max_value, avg_value)
+            SELECT pond_id, metric, hour::date, SUM(n), MIN(min_value), MAX(max_value),
+                   SUM(avg_value * n) / SUM(n)
+            FROM sensor_hourly_shiwa
+            WHERE hour >= date_trunc('day', %s::timestamp)
+            GROUP BY 1, 2, 3
+            ON CONFLICT (pond_id, metric, day) DO UPDATE
+            SET n = EXCLUDED.n, min_value = EXCLUDED.min_value,
+                max_value = EXCLUDED.max_value, avg_value = EXCLUDED.avg_value;
+        """, (start_hour,))
+        days = cur.rowcount
+
+        # 手工录入的字段保留，只补空缺；传感器自己写的行每次都用最新日平均覆盖
+        fill = ",\n".join(
+            f"{col} = CASE WHEN daily_log_shiwa.recorded_by = %(by)s "
+            f"THEN COALESCE(EXCLUDED.{col}, daily_log_shiwa.{col}) "
+            f"ELSE COALESCE(daily_log_shiwa.{col}, EXCLUDED.{col}) END"
+            for col in DAILY_LOG_COLUMNS.values())
+        pivot = ", ".join(f"ROUND(AVG(avg_value) FILTER (WHERE metric = {m})::numeric, 2)"
+                          for m in DAILY_LOG_COLUMNS)
+        cur.execute(f"""
+            INSERT INTO daily_log_shiwa (pond_id, log_date, {', '.join(DAILY_LOG_COLUMNS.values())},
+                                         recorded_by, created_at, updated_at)
+            SELECT d.pond_id, d.day, {pivot}, %(by)s, NOW(), NOW()
+            FROM sensor_daily_shiwa d
+            JOIN pond_shiwa p ON p.id = d.pond_id
+            WHERE d.day >= %(start)s::date
+            GROUP BY d.pond_id, d.day
+            ON CONFLICT (pond_id, log_date) DO UPDATE SET
+            {fill},
+            updated_at = NOW();
+        """, {"by": SENSOR_RECORDED_BY, "start": start_hour})
+
+        cur.execute("""
+            INSERT INTO sensor_rollup_state_shiwa (name, last_hour) VALUES ('hourly', %s)
+            ON CONFLICT (name) DO UPDATE SET last_hour = GREATEST(sensor_rollup_state_shiwa.last_hour, EXCLUDED.last_hour);
+        """, (end_hour,))
+    conn.commit()
+    return hours, days
+
+
+def _rollup_loop(conn_factory, stop):
+    while not stop.wait(ROLLUP_SECONDS):
+        conn = conn_factory()
+        try:
+            hours, days = rollup(conn)
+            print(f"[sensor] 汇总完成：{hours} 个小时、{days} 个池·日")
+        except Exception as e:
+            print(f"[sensor] 汇总失败：{e}")
+        finally:
+            conn.close()
+
+
+def start_rollup_thread(conn_factory):
+    stop = threading.Event()
+    threading.Thread(target=_rollup_loop, args=(conn_factory, stop), daemon=True, name="sensor-rollup").start()
+    return stop
+
+
+def make_app(buffer, token=SENSOR_TOKEN):
+    """Tornado 应用：POST /readings（JSON 或 CSV），GET /health；token 非空时 POST 须带 Bearer token"""
+    import tornado.web
+
+    class ReadingsHandler(tornado.web.RequestHandler):
+        def post(self):
+            if token:
+                supplied = self.request.headers.get("Authorization", "")
+                if not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+                    raise tornado.web.HTTPError(401, "token 无效")
+            body = self.request.body.decode("utf-8", errors="replace")
+            if "json" in self.request.headers.get("Content-Type", ""):
+                try:
+                    items = json.loads(body)
+                except ValueError:
+                    raise tornado.web.HTTPError(400, "JSON 格式错误")
+                if isinstance(items, dict):
+                    items = [items]
+                if not isinstance(items, list):
+                    raise tornado.web.HTTPError(400, "JSON 须为对象或数组")
+                readings = [parse_reading(i.get("pond_id"), i.get("metric"), i.get("value"), i.get("ts"))
+                            for i in items if isinstance(i, dict)]
+                rejected = len(items) - sum(1 for r in readings if r is not None)
+                readings = [r for r in readings if r is not None]
+            else:
+                readings, rejected = parse_csv_lines(body.splitlines())
+            buffer.add(readings)
+            self.set_status(202)
+            self.write({"accepted": len(readings), "rejected": rejected})
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            with buffer.lock:
+                pending = len(buffer.pending)
+            self.write({"pending": pending, "written": buffer.written})
+
+    return tornado.web.Application([(r"/readings", ReadingsHandler), (r"/health", HealthHandler)])
+
+
+def serve(port, conn_factory, host="127.0.0.1"):
+    import tornado.ioloop
+
+    if host not in LOOPBACK_HOSTS and not SENSOR_TOKEN:
+        raise RuntimeError(f"监听 {host} 前请先设置 SHIWA_SENSOR_TOKEN，否则任何人都能写入读数")
+    buffer = ReadingBuffer(conn_factory)
+    stop_rollup = start_rollup_thread(conn_factory)
+    make_app(buffer).listen(port, address=host)
+    print(f"[sensor] HTTP 接入已启动：POST http://{host}:{port}/readings"
+          + ("（需 token）" if SENSOR_TOKEN else ""))
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_rollup.set()
+        buffer.close()
+
+
+def watch(folder, conn_factory):
+    """轮询投递目录：*.csv 不再变化后读完交给缓冲，确认写库后移到 done/（*.tmp 等其他文件不管）"""
+    done_dir = os.path.join(folder, "done")
+    os.makedirs(done_dir, exist_ok=True)
+    buffer = ReadingBuffer(conn_factory)
+    stop_rollup = start_rollup_thread(conn_factory)
+    print(f"[sensor] 正在监视 {folder}（处理完的文件移到 {done_dir}）")
+    try:
+        while True:
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                if not name.lower().endswith(".csv") or not os.path.isfile(path):
+                    continue
+                if time.time() - os.path.getmtime(path) < WATCH_SETTLE_SECONDS:
+                    continue  # 可能还在写，下一轮再看
+                with open(path, encoding="utf-8-sig", newline="") as f:
+                    readings, rejected = parse_csv_lines(f)
+                # 写库确认后再移走，进程中途退出时文件还在，重启后会重新导入；
+                # 目标值要在 add() 之前取，否则后台线程先写完这一批会让目标多算一批、永远等不到
+                target = buffer.written + len(readings)
+                buffer.add(readings)
+                buffer.wake.set()
+                while buffer.written < target:
+                    time.sleep(0.05)
+                os.replace(path, os.path.join(done_dir, name))
+                print(f"[sensor] {name}：导入 {len(readings)} 条，丢弃 {rejected} 条")
+            time.sleep(WATCH_POLL_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_rollup.set()
+        buffer.close()
+
+
+def _get_conn():
+    """命令行用：按 .env 里的 DATABASE_SHIWA_URL 连库（与 init_shiwa_db.py 相同）"""
+    import psycopg2
+    from urllib.parse import urlparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_SHIWA_URL")
+    if not db_url:
+        raise RuntimeError("请先 export DATABASE_SHIWA_URL=postgresql://...")
+    url = urlparse(db_url)
+    return psycopg2.connect(host=url.hostname, port=url.port or 5432, database=url.path[1:],
+                            user=url.username, password=url.password)
+
+
+def main(argv):
+    commands = ("serve", "watch", "rollup")
+    if not argv or argv[0] not in commands:
+        print(__doc__)
+        return 1
+    command, args = argv[0], argv[1:]
+
+    if command == "serve":
+        port = int(args[args.index("--port") + 1]) if "--port" in args else 8765
+        host = args[args.index("--host") + 1] if "--host" in args else "127.0.0.1"
+        if host not in LOOPBACK_HOSTS and not SENSOR_TOKEN:
+            print(f"监听 {host} 前请先设置 SHIWA_SENSOR_TOKEN")
+            return 1
+        serve(port, _get_conn, host)
+    elif command == "watch":
+        if not args or not os.path.isdir(args[0]):
+            print("请指定已存在的投递目录：python sensor_ingest.py watch DIR")
+            return 1
+        watch(args[0], _get_conn)
+    else:
+        conn = _get_conn()
+        try:
+            hours, days = rollup(conn)
+            print(f"✅ 汇总完成：{hours} 个小时、{days} 个池·日")
+        finally:
+            conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
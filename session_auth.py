@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 登录会话
+- 农场 Wi-Fi 一断线，websocket 重连后 st.session_state 就没了，以前只能重新输密码
+- 登录成功后签发一个带过期时间的 HMAC 签名令牌（放在页面地址的查询参数里），
+  重连时凭令牌直接恢复登录：验签 + 进程内缓存，不查库、不跑 bcrypt
+- 按用户名限制连续输错密码的次数，防止暴力猜密码把 CPU 跑满
+
+注意：令牌在地址栏里，会跟着复制的链接、截图、浏览器历史和代理 / 访问日志一起泄露，
+拿到令牌的人在过期前都能以该用户身份登录。所以有效期设得短（默认 2 小时），
+活跃使用时过了一半有效期就换发新令牌、吊销旧的；不要把带 ?s= 的地址发给别人。
+
+令牌格式：base64url(json 载荷) + "." + base64url(HMAC-SHA256)
+载荷：{"uid", "u", "d", "r", "sid", "exp"}，sid 用于退出登录时吊销
+"""
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+
+class InvalidSession(ValueError):
+    """令牌格式错误、签名不对、已过期或已退出"""
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionStore:
+    """签发 / 校验会话令牌；校验过的令牌缓存在进程内，重连时直接命中"""
+
+    def __init__(self, secret, ttl_seconds, max_cached=1000):
+        self.secret = secret.encode("utf-8") if isinstance(secret, str) else secret
+        self.ttl = ttl_seconds
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        self.verified = OrderedDict()  # 令牌 -> 载荷
+        self.revoked = {}  # sid -> 过期时间（过期后令牌本来就无效，到时清理）
+
+    def _sign(self, body):
+        return _b64encode(hmac.new(self.secret, body.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, user):
+        """user：{"id", "username", "department", "role"}，返回令牌字符串"""
+        payload = {"uid": user["id"], "u": user["username"], "d": user["department"], "r": user["role"],
+                   "sid": secrets.token_urlsafe(12), "exp": int(time.time()) + self.ttl}
+        body = _b64encode(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        token = f"{body}.{self._sign(body)}"
+        with self.lock:
+            self._remember(token, payload)
+        return token
+
+    def verify(self, token):
+        """返回 {"id", "username", "department", "role"}；无效时抛 InvalidSession"""
+        now = time.time()
+        with self.lock:
+            payload = self.verified.get(token)
+            if payload is not None:
+                self.verified.move_to_end(token)
+        if payload is None:
+            payload = self._check(token)
+        if payload["exp"] <= now:
+            self._forget(token)
+            raise InvalidSession("登录已过期")
+        with self.lock:
+            if payload["sid"] in self.revoked:
+                raise InvalidSession("已退出登录")
+            self._remember(token, payload)
+        return {"id": payload["uid"], "username": payload["u"], "department": payload["d"], "role": payload["r"]}
+
+    def needs_renewal(self, token):
+        """令牌剩余有效期不到一半时返回 True；令牌无效时抛 InvalidSession"""
+        with self.lock:
+            payload = self.verified.get(token)
+        if payload is None:
+            payload = self._check(token)
+        return payload["exp"] - time.time() < self.ttl / 2
+
+    def revoke(self, token):
+        """退出登录：只在本进程内吊销（其他进程要等令牌过期）"""
+        try:
+            payload = self._check(token)
+        except InvalidSession:
+            return
+        now = time.time()
+        with self.lock:
+            self.verified.pop(token, None)
+            self.revoked[payload["sid"]] = payload["exp"]
+            for sid in [s for s, exp in self.revoked.items() if exp <= now]:
+                del self.revoked[sid]
+
+    def _check(self, token):
+        try:
+            body, sig = token.split(".", 1)
+            if not hmac.compare_digest(sig, self._sign(body)):
+                raise InvalidSession("签名不正确")
+            return json.loads(_b64decode(body))
+        except InvalidSession:
+            raise
+        except (ValueError, TypeError, UnicodeError) as e:
+            raise InvalidSession(f"令牌格式错误：{e}") from e
+
+    def _remember(self, token, payload):
+        self.verified[token] = payload
+        self.verified.move_to_end(token)
+        while len(self.verified) > self.max_cached:
+            self.verified.popitem(last=False)
+
+    def _forget(self, token):
+        with self.lock:
+            self.verified.pop(token, None)
+
+
+class LoginRateLimiter:
+    """
+    按用户名计失败次数：window_seconds 内失败 max_failures 次后锁定 lockout_seconds。
+    登录成功清零。只在本进程内计数。
+    """
+
+    def __init__(self, max_failures=5, window_seconds=300, lockout_seconds=300):
+        self.max_failures = max_failures
+        self.window = window_seconds
+        self.lockout = lockout_seconds
+        self.lock = threading.Lock()
+        self.failures = {}  # 用户名 -> deque[失败时间]
+        self.locked_until = {}
+
+    def retry_after(self, username):
+        """还需等待的秒数，0 表示可以尝试"""
+        with self.lock:
+            until = self.locked_until.get(username, 0)
+            remaining = until - time.monotonic()
+            if remaining <= 0 and until:
+                del self.locked_until[username]
+            return max(0, int(remaining + 0.999))
+
+    def record_failure(self, username):
+        now = time.monotonic()
+        with self.lock:
+            attempts = self.failures.setdefault(username, deque())
+            attempts.append(now)
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.max_failures:
+                self.locked_until[username] = now + self.lockout
+                attempts.clear()
+
+    def record_success(self, username):
+        with self.lock:
+            self.failures.pop(username, None)
+            self.locked_until.pop(username, None)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""feed_forecast.plan / ewma_fold 的边界情况（python -m unittest test_feed_forecast）"""
+import unittest
+from datetime import date
+
+from feed_forecast import EWMA_SPANS, MAX_HORIZON_DAYS, ewma_fold, plan
+
+
+class PlanTest(unittest.TestCase):
+    def test_idle_feed_has_no_forecast(self):
+        # 用过一次 20 kg，之后闲置 125 天：EWMA 接近 0 但不为 0
+        rate = max(ewma_fold(ewma_fold(0.0, [20.0], span), [0.0] * 125, span) for span in EWMA_SPANS)
+        self.assertGreater(rate, 0)
+        self.assertEqual(plan(500.0, rate, 7, date(2026, 1, 1)), (None, 0.0, None, 0.0))
+
+    def test_slow_feed_is_clamped_to_horizon(self):
+        today = date(2026, 1, 1)
+        days_left, _, reorder_by, suggested = plan(1e6, 0.02, 7, today)
+        self.assertEqual(days_left, MAX_HORIZON_DAYS)
+        self.assertEqual((reorder_by - today).days, MAX_HORIZON_DAYS)
+        self.assertEqual(suggested, 0.0)
+
+    def test_reorder_when_below_reorder_point(self):
+        days_left, reorder_point, reorder_by, suggested = plan(100.0, 10.0, 7, date(2026, 1, 1))
+        self.assertEqual((days_left, reorder_point, reorder_by), (10.0, 100.0, date(2026, 1, 1)))
+        self.assertEqual(suggested, 300.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
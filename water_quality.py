@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+中益石蛙基地 - 水质异常检测
+- 数据来源：daily_log_shiwa（手工录入 + 探头日平均）
+- 两种检测，都用 pandas 按列整体计算：
+    self_z：和本池最近 SELF_WINDOW 条记录比，z 分数超过 Z_THRESHOLD
+    peer_iqr：和同一天同类型的其他池子比，超出 [Q1 - k·IQR, Q3 + k·IQR]
+- 增量：只检测水位线之后的日期；今天的数据可能还会补录 / 被探头更新，所以水位线只推进到昨天
+- 结果写进 water_quality_flag_shiwa，池塘总览页显示为告警，处理后标记已确认
+
+命令行（在 app.py 所在目录执行，读 .env 里的 DATABASE_SHIWA_URL）：
+    python water_quality.py detect      立即增量检测一次
+"""
+import sys
+from datetime import date, timedelta
+
+import pandas as pd
+
+# 检测的字段 → 中文名
+METRIC_LABELS = {"water_temp": "水温", "ph_value": "pH", "do_value": "溶氧", "humidity": "湿度"}
+# 标准差 / IQR 下限：数值几乎不变的池子，小波动不算异常
+METRIC_MIN_SPREAD = {"water_temp": 0.5, "ph_value": 0.1, "do_value": 0.3, "humidity": 3.0}
+METHOD_LABELS = {"self_z": "偏离本池近期水平", "peer_iqr": "偏离同类型池子"}
+
+SELF_WINDOW = 14
+SELF_MIN_PERIODS = 5
+Z_THRESHOLD = 3.0
+PEER_MIN_PONDS = 4
+IQR_K = 1.5
+# 首次运行回看的天数
+INITIAL_DAYS = 30
+# pg_try_advisory_xact_lock 的键：多个进程同时触发时只跑一个
+DETECT_LOCK = 0x5368697771
+
+
+def detect_anomalies(history, since):
+    """
+    history：DataFrame[pond_id, pond_type, log_date, *METRIC_LABELS]，需包含 since 之前至少 SELF_WINDOW 天
+    返回 since 之后（不含）的异常：DataFrame[pond_id, log_date, metric, method, value, baseline, score]
+    """
+    columns = ["pond_id", "log_date", "metric", "method", "value", "baseline", "score"]
+    if history.empty:
+        return pd.DataFrame(columns=columns)
+    long = history.melt(id_vars=["pond_id", "pond_type", "log_date"], value_vars=list(METRIC_LABELS),
+                        var_name="metric", value_name="value").dropna(subset=["value"])
+    long["value"] = long["value"].astype(float)
+    long = long.sort_values(["pond_id", "metric", "log_date"]).reset_index(drop=True)
+    min_spread = long["metric"].map(METRIC_MIN_SPREAD)
+
+    # ---- 本池历史：前 SELF_WINDOW 条（不含当天）的均值 / 标准差 ----
+    by_pond = long.groupby(["pond_id", "metric"])["value"]
+    mean = by_pond.transform(lambda s: s.shift(1).rolling(SELF_WINDOW, min_periods=SELF_MIN_PERIODS).mean())
+    std = by_pond.transform(lambda s: s.shift(1).rolling(SELF_WINDOW, min_periods=SELF_MIN_PERIODS).std())
+    z = (long["value"] - mean) / std.clip(lower=min_spread)
+    self_flags = long.assign(method="self_z", baseline=mean, score=z)[z.abs() >= Z_THRESHOLD]
+
+    # ---- 同类型池子：同一天的四分位距 ----
+    by_peer = long.groupby(["pond_type", "log_date", "metric"])["value"]
+    q1 = by_peer.transform(lambda s: s.quantile(0.25))
+    q3 = by_peer.transform(lambda s: s.quantile(0.75))
+    median = by_peer.transform("median")
+    peers = by_peer.transform("count")
+    iqr = (q3 - q1).clip(lower=min_spread)
+    over = long["value"] - (q3 + IQR_K * iqr)
+    under = (q1 - IQR_K * iqr) - long["value"]
+    score = (over.where(over > 0, 0) - under.where(under > 0, 0)) / iqr
+    peer_flags = long.assign(method="peer_iqr", baseline=median, score=score)[
+        (peers >= PEER_MIN_PONDS) & (score != 0)]
+
+    flags = pd.concat([self_flags, peer_flags], ignore_index=True)
+    flags = flags[pd.to_datetime(flags["log_date"]).dt.date > since]
+    return flags[columns].reset_index(drop=True)
+
+
+def run_incremental(conn, today=None):
+    """增量检测并写入告警表，返回本次写入（新增或更新）的告警条数；别的进程正在跑时返回 0"""
+    from psycopg2.extras import execute_values
+
+    today = today or date.today()
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (DETECT_LOCK,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return 0
+        cur.execute("SELECT last_date FROM water_quality_state_shiwa WHERE name = 'anomaly';")
+        row = cur.fetchone()
+        since = row[0] if row else today - timedelta(days=INITIAL_DAYS)
+
+        # 只取检测需要的历史：since 往前 3 个窗口（日期可能不连续）
+        history = pd.read_sql("""
+            SELECT d.pond_id, pt.name AS pond_type, d.log_date, d.water_temp, d.ph_value, d.do_value, d.humidity
+            FROM daily_log_shiwa d
+            JOIN pond_shiwa p ON p.id = d.pond_id
+            JOIN pond_type_shiwa pt ON pt.id = p.pond_type_id
+            WHERE d.log_date > %s AND d.log_date <= %s;
+        """, conn, params=(since - timedelta(days=3 * SELF_WINDOW), today))
+        flags = detect_anomalies(history, since)
+
+        # 重新检测的日期：未确认的旧告警先删掉（数据被修正后不再报），已确认的保留
+        cur.execute("DELETE FROM water_quality_flag_shiwa WHERE log_date > %s AND acknowledged_at IS NULL;", (since,))
+        if not flags.empty:
+            execute_values(cur, """
+                INSERT INTO water_quality_flag_shiwa (pond_id, log_date, metric, method, value, baseline, score)
+                VALUES %s
+                ON CONFLICT (pond_id, log_date, metric, method) DO UPDATE
+                SET value = EXCLUDED.value, baseline = EXCLUDED.baseline, score = EXCLUDED.score;
+            """, [(int(r.pond_id), r.log_date, r.metric, r.method, float(r.value),
+                   None if pd.isna(r.baseline) else float(r.baseline), round(float(r.score), 2))
+                  for r in flags.itertuples(index=False)])
+        # 今天的数据还会变，水位线只推进到昨天
+        cur.execute("""
+            INSERT INTO water_quality_state_shiwa (name, last_date) VALUES ('anomaly', %s)
+            ON CONFLICT (name) DO UPDATE SET last_date = GREATEST(water_quality_state_shiwa.last_date, EXCLUDED.last_date);
+        """, (max(since, today - timedelta(days=1)),))
+    conn.commit()
+    return len(flags)
+
+
+def main(argv):
+    if argv != ["detect"]:
+        print(__doc__)
+        return 1
+    from sensor_ingest import _get_conn
+
+    conn = _get_conn()
+    try:
+        print(f"✅ 检测完成：{run_incremental(conn)} 条异常")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))